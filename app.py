@@ -1,26 +1,139 @@
+import hashlib
 import json
 import logging
 import os
 import re
 import sys
+import time
 import urllib
 
-from flask import (url_for, render_template, flash, send_from_directory,
-                   request, jsonify, session, redirect, Response)
+import flask
+from flask import (url_for, flash, send_from_directory,
+                   request, jsonify, session, redirect, Response,
+                   stream_with_context, abort)
 
 import authentication
 import config
+import file_contents
 import github
 import github_comments
 import gitcritic
 import comment_db
+import metrics
+import parallel
+import prefetch
+import ratelimit
+import side_by_side
+import watchers
+import webhooks
 from logged_in import logged_in
 
 app = config.create_app()
-db = comment_db.CommentDb()
+db = comment_db.CommentDb(app.config['DRAFTS_DB_FILE'])
 authentication.install_github_oauth(app)
 
 
+# Long-lived requests which nobody is waiting on. These shouldn't hold up
+# background prefetching.
+_BACKGROUND_ENDPOINTS = ('pull_request_events',)
+
+
+@app.before_request
+def _begin_interactive():
+    if request.endpoint not in _BACKGROUND_ENDPOINTS:
+        prefetch.prefetcher.begin_interactive()
+
+
+@app.teardown_request
+def _end_interactive(exception):
+    if request.endpoint not in _BACKGROUND_ENDPOINTS:
+        prefetch.prefetcher.end_interactive()
+
+
+@app.before_request
+def _start_trace():
+    metrics.start_trace()
+
+
+@app.after_request
+def _add_server_timing(response):
+    '''Reports where the time went, see metrics.py.'''
+    trace, total_secs = metrics.finish_trace(request.endpoint)
+    if trace:
+        response.headers['Server-Timing'] = trace.server_timing(total_secs)
+    return response
+
+
+def render_template(template_name, **context):
+    with metrics.timed('render'):
+        return flask.render_template(template_name, **context)
+
+
+# Responses for a commit sha never change, so browsers can keep them. Pages
+# which can change are revalidated against their ETag on every visit.
+IMMUTABLE = 'private, max-age=31536000, immutable'
+REVALIDATE = 'private, no-cache'
+
+_FULL_SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+def _code_version():
+    '''Changes with each deploy, so cached pages don't outlive the code.
+
+    This covers the templates and the modules which fill them in.
+    '''
+    paths = [os.path.join(app.root_path, f)
+             for f in sorted(os.listdir(app.root_path)) if f.endswith('.py')]
+    for dirpath, dirnames, filenames in sorted(os.walk(
+            os.path.join(app.root_path, app.template_folder))):
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames))
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+CODE_VERSION = _code_version()
+
+
+def _etag(*parts):
+    return hashlib.sha1('\0'.join(
+            unicode(p).encode('utf-8') for p in parts)).hexdigest()
+
+
+def _page_etag(*parts):
+    '''An ETag for a rendered page, or None if it mustn't be cached.
+
+    A pending flash message isn't part of the ETag, so it can't be cached.
+    '''
+    if session.get('_flashes'):
+        return None
+    return _etag(CODE_VERSION, *parts)
+
+
+def _set_validators(response, etag, cache_control):
+    '''Makes a response cacheable, unless it's an error.'''
+    if response.status_code not in (200, 206, 304):
+        # e.g. the size of a file too large to show, which is best refetched.
+        return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def _not_modified(etag, cache_control):
+    '''A 304 if the client already has this version of the response.'''
+    if etag in request.if_none_match:
+        return _set_validators(Response(status=304), etag, cache_control)
+    return None
+
+
+def _wants_json():
+    '''Does the client prefer a JSON response to an HTML one?'''
+    best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
+    return best == 'application/json'
+
+
 @app.route("/<owner>/<repo>")
 @logged_in
 def plain_repo(owner, repo):
@@ -46,31 +159,50 @@ def pull(owner, repo, number):
     login = session['login']
 
     pr = gitcritic.PullRequest.from_github(db, token, login, owner, repo, number)
-
     if not sha1: sha1 = pr.pull_request['base']['sha']
     if not sha2: sha2 = pr.pull_request['head']['sha']
 
+    etag = _page_etag(pr.version(), sha1, sha2)
+    if etag:
+        not_modified = _not_modified(etag, REVALIDATE)
+        if not_modified:
+            return not_modified
+
+    pr.load('commits', 'files', 'comments')
+
     for commit in pr.commits:
         if commit['sha'] == sha1: commit['selected_left'] = True
         if commit['sha'] == sha2: commit['selected_right'] = True
 
     pr.add_file_diff_links(sha1, sha2)
-
-    return render_template('pull_request.html',
-                           logged_in_user=login,
-                           owner=owner, repo=repo,
-                           commits=pr.commits,
-                           pull_request=pr.pull_request,
-                           comments=pr.comments,
-                           files=pr.files)
-
-
-@app.route("/<owner>/<repo>/get_contents", methods=['POST'])
+    prefetch.prefetch_pull_request_files(
+            token, owner, repo, pr.files, sha1, sha2)
+
+    response = flask.make_response(render_template(
+            'pull_request.html',
+            logged_in_user=login,
+            owner=owner, repo=repo,
+            commits=pr.commits,
+            pull_request=pr.pull_request,
+            comments=pr.comments,
+            files=pr.files))
+    if etag:
+        _set_validators(response, etag, REVALIDATE)
+    return response
+
+
+@app.route("/<owner>/<repo>/get_contents", methods=['GET', 'POST'])
 @logged_in
 def get_contents(owner, repo):
+    '''A file's contents at a sha, streamed from the cache.
+
+    Supports Range requests. Binary files (415) and files over
+    CONTENTS_MAX_BYTES without a Range (413) get their size instead.
+    Responses for a full commit sha are cacheable forever.
+    '''
     token = session['token']
-    path = request.form.get('path', '')
-    sha = request.form.get('sha', '')
+    path = request.values.get('path', '')
+    sha = request.values.get('sha', '')
     if not (path and sha):
         e = {"code": "incomplete",
              "message": "Incomplete request (need path, sha)"}
@@ -78,8 +210,65 @@ def get_contents(owner, repo):
         response.status_code = 400
         return response
 
-    contents = github.get_file_at_ref(token, owner, repo, path, sha) or ''
-    return Response(contents, mimetype='text/plain')
+    etag = None
+    if _FULL_SHA_RE.match(sha):
+        etag = _etag('contents', owner, repo, path, sha)
+        not_modified = _not_modified(etag, IMMUTABLE)
+        if not_modified:
+            return not_modified
+
+    f = github.open_file_at_ref(token, owner, repo, path, sha)
+    if f is None:
+        return Response('', mimetype='text/plain')
+    response = _contents_response(f, path)
+    if etag:
+        _set_validators(response, etag, IMMUTABLE)
+    return response
+
+
+def _contents_response(f, path):
+    '''Streams an open file in response to get_contents. Closes it.'''
+    size = file_contents.size(f)
+    byte_range = request.range
+    if byte_range and len(byte_range.ranges) != 1:
+        # Servers may ignore a Range, which beats a multipart response.
+        byte_range = None
+    if file_contents.is_binary(f):
+        e = {"code": "binary", "size": size,
+             "message": "%s is a binary file (%d bytes)" % (path, size)}
+        status = 415
+    elif size > file_contents.MAX_BYTES and not byte_range:
+        e = {"code": "too_large", "size": size,
+             "message": "%s is too large to show (%d bytes)" % (path, size)}
+        status = 413
+    else:
+        e = None
+    if e:
+        f.close()
+        response = jsonify(e)
+        response.status_code = status
+        return response
+
+    start, end = 0, size
+    if byte_range:
+        span = byte_range.range_for_length(size)
+        if span is None:
+            f.close()
+            response = Response('', status=416)
+            response.headers['Content-Range'] = 'bytes */%d' % size
+            return response
+        start, end = span
+
+    response = Response(file_contents.iter_chunks(f, start, end),
+                        status=206 if byte_range else 200,
+                        mimetype='text/plain', direct_passthrough=True)
+    response.call_on_close(f.close)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Length'] = str(end - start)
+    if byte_range:
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, end - 1, size)
+    return response
 
 
 @app.route("/<owner>/<repo>/pull/<number>/diff")
@@ -94,16 +283,22 @@ def file_diff(owner, repo, number):
         return "Incomplete request (need path, sha1, sha2)"
 
     pr = gitcritic.PullRequest.from_github(db, token, login, owner, repo, number)
-
-    unified_diff = github.get_file_diff(token, owner, repo, path, sha1, sha2)
-    if not unified_diff:
+    etag = _page_etag(pr.version(), path, sha1, sha2)
+    if etag:
+        not_modified = _not_modified(etag, REVALIDATE)
+        if not_modified:
+            return not_modified
+
+    # Only this file's comments are placed on their diffs.
+    pr.load('commits', 'files')
+
+    parsed_diff = github_comments.get_parsed_diff(
+            token, owner, repo, path, sha1, sha2)
+    if not parsed_diff:
         return "Unable to get diff for %s..%s" % (sha1, sha2)
 
-    # github excludes the first four header lines of "git diff"
-    github_diff = '\n'.join(unified_diff.split('\n')[4:])
-
-    # before = github.get_file_at_ref(token, owner, repo, path, sha1) or ''
-    # after = github.get_file_at_ref(token, owner, repo, path, sha2) or ''
+    # github excludes the header lines of "git diff"
+    github_diff = '\n'.join(parsed_diff.lines)
 
     for commit in pr.commits:
         if commit['sha'] == sha1: commit['selected_left'] = True
@@ -128,19 +323,63 @@ def file_diff(owner, repo, number):
 
     github_file_urls = map(lambda sha: 'http://github.com/%s/%s/blob/%s/%s' % (owner, repo, sha, path), [sha1, sha2])
 
-    return render_template('file_diff.html',
-                           logged_in_user=login,
-                           owner=owner, repo=repo,
-                           pull_request=pr.pull_request,
-                           commits=pr.commits,
-                           comments=pr.comments,
-                           files=pr.files,
-                           path=path, sha1=sha1, sha2=sha2,
-                           # before_contents=before, after_contents=after,
-                           prev_file=prev_file, next_file=next_file,
-                           github_diff=github_diff,
-                           pull_request_url=pull_request_url,
-                           github_file_urls=github_file_urls)
+    response = flask.make_response(render_template(
+            'file_diff.html',
+            logged_in_user=login,
+            owner=owner, repo=repo,
+            pull_request=pr.pull_request,
+            commits=pr.commits,
+            comments=pr.comments_for_path(path),
+            files=pr.files,
+            path=path, sha1=sha1, sha2=sha2,
+            prev_file=prev_file, next_file=next_file,
+            github_diff=github_diff,
+            diff_rows=side_by_side.rows_for_diff(parsed_diff),
+            # Versioned, so that cached rows don't outlive the code.
+            context_url=url_for('diff_context', owner=owner, repo=repo,
+                                v=CODE_VERSION),
+            pull_request_url=pull_request_url,
+            github_file_urls=github_file_urls))
+    if etag:
+        _set_validators(response, etag, REVALIDATE)
+    return response
+
+
+@app.route("/<owner>/<repo>/diff_context")
+@logged_in
+def diff_context(owner, repo):
+    '''Rows of a file's diff which were collapsed, see side_by_side.py.'''
+    token = session['token']
+    path = request.args.get('path', '')
+    sha = request.args.get('sha', '')
+    try:
+        left_line = int(request.args['left_line'])
+        right_line = int(request.args['right_line'])
+        count = request.args.get('count')
+        count = int(count) if count else None
+    except (KeyError, ValueError):
+        left_line = None
+    if not (path and sha and left_line and right_line):
+        return "Incomplete request (need path, sha, left_line, right_line)", 400
+
+    etag = None
+    if _FULL_SHA_RE.match(sha):
+        etag = _etag('context', request.args.get('v'), owner, repo, path, sha,
+                     left_line, right_line, count)
+        not_modified = _not_modified(etag, IMMUTABLE)
+        if not_modified:
+            return not_modified
+
+    f = github.open_file_at_ref(token, owner, repo, path, sha)
+    if f is None:
+        abort(404)
+    with f:
+        lines = (line.rstrip('\n').decode('utf-8', 'replace') for line in f)
+        rows = side_by_side.context_rows(lines, left_line, right_line, count)
+    response = flask.make_response(render_template('diff_rows.html', rows=rows))
+    if etag:
+        _set_validators(response, etag, IMMUTABLE)
+    return response
 
 
 @app.route("/count_open_pull_requests", methods=['POST'])
@@ -151,6 +390,53 @@ def count_open_pull_requests():
     return jsonify(gitcritic.count_open_pull_requests(owner, repo))
 
 
+@app.route("/open_pull_request_counts", methods=['POST'])
+@logged_in
+def open_pull_request_counts():
+    '''Counts open PRs for each "owner/repo" in the "repo" form fields.
+
+    This streams back one line of JSON per repo (NDJSON), as results arrive.
+    '''
+    repos = [tuple(r.split('/', 1)) for r in request.form.getlist('repo')
+             if '/' in r]
+    def generate():
+        for result in gitcritic.iter_open_pull_request_counts(repos):
+            yield json.dumps(result) + '\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+@app.route("/<owner>/<repo>/pull/<number>/events")
+@logged_in
+def pull_request_events(owner, repo, number):
+    '''Server-sent events announcing changes to a pull request.
+
+    The page passes the updated_at of the copy it's showing. An "updated"
+    event is sent whenever github has something newer (see watchers.py).
+    '''
+    token = session['token']
+    updated_at = request.args.get('updated_at', '')
+    keepalive_secs = app.config['EVENT_KEEPALIVE_SECS']
+
+    def generate():
+        subscription = watchers.registry.subscribe(
+                token, owner, repo, number, updated_at)
+        try:
+            while True:
+                event = subscription.get(timeout=keepalive_secs)
+                if event is None:
+                    # Lets us notice when the client has gone away.
+                    yield ': keepalive\n\n'
+                else:
+                    yield 'event: updated\ndata: %s\n\n' % json.dumps(event)
+        finally:
+            watchers.registry.unsubscribe(subscription)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
 @app.route("/check_for_updates", methods=['POST'])
 def check_for_updates():
     owner = request.form['owner']
@@ -159,8 +445,11 @@ def check_for_updates():
     updated_at = request.form['updated_at']
     token = session['token']
 
+    # With a webhook set up, the cache is invalidated whenever the PR changes,
+    # so there's no need to ask github.
+    webhooks_enabled = bool(app.config.get('GITHUB_WEBHOOK_SECRET'))
     pr = github.get_pull_request(token, owner, repo, pull_number,
-                                 bust_cache=True)
+                                 bust_cache=not webhooks_enabled)
 
     if not pr:
         return "Error"
@@ -173,6 +462,27 @@ def check_for_updates():
     return "Update"
 
 
+@app.route("/webhook", methods=['POST'])
+def webhook():
+    '''Receives events from github, see webhooks.py.'''
+    secret = app.config.get('GITHUB_WEBHOOK_SECRET')
+    if not secret:
+        abort(404)
+    body = request.get_data()
+    if not webhooks.verify_signature(
+            secret, body,
+            signature_256=request.headers.get('X-Hub-Signature-256'),
+            signature_1=request.headers.get('X-Hub-Signature')):
+        abort(403)
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        abort(400)
+    event = request.headers.get('X-GitHub-Event', '')
+    handled = webhooks.handle_event(event, payload)
+    return jsonify({'event': event, 'handled': handled})
+
+
 @app.route("/save_draft", methods=['POST'])
 @logged_in
 def save_draft_comment():
@@ -182,6 +492,8 @@ def save_draft_comment():
     pull_number = request.form['pull_number']
     commit_id = request.form['commit_id']
     line_number = int(request.form['line_number'])
+    # Which side of the diff from the base to commit_id the line is on.
+    on_left = request.form.get('on_left') == 'true'
     in_reply_to = request.args.get('in_reply_to')
     comment = {
       'owner': owner,
@@ -202,14 +514,20 @@ def save_draft_comment():
     pr = github.get_pull_request(token, owner, repo, pull_number)
     base_sha = pr['base']['sha']
 
-    position, hunk = github_comments.lineNumberToDiffPositionAndHunk(token, owner, repo, base_sha, path, commit_id, line_number, False)
+    position, hunk = github_comments.lineNumberToDiffPositionAndHunk(token, owner, repo, base_sha, path, commit_id, line_number, on_left)
     if not position:
         return "Unable to get diff position for %s:%s @%s" % (path, line_number, commit_id)
 
     comment['original_position'] = position
     comment['diff_hunk'] = hunk
 
-    result = db.add_draft_comment(session['login'], comment)
+    login = session['login']
+    draft_version = db.get_draft_version(login, owner, repo, pull_number)
+    result = db.add_draft_comment(login, comment)
+    if result:
+        gitcritic.update_snapshot_drafts(db, token, login, owner, repo,
+                                         pull_number, draft_version,
+                                         saved=result)
     result = db.githubify_comment(result)
     # This is a bit roundabout, but more reliable!
     github_comments.add_line_number_to_comment(token, owner, repo, base_sha,
@@ -239,28 +557,35 @@ def publish_draft_comments():
     if not draft_comments and not new_top_level:
         return "No comments to publish!"
 
-    # TODO(danvk): publish comments in parallel
-    errors = []
-    for comment in draft_comments:
-        result = github.post_comment(token, owner, repo, pull_number, comment)
-        if not result:
-            errors.append(comment)
-            sys.stderr.write("Unable to publish comment: %s" % json.dumps(comment))
-        else:
-            db.delete_draft_comments([comment['id']])
-
-    logging.info('Successfully published %d comments', len(draft_comments))
+    results = gitcritic.publish_draft_comments(
+            db, token, owner, repo, pull_number, draft_comments)
+    failures = [r for r in results if not r['published']]
+    logging.info('Successfully published %d of %d comments',
+                 len(results) - len(failures), len(results))
 
+    top_level_error = None
     if new_top_level:
-        result = github.post_issue_comment(token, owner, repo, pull_number,
-                                           new_top_level)
+        try:
+            result = github.post_issue_comment(token, owner, repo,
+                                               pull_number, new_top_level)
+        except ratelimit.RateLimited:
+            # Drafts may have been published already, so report it with them.
+            result = None
         if not result:
-            return "Unable to publish comment: %s" % new_top_level
+            top_level_error = "Unable to publish comment: %s" % new_top_level
 
     github.expire_cache_for_pull_request(owner, repo, pull_number)
     github.expire_cache_for_pull_request_children(owner, repo, pull_number)
-    if errors:
+
+    if _wants_json():
+        return jsonify({'drafts': results, 'top_level_error': top_level_error})
+    if top_level_error:
+        return top_level_error
+    if failures:
         flash("Some comments could not be published. They've been left as drafts.")
+        for failure in failures:
+            flash("Unable to publish draft on %s: %s" % (
+                failure['path'], failure['error']))
     return redirect(url_for('pull', owner=owner, repo=repo, number=pull_number))
 
 
@@ -271,18 +596,66 @@ def discard_draft_comment():
     if not comment_id:
         return "Missing 'id' parameter"
 
+    draft = db.get_draft_comment_by_id(comment_id)
+    if not draft:
+        return "Error"
+    login, owner, repo, pull_number = (draft['login'], draft['owner'],
+                                       draft['repo'], draft['pull_number'])
+    draft_version = db.get_draft_version(login, owner, repo, pull_number)
     if db.delete_draft_comments([comment_id]):
+        gitcritic.update_snapshot_drafts(db, session['token'], login, owner,
+                                         repo, pull_number, draft_version,
+                                         deleted_ids=[comment_id])
         return "OK"
     else:
         return "Error"
 
 
+@app.errorhandler(parallel.DeadlineExceeded)
+def github_timeout(e):
+    return "Timed out waiting for github: %s" % e, 504
+
+
+@app.errorhandler(github.IncompleteList)
+def github_incomplete(e):
+    return "Unable to fetch everything from github: %s" % e, 502
+
+
+@app.errorhandler(ratelimit.RateLimited)
+def github_rate_limited(e):
+    retry_secs = max(1, int(e.retry_at - time.time()))
+    message = "%s. Try again in %d minute%s." % (
+            e, (retry_secs + 59) // 60, '' if retry_secs <= 60 else 's')
+    return message, 429, {'Retry-After': str(retry_secs)}
+
+
 @app.route('/')
 @logged_in
 def index():
     return user(session['login'])
 
 
+@app.route('/_status')
+@logged_in
+def status():
+    return jsonify({
+        'github_connections': github.client.stats(),
+        'github_cache': github.cache.stats(),
+        'github_inflight': github.inflight.stats(),
+        'github_rate_limit': dict(github.ratelimiter.stats(),
+                                  budget=github.ratelimiter.budget(session['token'])),
+        'prefetch': prefetch.prefetcher.stats(),
+        'watchers': watchers.registry.stats()
+    })
+
+
+@app.route('/metrics')
+def export_metrics():
+    '''Request and stage timings, in the Prometheus text format.'''
+    return Response(metrics.registry.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static/img'),
@@ -309,4 +682,5 @@ def user(user):
 
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0')
+    # Event streams hold a request open, so serve each request on a thread.
+    app.run(host='0.0.0.0', threaded=True)
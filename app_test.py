@@ -0,0 +1,134 @@
+import app
+import caching
+import comment_db
+import fake_github
+import file_contents
+import github_comments
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+SHA = 'a' * 40
+
+
+class GetContentsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.contents = '0123456789'
+        self.open_patch = patch('github.open_file_at_ref', self._open)
+        self.open_patch.start()
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        self.open_patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def _open(self, token, owner, repo, path, sha):
+        path = os.path.join(self.tmp_dir, 'contents')
+        with open(path, 'wb') as f:
+            f.write(self.contents)
+        return open(path, 'rb')
+
+    def _get(self, **headers):
+        return self.client.get('/danvk/dygraphs/get_contents?path=a.txt&sha=' +
+                               SHA, headers=headers)
+
+    def test_not_modified(self):
+        r = self._get()
+        self.assertEquals(200, r.status_code)
+        self.assertEquals(self.contents, r.data)
+        self.assertEquals(app.IMMUTABLE, r.headers['Cache-Control'])
+        etag = r.headers['ETag']
+
+        r = self._get(**{'If-None-Match': etag})
+        self.assertEquals(304, r.status_code)
+        self.assertEquals(etag, r.headers['ETag'])
+
+    def test_ranges(self):
+        r = self._get(Range='bytes=2-5')
+        self.assertEquals(206, r.status_code)
+        self.assertEquals('2345', r.data)
+        self.assertEquals('bytes 2-5/10', r.headers['Content-Range'])
+        self.assertIn('ETag', r.headers)
+
+        r = self._get(Range='bytes=20-30')
+        self.assertEquals(416, r.status_code)
+        self.assertEquals('bytes */10', r.headers['Content-Range'])
+        self.assertNotIn('ETag', r.headers)
+        self.assertNotIn('Cache-Control', r.headers)
+
+        # Several ranges get the whole file.
+        r = self._get(Range='bytes=0-1,5-6')
+        self.assertEquals(200, r.status_code)
+        self.assertEquals(self.contents, r.data)
+
+    def test_errors_are_not_cached(self):
+        self.contents = 'GIF89a\0\0\x01'
+        r = self._get()
+        self.assertEquals(415, r.status_code)
+        self.assertNotIn('ETag', r.headers)
+        self.assertNotIn('Cache-Control', r.headers)
+
+        self.contents = 'x' * 20
+        with patch('file_contents.MAX_BYTES', 10):
+            r = self._get()
+            self.assertEquals(413, r.status_code)
+            self.assertNotIn('ETag', r.headers)
+            # It can still be read a range at a time.
+            r = self._get(Range='bytes=0-9')
+            self.assertEquals(206, r.status_code)
+
+
+class FileDiffTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fake_pr = fake_github.FakePullRequest(num_commits=2, num_files=2,
+                                                   num_comments=3)
+        self.fake = fake_github.FakeGitHub(self.fake_pr)
+        self.patches = [
+            patch('github.GITHUB_API_ROOT', self.fake.root),
+            patch('github.cache', caching.TieredCache(self.tmp_dir)),
+            patch('github.client', fake_github.FakeClient(self.fake)),
+            patch('gitcritic.PR_BACKEND', 'rest'),
+            patch('app.db', comment_db.CommentDb(
+                    os.path.join(self.tmp_dir, 'drafts.sqlite')))
+        ]
+        for p in self.patches:
+            p.start()
+        github_comments._parsed_diffs.clear()
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        github_comments._parsed_diffs.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def _get(self, **headers):
+        return self.client.get(
+                '/danvk/dygraphs/pull/1/diff?path=%s&sha1=%s&sha2=%s' % (
+                    self.fake_pr.filenames[0], self.fake_pr.base_sha,
+                    self.fake_pr.commit_shas[-1]), headers=headers)
+
+    def test_not_modified(self):
+        r = self._get()
+        self.assertEquals(200, r.status_code)
+        self.assertEquals(app.REVALIDATE, r.headers['Cache-Control'])
+        r = self._get(**{'If-None-Match': r.headers['ETag']})
+        self.assertEquals(304, r.status_code)
+
+    def test_pending_flash(self):
+        etag = self._get().headers['ETag']
+        with self.client.session_transaction() as s:
+            s['_flashes'] = [('message', 'Unable to publish draft')]
+        r = self._get(**{'If-None-Match': etag})
+        self.assertEquals(200, r.status_code)
+        self.assertNotIn('ETag', r.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+'''Compares the cost of loading a pull request via REST vs. GraphQL.
+
+This runs against fake_github.py, so no network access or token is needed.
+Each load starts with an empty cache, i.e. it measures a cold page load.
+
+Usage:
+    python benchmark.py [--latency=0.1] [--commits=20] [--runs=3]
+'''
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import caching
+import fake_github
+import gitcritic
+import github
+import github_comments
+import metrics
+
+
+class _NoDrafts(object):
+    epoch = 'benchmark'
+
+    def get_draft_comments(self, login, owner, repo, number):
+        return []
+
+    def get_draft_version(self, login, owner, repo, number):
+        return 0
+
+
+def load_pull_request(fake, backend):
+    '''Loads the fake pull request with an empty cache.
+
+    Returns (seconds, number of HTTP requests, rate limit points used).
+    Each REST request costs a point; GraphQL queries report their own cost.
+    '''
+    cache_dir = tempfile.mkdtemp()
+    github.cache = caching.TieredCache(cache_dir)
+    github.client = github.GitHubClient()
+    github_comments._parsed_diffs.clear()
+    gitcritic.PR_BACKEND = backend
+    del fake.requests[:]
+    trace = metrics.start_trace()
+    try:
+        start = time.time()
+        pr = gitcritic.PullRequest.from_github(
+                _NoDrafts(), None, 'login', fake.pull_request.owner,
+                fake.pull_request.repo, fake.pull_request.number)
+        pr.load('commits', 'files', 'comments')
+        elapsed = time.time() - start
+    finally:
+        metrics.finish_trace('benchmark')
+        github.client.close()
+        shutil.rmtree(cache_dir)
+
+    num_graphql = fake.requests.count(('POST', '/graphql'))
+    num_rest = len(fake.requests) - num_graphql
+    graphql_cost = trace.counts.get('github_graphql_cost', 0)
+    return elapsed, len(fake.requests), num_rest + graphql_cost
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='Seconds to delay each fake github response.')
+    parser.add_argument('--commits', type=int, default=20,
+                        help='Number of commits in the pull request.')
+    parser.add_argument('--files', type=int, default=20,
+                        help='Number of files in the pull request.')
+    parser.add_argument('--comments', type=int, default=30,
+                        help='Number of comments on the pull request.')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Report the best of this many loads.')
+    args = parser.parse_args()
+
+    fake = fake_github.FakeGitHub(
+            fake_github.FakePullRequest(num_commits=args.commits,
+                                        num_files=args.files,
+                                        num_comments=args.comments),
+            latency=args.latency)
+    fake.start()
+    github.GITHUB_API_ROOT = fake.root
+
+    print '%-8s %10s %10s %10s' % ('backend', 'cold (s)', 'requests', 'cost')
+    try:
+        for backend in ('rest', 'graphql'):
+            runs = [load_pull_request(fake, backend) for _ in xrange(args.runs)]
+            elapsed, num_requests, cost = min(runs)
+            print '%-8s %10.3f %10d %10d' % (backend, elapsed, num_requests, cost)
+    finally:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
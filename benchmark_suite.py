@@ -0,0 +1,281 @@
+'''Times how building a pull request page scales with the pull request's size.
+
+Each size is a synthetic pull request from fake_github.py, with more commits,
+files, diff lines, comments and drafts than the last. github responses are
+served in-process by a FakeClient, so only our own work is timed: building
+the PullRequest model (for the PR page, for one file's diff, and from its
+snapshot), mapping comments onto diffs, and rendering the pages.
+
+Times are divided by the time of a fixed workload before being compared with
+the stored baseline, which makes the comparison roughly independent of
+the speed of the machine. The suite exits with status 1 if any operation got
+slower than the baseline by more than the tolerance, or if it scales worse
+with the size of the pull request (e.g. it went from linear to quadratic).
+
+Usage:
+    python benchmark_suite.py [--runs=5] [--tolerance=2] [--update-baseline]
+'''
+
+import argparse
+import copy
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+# The app needs a config; the testing one fakes the OAuth settings.
+os.environ.setdefault('BETTER_PR_CONFIG', 'testing.config')
+
+import caching
+import comment_db
+import fake_github
+import gitcritic
+import github
+import github_comments
+import side_by_side
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'testdata', 'benchmark_baseline.json')
+
+# Pull request sizes, smallest first. Every dimension grows with the scale.
+SIZES = [('small', 1), ('medium', 2), ('large', 4), ('huge', 8)]
+
+# Measurements shorter than this are mostly noise; they're reported, but
+# never counted as regressions.
+MIN_SECS = 0.02
+
+# An operation scales worse than its baseline if time ~ scale^k has a k this
+# much larger.
+MAX_EXPONENT_INCREASE = 0.5
+
+
+def _pull_request_for_scale(scale):
+    return fake_github.FakePullRequest(num_commits=5 * scale,
+                                       num_files=10 * scale,
+                                       num_comments=20 * scale,
+                                       lines_per_file=10 * scale)
+
+
+def _best_of(runs, fn, setup=None):
+    '''Returns the fastest of several calls to fn(), in seconds.'''
+    times = []
+    for _ in xrange(runs):
+        args = setup() if setup else ()
+        start = timeit.default_timer()
+        fn(*args)
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+
+def calibrate(runs):
+    '''Times a fixed workload, as a measure of this machine's speed.'''
+    data = [{'id': i, 'body': 'Comment %d' % i} for i in xrange(20000)]
+    return _best_of(runs, lambda: sorted(json.loads(json.dumps(data)),
+                                         key=lambda c: c['body']))
+
+
+class _Fixture(object):
+    '''A synthetic pull request, its drafts, and a github which serves it.'''
+    def __init__(self, scale, tmp_dir):
+        self.fake_pr = _pull_request_for_scale(scale)
+        self.fake = fake_github.FakeGitHub(self.fake_pr)
+        self.tmp_dir = tmp_dir
+        self.db = comment_db.CommentDb(os.path.join(tmp_dir, 'drafts.sqlite'))
+        for i, comment in enumerate(self.fake_pr.review_comments[::4]):
+            self.db.add_draft_comment('login', {
+                'owner': self.fake_pr.owner,
+                'repo': self.fake_pr.repo,
+                'pull_number': self.fake_pr.number,
+                'path': comment['path'],
+                'original_commit_id': comment['original_commit_id'],
+                'original_position': comment['original_position'],
+                'diff_hunk': comment['diff_hunk'],
+                'body': 'Draft reply %d' % i
+            })
+
+    def reset_caches(self):
+        github.cache = caching.TieredCache(tempfile.mkdtemp(dir=self.tmp_dir))
+        github_comments._parsed_diffs.clear()
+
+    def load(self, *names):
+        '''Builds the PullRequest as a view would, by default the PR page.'''
+        fake_pr = self.fake_pr
+        pr = gitcritic.PullRequest.from_github(
+                self.db, None, 'login', fake_pr.owner, fake_pr.repo,
+                fake_pr.number)
+        pr.load(*(names or ('commits', 'files', 'comments')))
+        return pr
+
+
+def run_size(scale, runs, app):
+    '''Returns {operation: seconds} for a pull request of the given scale.'''
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fixture = _Fixture(scale, tmp_dir)
+        github.client = fake_github.FakeClient(fixture.fake)
+        github.GITHUB_API_ROOT = fixture.fake.root
+        fake_pr = fixture.fake_pr
+        base_sha = fake_pr.base_sha
+        results = {}
+
+        def cold():
+            fixture.reset_caches()
+            return ()
+        results['from_github'] = _best_of(runs, fixture.load, cold)
+        path = fake_pr.filenames[-1]
+        results['file_diff_model'] = _best_of(
+                runs,
+                lambda: fixture.load('commits', 'files').comments_for_path(path),
+                cold)
+        pr = fixture.load()  # leaves the github cache warm
+        results['from_snapshot'] = _best_of(runs, fixture.load)
+
+        def fresh_comments():
+            github_comments._parsed_diffs.clear()
+            return (copy.deepcopy(pr.comments['diff_level']),)
+        results['add_line_numbers_to_comments'] = _best_of(
+                runs,
+                lambda comments: github_comments.add_line_numbers_to_comments(
+                    None, fake_pr.owner, fake_pr.repo, base_sha, comments),
+                fresh_comments)
+
+        results['add_in_response_to'] = _best_of(
+                runs,
+                lambda comments: github_comments.add_in_response_to(
+                    pr.pull_request, comments),
+                lambda: (copy.deepcopy(pr.comments['diff_level']),))
+
+        head_sha = pr.pull_request['head']['sha']
+        def map_every_line():
+            for path in fake_pr.filenames:
+                for line in xrange(1, fake_pr.lines_per_file + 2):
+                    github_comments.lineNumberToDiffPositionAndHunk(
+                            None, fake_pr.owner, fake_pr.repo, base_sha, path,
+                            head_sha, line, False)
+        results['lineNumberToDiffPositionAndHunk'] = _best_of(
+                runs, map_every_line)
+
+        with app.app.test_request_context():
+            pr.add_file_diff_links(base_sha, head_sha)
+            results['render_pull_request'] = _best_of(
+                    runs, lambda: app.render_template(
+                        'pull_request.html',
+                        logged_in_user='login',
+                        owner=fake_pr.owner, repo=fake_pr.repo,
+                        commits=pr.commits,
+                        pull_request=pr.pull_request,
+                        comments=pr.comments,
+                        files=pr.files))
+
+            def render_every_diff():
+                for path in fake_pr.filenames:
+                    rows = side_by_side.rows_for_diff(
+                            github_comments.get_parsed_diff(
+                                None, fake_pr.owner, fake_pr.repo, path,
+                                base_sha, head_sha))
+                    app.render_template('diff_rows.html', rows=rows)
+            results['render_file_diffs'] = _best_of(runs, render_every_diff)
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def scaling_exponent(times, scales):
+    '''Fits time ~ scale^k between the smallest and largest sizes.'''
+    if times[0] <= 0 or len(times) < 2:
+        return None
+    return math.log(times[-1] / times[0]) / math.log(
+            float(scales[-1]) / scales[0])
+
+
+def _exponent(by_size):
+    '''scaling_exponent for {size name: seconds}.'''
+    sizes = [(name, scale) for name, scale in SIZES if name in by_size]
+    return scaling_exponent([by_size[name] for name, _ in sizes],
+                            [scale for _, scale in sizes])
+
+
+def find_regressions(results, calibration_secs, baseline, tolerance):
+    '''Returns a description of each regression against the baseline.
+
+    results is {operation: {size: seconds}}. On a slower machine than the
+    baseline's, its times are scaled up by the ratio of the calibration times.
+    They're never scaled down: the calibration is noisy enough that a lucky
+    run would make everything else look like a regression.
+    '''
+    speed = max(1.0, calibration_secs / baseline['calibration_secs'])
+    regressions = []
+    for op, by_size in sorted(results.iteritems()):
+        expected_by_size = baseline['results'].get(op)
+        if not expected_by_size:
+            continue
+        for size, secs in sorted(by_size.iteritems()):
+            if size not in expected_by_size:
+                continue
+            limit = expected_by_size[size] * speed * tolerance
+            if secs >= MIN_SECS and secs > limit:
+                regressions.append(
+                        '%s (%s) took %.1f ms, expected at most %.1f ms' % (
+                            op, size, 1000 * secs, 1000 * limit))
+        k, expected_k = _exponent(by_size), _exponent(expected_by_size)
+        if (k is not None and expected_k is not None and
+                k > expected_k + MAX_EXPONENT_INCREASE):
+            regressions.append('%s scales as n^%.2f, was n^%.2f' % (
+                op, k, expected_k))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Report the best of this many runs.')
+    parser.add_argument('--tolerance', type=float, default=2.0,
+                        help='Fail if an operation takes more than this '
+                        'multiple of its baseline time.')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Store these results as the new baseline.')
+    args = parser.parse_args()
+
+    import app  # after the config is set
+    for name in ('', 'github'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    calibration_secs = calibrate(args.runs)
+    results = {}
+    for name, scale in SIZES:
+        for op, secs in run_size(scale, args.runs, app).iteritems():
+            results.setdefault(op, {})[name] = secs
+
+    names = [name for name, _ in SIZES]
+    print '%-32s' % 'operation (ms)' + ''.join('%10s' % n for n in names) + '  scaling'
+    for op in sorted(results):
+        k = _exponent(results[op])
+        print '%-32s' % op + ''.join(
+                '%10.1f' % (1000 * results[op][n]) for n in names) + (
+                '  ~n^%.2f' % k if k is not None else '')
+    print 'calibration: %.1f ms' % (1000 * calibration_secs)
+
+    if args.update_baseline:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump({'calibration_secs': calibration_secs,
+                       'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print 'Wrote %s' % BASELINE_FILE
+        return
+
+    with open(BASELINE_FILE) as f:
+        baseline = json.load(f)
+    regressions = find_regressions(results, calibration_secs, baseline,
+                                   args.tolerance)
+    for regression in regressions:
+        print 'REGRESSION: %s' % regression
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import benchmark_suite
+import caching
+import fake_github
+import github
+import github_comments
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+
+class BenchmarkSuiteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.baseline = {
+            'calibration_secs': 0.1,
+            'results': {'from_github': {'small': 0.1, 'medium': 0.2,
+                                        'large': 0.4, 'huge': 0.8}}
+        }
+
+    def test_no_regressions(self):
+        results = {'from_github': {'small': 0.12, 'medium': 0.2,
+                                   'large': 0.4, 'huge': 0.9}}
+        self.assertEquals([], benchmark_suite.find_regressions(
+                results, 0.1, self.baseline, 1.5))
+
+    def test_slower(self):
+        results = {'from_github': {'small': 0.1, 'medium': 0.2,
+                                   'large': 0.4, 'huge': 1.0}}
+        regressions = benchmark_suite.find_regressions(
+                results, 0.1, self.baseline, 1.2)
+        self.assertEquals(1, len(regressions))
+        self.assertIn('from_github (huge)', regressions[0])
+        # ... but not on a machine which is that much slower.
+        self.assertEquals([], benchmark_suite.find_regressions(
+                results, 0.2, self.baseline, 1.2))
+
+    def test_scales_worse(self):
+        # Quadratic rather than linear, though the small case got faster.
+        results = {'from_github': {'small': 0.05, 'medium': 0.2,
+                                   'large': 0.8, 'huge': 3.2}}
+        regressions = benchmark_suite.find_regressions(
+                results, 0.1, self.baseline, 100)
+        self.assertEquals(['from_github scales as n^2.00, was n^1.00'],
+                          regressions)
+
+
+class FakeClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fixture = benchmark_suite._Fixture(1, self.tmp_dir)
+        self.patches = [
+            patch('github.GITHUB_API_ROOT', self.fixture.fake.root),
+            patch('github.cache', caching.TieredCache(self.tmp_dir)),
+            patch('github.client', fake_github.FakeClient(self.fixture.fake))
+        ]
+        for p in self.patches:
+            p.start()
+        github_comments._parsed_diffs.clear()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        github_comments._parsed_diffs.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load(self):
+        pr = self.fixture.load()
+        fake_pr = self.fixture.fake_pr
+        self.assertEquals(fake_pr.pull_request['head']['sha'],
+                          pr.pull_request['head']['sha'])
+        self.assertEquals(len(fake_pr.filenames), len(pr.files))
+        self.assertEquals(len(fake_pr.commit_shas) + 1, len(pr.commits))
+        drafts = [c for c in pr.comments['diff_level'] if c.get('is_draft')]
+        self.assertEquals(len(fake_pr.review_comments[::4]), len(drafts))
+        # Every comment was placed on its diff.
+        for comment in pr.comments['diff_level']:
+            self.assertIn('diff_line', comment)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,544 @@
+'''Two-tier cache for github API responses.
+
+Responses live in an in-process LRU, in front of a size-capped directory on
+disk which is shared by all worker processes. Each entry is a body plus a
+small dict of metadata (HTTP validators, when it was fetched, ...).
+
+The disk is the source of truth: an entry in memory is only used while its
+metadata file on disk is the one it was read with. So an update or expiry in
+one process is seen by all of them, at the cost of a stat() per memory hit.
+
+Policies decide whether a cached entry may be served without asking github.
+'''
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class Immutable(object):
+    '''For responses which can never change, e.g. anything addressed by sha.'''
+    store = True
+
+    def is_fresh(self, meta, now):
+        return True
+
+
+class Revalidate(object):
+    '''For mutable responses.
+
+    These are served from cache for ttl seconds after they were fetched.
+    After that (or once they've been marked stale), they must be revalidated
+    with github before they're used again.
+    '''
+    store = True
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+
+    def is_fresh(self, meta, now):
+        if meta.get('stale'):
+            return False
+        return now - meta.get('fetched_at', 0) < self.ttl
+
+
+class NeverCache(object):
+    '''For responses which should always come straight from github.'''
+    store = False
+
+    def is_fresh(self, meta, now):
+        return False
+
+
+class CacheStats(object):
+    '''Thread-safe hit/miss/eviction counters.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0
+        }
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class MemoryCache(object):
+    '''In-process LRU cache of (body, meta, version) tuples, capped in bytes.
+
+    version identifies the disk entry that the body and meta came from.
+    '''
+    def __init__(self, max_bytes, stats):
+        self._max_bytes = max_bytes
+        self._stats = stats
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, k):
+        with self._lock:
+            entry = self._entries.pop(k, None)
+            if entry is None:
+                return None
+            self._entries[k] = entry  # move to the most-recent end
+            return entry[0], dict(entry[1]), entry[2]
+
+    def set(self, k, body, meta, version):
+        size = len(body)
+        if size > self._max_bytes:
+            self.delete(k)
+            return
+        with self._lock:
+            old = self._entries.pop(k, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._entries[k] = (body, dict(meta), version)
+            self._size += size
+            while self._size > self._max_bytes:
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self._stats.incr('memory_evictions')
+
+    def peek(self, k):
+        '''Returns (body, version) for a key without copying or reordering.'''
+        with self._lock:
+            entry = self._entries.get(k)
+            return (entry[0], entry[2]) if entry is not None else (None, None)
+
+    def set_meta(self, k, meta, version):
+        with self._lock:
+            if k in self._entries:
+                self._entries[k] = (self._entries[k][0], dict(meta), version)
+
+    def delete(self, k):
+        with self._lock:
+            old = self._entries.pop(k, None)
+            if old is not None:
+                self._size -= len(old[0])
+
+
+class LruCache(object):
+    '''Thread-safe in-process LRU for arbitrary objects, capped by count.'''
+    def __init__(self, max_items):
+        self._max_items = max_items
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, k):
+        with self._lock:
+            v = self._entries.pop(k, None)
+            if v is not None:
+                self._entries[k] = v
+            return v
+
+    def set(self, k, v):
+        with self._lock:
+            self._entries.pop(k, None)
+            self._entries[k] = v
+            while len(self._entries) > self._max_items:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCache(object):
+    '''Directory of cached bodies, capped in bytes and evicted LRU.
+
+    Each key maps to a file named after its md5 plus a ".meta" JSON file.
+    Files are written to a temporary name and renamed into place, so readers
+    in other processes never see partial writes. Reads bump the file's mtime,
+    which serves as the LRU clock.
+
+    Every write replaces the .meta file, so its inode, mtime and size make a
+    version for the entry (see meta_version).
+    '''
+    def __init__(self, cache_dir, max_bytes, stats):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._stats = stats
+        self._lock = threading.Lock()
+        self._size = None  # lazily computed; approximate between evictions
+        if not os.path.exists(self._cache_dir):
+            os.makedirs(self._cache_dir)
+
+    def _file_for_key(self, k):
+        if isinstance(k, unicode):
+            k = k.encode('utf-8')
+        return os.path.join(self._cache_dir, hashlib.md5(k).hexdigest())
+
+    def _write_atomic(self, path, chunks):
+        '''Writes an iterable of byte strings to a file, returning its stat.'''
+        fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                f.flush()
+                st = os.fstat(f.fileno())
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+        return st
+
+    def _read_meta(self, path):
+        '''Returns (meta, version) for a cached body, or ({}, None).'''
+        try:
+            with open(path + '.meta') as f:
+                return json.load(f), _version(os.fstat(f.fileno()))
+        except (IOError, ValueError):
+            return {}, None
+
+    def get(self, k):
+        '''Returns (body, meta, version), or None.'''
+        path = self._file_for_key(k)
+        try:
+            with open(path, 'rb') as f:
+                body = f.read().decode('utf-8')
+            os.utime(path, None)
+        except (IOError, OSError, UnicodeDecodeError):
+            return None
+        meta, version = self._read_meta(path)
+        return body, meta, version
+
+    def get_meta(self, k):
+        return self._read_meta(self._file_for_key(k))[0]
+
+    def meta_version(self, k):
+        '''The version of an entry, or None if it isn't cached.'''
+        try:
+            return _version(os.stat(self._file_for_key(k) + '.meta'))
+        except OSError:
+            return None
+
+    def open(self, k):
+        '''Returns the cached body as an open binary file, or None.
+
+        The file stays readable even if the entry is replaced or evicted.
+        '''
+        path = self._file_for_key(k)
+        try:
+            f = open(path, 'rb')
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return f
+
+    def read_range(self, k, start, end):
+        '''Returns bytes [start, end) of a cached body, or None.'''
+        path = self._file_for_key(k)
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                data = f.read(end - start)
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        if len(data) != end - start:
+            return None
+        return data
+
+    def set(self, k, body, meta):
+        '''Stores an entry, returning its new version.'''
+        return self.set_file(k, [body.encode('utf-8')], meta)
+
+    def set_file(self, k, chunks, meta):
+        '''Like set, but stores raw bytes from an iterable as they arrive.'''
+        path = self._file_for_key(k)
+        # Write the body first: a new body with old validators only costs a
+        # full refetch, whereas the reverse could serve stale data on a 304.
+        size = self._write_atomic(path, chunks).st_size
+        version = self.set_meta(k, meta)
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            needs_eviction = self._size is None or self._size > self._max_bytes
+        if needs_eviction:
+            self._evict()
+        return version
+
+    def set_meta(self, k, meta):
+        '''Replaces an entry's metadata, returning its new version.'''
+        # Written even if it's empty, since it also versions the entry.
+        return _version(self._write_atomic(self._file_for_key(k) + '.meta',
+                                           [json.dumps(meta)]))
+
+    def delete(self, k):
+        path = self._file_for_key(k)
+        for p in (path, path + '.meta'):
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+
+    def _scan(self):
+        '''Returns a list of (mtime, total size, path) for cached bodies.'''
+        entries = []
+        for name in os.listdir(self._cache_dir):
+            if name.startswith('.tmp-') or name.endswith('.meta'):
+                continue
+            path = os.path.join(self._cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # deleted by another process
+            size = st.st_size
+            try:
+                size += os.path.getsize(path + '.meta')
+            except OSError:
+                pass
+            entries.append((st.st_mtime, size, path))
+        return entries
+
+    def _evict(self):
+        '''Deletes the least recently used files until under budget.
+
+        Other processes share the directory, so this rescans it rather than
+        trusting the in-process size estimate.
+        '''
+        with self._lock:
+            entries = self._scan()
+            total = sum(size for _, size, _ in entries)
+            if total > self._max_bytes:
+                entries.sort()
+                # Evict down to 90% of the budget so we don't rescan on
+                # every write.
+                target = self._max_bytes * 0.9
+                for _, size, path in entries:
+                    if total <= target:
+                        break
+                    for p in (path, path + '.meta'):
+                        try:
+                            os.unlink(p)
+                        except OSError:
+                            pass
+                    total -= size
+                    self._stats.incr('disk_evictions')
+            self._size = total
+
+    def size(self):
+        if self._size is None:
+            self._evict()
+        return self._size
+
+
+def _version(st):
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''Collapses concurrent calls for the same key into a single call.
+
+    The first caller for a key (the leader) runs the function; anyone else
+    who asks for that key before it finishes waits and gets the same result.
+
+    If lock_dir is set, leaders also take a lock file for the key, so that at
+    most one process at a time runs the function for it. The function should
+    check whether another process already did its work while it waited.
+    '''
+    # Keys share this many lock files, so that the directory doesn't grow
+    # without bound. There are enough that unrelated keys rarely collide.
+    NUM_LOCK_FILES = 65536
+
+    def __init__(self, lock_dir=None):
+        self._lock_dir = lock_dir
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._counts = {'leaders': 0, 'collapsed': 0}
+        if lock_dir and not os.path.exists(lock_dir):
+            os.makedirs(lock_dir)
+
+    def do(self, k, fn):
+        with self._lock:
+            flight = self._flights.get(k)
+            leader = flight is None
+            if leader:
+                flight = self._flights[k] = _Flight()
+                self._counts['leaders'] += 1
+            else:
+                self._counts['collapsed'] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result
+
+        try:
+            if self._lock_dir:
+                with self._file_lock(k):
+                    flight.result = fn()
+            else:
+                flight.result = fn()
+            return flight.result
+        except Exception:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[k]
+            flight.done.set()
+
+    def _file_lock(self, k):
+        if isinstance(k, unicode):
+            k = k.encode('utf-8')
+        stripe = int(hashlib.md5(k).hexdigest()[:8], 16) % self.NUM_LOCK_FILES
+        return _FileLock(os.path.join(self._lock_dir, '%04x.lock' % stripe))
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class _FileLock(object):
+    '''Exclusive flock() on a file, for use in a with statement.'''
+    def __init__(self, path):
+        self._path = path
+        self._f = None
+
+    def __enter__(self):
+        self._f = open(self._path, 'a')
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+
+
+class TieredCache(object):
+    '''Memory LRU in front of a DiskCache.
+
+    Values are unicode bodies, each with a dict of metadata.
+    '''
+    def __init__(self, cache_dir='/tmp/better-git-pr/cache',
+                 max_disk_bytes=1024 ** 3, max_memory_bytes=64 * 1024 ** 2):
+        self._stats = CacheStats()
+        self._memory = MemoryCache(max_memory_bytes, self._stats)
+        self._disk = DiskCache(cache_dir, max_disk_bytes, self._stats)
+
+    def _is_current(self, k, version):
+        '''Is a memory entry still the one on disk? Drops it if not.
+
+        Another process may have updated, expired or evicted it.
+        '''
+        if version is not None and version == self._disk.meta_version(k):
+            return True
+        self._memory.delete(k)
+        return False
+
+    def _memory_entry(self, k):
+        entry = self._memory.get(k)
+        if entry is not None and self._is_current(k, entry[2]):
+            return entry[0], entry[1]
+        return None
+
+    def get_entry(self, k):
+        '''Returns (body, meta) for a key, or (None, {}) if it's not cached.'''
+        entry = self._memory_entry(k)
+        if entry is not None:
+            self._stats.incr('memory_hits')
+            return entry
+        entry = self._disk.get(k)
+        if entry is not None:
+            self._stats.incr('disk_hits')
+            body, meta, version = entry
+            self._memory.set(k, body, meta, version)
+            return body, meta
+        self._stats.incr('misses')
+        return None, {}
+
+    def get(self, k):
+        return self.get_entry(k)[0]
+
+    def read_span(self, k, span):
+        '''Returns part of a cached body without reading all of it.
+
+        span is (byte_start, byte_end, char_start, char_end): the same range
+        as offsets into the UTF-8 encoded body and into the unicode body.
+        Returns None if the key isn't cached.
+        '''
+        byte_start, byte_end, char_start, char_end = span
+        body, version = self._memory.peek(k)
+        if body is not None and self._is_current(k, version):
+            self._stats.incr('memory_hits')
+            return body[char_start:char_end]
+        data = self._disk.read_range(k, byte_start, byte_end)
+        if data is None:
+            self._stats.incr('misses')
+            return None
+        self._stats.incr('disk_hits')
+        return data.decode('utf-8')
+
+    def open(self, k):
+        '''Returns a binary file of a cached body, or None.
+
+        Unlike get(), this doesn't read the whole body into memory, so large
+        bodies can be streamed. Bodies stored by set() are UTF-8.
+        '''
+        f = self._disk.open(k)
+        if f is not None:
+            self._stats.incr('disk_hits')
+            return f
+        self._memory.delete(k)
+        self._stats.incr('misses')
+        return None
+
+    def get_meta(self, k):
+        '''Returns the metadata stored with a key, or an empty dict.'''
+        entry = self._memory_entry(k)
+        if entry is not None:
+            return entry[1]
+        return self._disk.get_meta(k)
+
+    def set(self, k, v, meta=None):
+        meta = meta or {}
+        version = self._disk.set(k, v, meta)
+        self._memory.set(k, v, meta, version)
+
+    def set_file(self, k, chunks, meta=None):
+        '''Stores raw bytes from an iterable, without holding them in memory.
+
+        Unless the bytes are UTF-8, the entry can only be read via open().
+        '''
+        self._memory.delete(k)
+        self._disk.set_file(k, chunks, meta or {})
+
+    def set_meta(self, k, meta):
+        version = self._disk.set_meta(k, meta)
+        self._memory.set_meta(k, meta, version)
+
+    def delete_multi(self, ks):
+        for k in ks:
+            self._memory.delete(k)
+            self._disk.delete(k)
+
+    def stats(self):
+        stats = self._stats.snapshot()
+        stats['disk_bytes'] = self._disk.size()
+        return stats
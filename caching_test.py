@@ -0,0 +1,202 @@
+import caching
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+
+class CachingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_round_trip(self):
+        cache = caching.TieredCache(self.cache_dir)
+        self.assertEquals((None, {}), cache.get_entry('a'))
+        cache.set('a', u'body \u2603', {'etag': '"x"'})
+        self.assertEquals((u'body \u2603', {'etag': '"x"'}), cache.get_entry('a'))
+
+        # A fresh cache (e.g. in another process) reads it from disk.
+        other = caching.TieredCache(self.cache_dir)
+        self.assertEquals((u'body \u2603', {'etag': '"x"'}), other.get_entry('a'))
+        self.assertEquals(1, other.stats()['disk_hits'])
+        other.get_entry('a')
+        self.assertEquals(1, other.stats()['memory_hits'])
+
+        cache.set_meta('a', {'etag': '"y"'})
+        self.assertEquals({'etag': '"y"'}, cache.get_meta('a'))
+        cache.delete_multi(['a'])
+        self.assertEquals(None, cache.get('a'))
+        self.assertEquals([], os.listdir(self.cache_dir))
+
+    def test_open(self):
+        cache = caching.TieredCache(self.cache_dir)
+        self.assertEquals(None, cache.open('a'))
+        cache.set('a', u'body \u2603')
+        f = cache.open('a')
+        # Replacing the entry doesn't affect files which are already open.
+        cache.set('a', u'new body')
+        self.assertEquals(u'body \u2603'.encode('utf-8'), f.read())
+        f.close()
+
+        # The disk is the source of truth, even if it's still in memory.
+        cache._disk.delete('a')
+        self.assertEquals(None, cache.open('a'))
+        self.assertEquals(None, cache.get('a'))
+
+    def test_set_file(self):
+        cache = caching.TieredCache(self.cache_dir)
+        cache.set('a', u'old')
+        cache.set_file('a', iter(['\xff\0', 'binary']), {'etag': '"x"'})
+        with cache.open('a') as f:
+            self.assertEquals('\xff\0binary', f.read())
+        self.assertEquals({'etag': '"x"'}, cache.get_meta('a'))
+        # It isn't UTF-8, so it can't be read as text.
+        self.assertEquals(None, cache.get('a'))
+
+    def test_changes_seen_by_other_processes(self):
+        cache = caching.TieredCache(self.cache_dir)
+        other = caching.TieredCache(self.cache_dir)
+        cache.set('a', u'old', {'fetched_at': 1})
+        self.assertEquals(u'old', other.get('a'))  # now in its memory, too
+
+        cache.set_meta('a', {'fetched_at': 1, 'stale': True})
+        self.assertEquals((u'old', {'fetched_at': 1, 'stale': True}),
+                          other.get_entry('a'))
+        cache.set('a', u'new', {'fetched_at': 2})
+        self.assertEquals(u'new', other.get('a'))
+        self.assertEquals({'fetched_at': 2}, other.get_meta('a'))
+        self.assertEquals(3, other.stats()['disk_hits'])
+        cache.delete_multi(['a'])
+        self.assertEquals(None, other.get('a'))
+
+    def test_memory_lru(self):
+        cache = caching.TieredCache(self.cache_dir, max_memory_bytes=10)
+        cache.set('a', u'aaaa')
+        cache.set('b', u'bbbb')
+        cache.get('a')  # 'b' is now the least recently used.
+        cache.set('c', u'cccc')
+        self.assertEquals(1, cache.stats()['memory_evictions'])
+
+        cache.get('a')
+        cache.get('b')
+        stats = cache.stats()
+        self.assertEquals(2, stats['memory_hits'])
+        self.assertEquals(1, stats['disk_hits'])
+
+    def test_disk_eviction(self):
+        cache = caching.TieredCache(self.cache_dir, max_disk_bytes=100)
+        for i, k in enumerate('abcd'):
+            cache.set(k, u'x' * 30)
+            # Make sure mtimes are distinct and ordered.
+            path = cache._disk._file_for_key(k)
+            os.utime(path, (1000 + i, 1000 + i))
+
+        cache.set('e', u'x' * 30)
+        self.assertEquals(2, cache.stats()['disk_evictions'])
+        self.assertLessEqual(cache.stats()['disk_bytes'], 100)
+        self.assertEquals(None, caching.TieredCache(self.cache_dir).get('a'))
+        self.assertEquals(u'x' * 30, caching.TieredCache(self.cache_dir).get('e'))
+
+    def test_policies(self):
+        now = 1000
+        self.assertTrue(caching.Immutable().is_fresh({}, now))
+        self.assertFalse(caching.NeverCache().is_fresh({}, now))
+        self.assertFalse(caching.NeverCache().store)
+
+        policy = caching.Revalidate(ttl=60)
+        self.assertTrue(policy.is_fresh({'fetched_at': 950}, now))
+        self.assertFalse(policy.is_fresh({'fetched_at': 900}, now))
+        self.assertFalse(policy.is_fresh({'fetched_at': 950, 'stale': True}, now))
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def _race(self, flight, key, fn, n=5):
+        results = []
+        threads = [threading.Thread(
+                       target=lambda: results.append(flight.do(key, fn)))
+                   for _ in xrange(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_collapse(self):
+        calls = []
+        def fn():
+            calls.append(1)
+            time.sleep(0.1)
+            return len(calls)
+
+        flight = caching.SingleFlight()
+        self.assertEquals([1] * 5, self._race(flight, 'k', fn))
+        self.assertEquals({'leaders': 1, 'collapsed': 4}, flight.stats())
+
+        # Once it's finished, the next call runs again.
+        self.assertEquals(2, flight.do('k', fn))
+
+    def test_error(self):
+        gate = threading.Event()
+        def fn():
+            gate.wait()
+            raise ValueError('upstream failed')
+
+        flight = caching.SingleFlight()
+        errors = []
+        def call():
+            try:
+                flight.do('k', fn)
+            except ValueError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=call) for _ in xrange(3)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        gate.set()
+        for t in threads:
+            t.join()
+        self.assertEquals(3, len(errors))
+
+    def test_lock_dir(self):
+        lock_dir = tempfile.mkdtemp()
+        try:
+            # Separate instances stand in for separate processes.
+            flights = [caching.SingleFlight(lock_dir) for _ in xrange(2)]
+            running = []
+            overlaps = []
+            def fn():
+                running.append(1)
+                overlaps.append(len(running))
+                time.sleep(0.05)
+                running.pop()
+
+            threads = [threading.Thread(target=flight.do, args=('k', fn))
+                       for flight in flights]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEquals([1, 1], overlaps)
+            self.assertEquals(1, len(os.listdir(lock_dir)))
+
+            # Unrelated keys don't wait on each other.
+            gate = threading.Event()
+            t = threading.Thread(target=flights[0].do, args=('k', gate.wait))
+            t.start()
+            time.sleep(0.05)
+            self.assertEquals(2, flights[1].do('other', lambda: 2))
+            gate.set()
+            t.join()
+        finally:
+            shutil.rmtree(lock_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
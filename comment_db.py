@@ -1,7 +1,7 @@
 """On-disk database for draft comments.
 
 Draft comments are the one piece of state that gitcritic needs to track.
-This should use a real DB, but this was easier to set up on an airplane.
+They're stored in SQLite, which is safe to share between worker processes.
 
 Comment:
     key = (login, owner, repo, number)
@@ -22,37 +22,138 @@ import time
 import json
 import copy
 import logging
+import sqlite3
+import threading
+
+import metrics
+
+# Drafts used to be stored in this pickle file. If it exists, its contents
+# are migrated into the SQLite DB.
+LEGACY_PICKLE_FILE = '/tmp/better-git-pr/db.pickle'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS drafts (
+    id INTEGER NOT NULL UNIQUE,
+    login TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    pull_number TEXT NOT NULL,
+    comment TEXT NOT NULL  -- JSON-encoded, including all the fields above.
+);
+CREATE INDEX IF NOT EXISTS drafts_by_pull_request
+    ON drafts (login, owner, repo, pull_number);
+-- Changes whenever a user's drafts on a pull request change.
+CREATE TABLE IF NOT EXISTS draft_versions (
+    login TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    pull_number TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (login, owner, repo, pull_number)
+);
+-- A random number identifying this DB, so that versions from a deleted DB
+-- aren't mistaken for versions from this one.
+CREATE TABLE IF NOT EXISTS db_info (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    epoch INTEGER NOT NULL
+);
+'''
+
 
 class CommentDb(object):
-    """Fake DB for draft comments.
-
-    This stores the entire DB as a pickle file on disk."""
-    def __init__(self):
-        self._db_file = '/tmp/better-git-pr/db.pickle'
-        if os.path.exists(self._db_file):
-            self._comments = cPickle.load(open(self._db_file))
-            logging.info('Loaded %d draft comments.', len(self._comments))
-        else:
-            self._comments = []
+    """DB for draft comments, backed by SQLite.
+
+    The DB runs in WAL mode, so readers don't block writers and vice versa.
+    Each thread gets its own connection."""
+    def __init__(self, db_file='/tmp/better-git-pr/drafts.sqlite'):
+        self._db_file = db_file
+        self._local = threading.local()
+        db_dir = os.path.dirname(self._db_file)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO db_info (id, epoch) VALUES (0, ?)',
+                         (random.randrange(2**31),))
+        self.epoch = conn.execute('SELECT epoch FROM db_info').fetchone()[0]
+        self._migrate_pickle(LEGACY_PICKLE_FILE)
+
+    def _conn(self):
+        # Connections can't be shared across threads or a fork.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self._db_file, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
 
-    def _write(self):
-        cPickle.dump(self._comments, open(self._db_file, 'wb'))
+    def _migrate_pickle(self, pickle_file):
+        if not os.path.exists(pickle_file):
+            return
+        comments = cPickle.load(open(pickle_file))
+        with self._conn() as conn:
+            for comment in comments:
+                self._insert(conn, comment, 'INSERT OR IGNORE')
+        try:
+            os.rename(pickle_file, pickle_file + '.migrated')
+        except OSError:
+            pass  # another process got there first.
+        logging.info('Migrated %d draft comments from %s.',
+                     len(comments), pickle_file)
 
+    def _insert(self, conn, db_comment, verb='INSERT'):
+        conn.execute(
+            verb + ' INTO drafts (id, login, owner, repo, pull_number, comment) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (db_comment['id'], db_comment['login'], db_comment['owner'],
+             db_comment['repo'], unicode(db_comment['pull_number']),
+             json.dumps(db_comment)))
+
+    def _bump_version(self, conn, login, owner, repo, number):
+        key = (login, owner, repo, unicode(number))
+        conn.execute(
+            'INSERT OR IGNORE INTO draft_versions '
+            '(login, owner, repo, pull_number, version) VALUES (?, ?, ?, ?, 0)',
+            key)
+        conn.execute(
+            'UPDATE draft_versions SET version = version + 1 '
+            'WHERE login = ? AND owner = ? AND repo = ? AND pull_number = ?',
+            key)
+
+    @metrics.timed('db')
+    def get_draft_version(self, login, owner, repo, number):
+        '''Returns a count of the changes to these drafts.
+
+        Together with epoch, this identifies the drafts' current contents.
+        '''
+        row = self._conn().execute(
+            'SELECT version FROM draft_versions '
+            'WHERE login = ? AND owner = ? AND repo = ? AND pull_number = ?',
+            (login, owner, repo, unicode(number))).fetchone()
+        return row[0] if row else 0
+
+    @metrics.timed('db')
     def get_draft_comments(self, login, owner, repo, number):
-        return copy.deepcopy([x for x in self._comments if
-                x['login'] == login and
-                x['owner'] == owner and
-                x['repo'] == repo and
-                x['pull_number'] == number])
+        rows = self._conn().execute(
+            'SELECT comment FROM drafts '
+            'WHERE login = ? AND owner = ? AND repo = ? AND pull_number = ? '
+            'ORDER BY rowid',
+            (login, owner, repo, unicode(number))).fetchall()
+        return [json.loads(row[0]) for row in rows]
 
+    @metrics.timed('db')
     def get_draft_comment_by_id(self, comment_id):
-        rs = [x for x in self._comments if
-              x['id'] == comment_id]
-        if len(rs) == 1:
-            return copy.deepcopy(rs[0])
+        row = self._conn().execute(
+            'SELECT comment FROM drafts WHERE id = ?',
+            (int(comment_id),)).fetchone()
+        if row:
+            return json.loads(row[0])
         else:
             return None
 
+    @metrics.timed('db')
     def add_draft_comment(self, login, comment):
         assert 'owner' in comment
         assert 'repo' in comment
@@ -68,30 +169,37 @@ class CommentDb(object):
             'id': random.randrange(2**32)
         }
         db_comment.update(comment)
-        updated = False
-        if 'id' in comment:
-            for idx, c in enumerate(self._comments):
-                if c['id'] == comment['id']:
-                    self._comments[idx] = db_comment
-                    updated = True
-                    break
-            if not updated:
-                return None
-        else:
-            self._comments.append(db_comment)
-        self._write()
+        db_comment['id'] = int(db_comment['id'])
+        with self._conn() as conn:
+            if 'id' in comment:
+                cursor = conn.execute(
+                    'UPDATE drafts SET comment = ? WHERE id = ? AND login = ?',
+                    (json.dumps(db_comment), db_comment['id'], login))
+                if cursor.rowcount == 0:
+                    return None
+            else:
+                self._insert(conn, db_comment)
+            self._bump_version(conn, login, db_comment['owner'],
+                               db_comment['repo'], db_comment['pull_number'])
         return copy.deepcopy(db_comment)
-    
+
+    @metrics.timed('db')
     def delete_draft_comments(self, comment_ids):
-        indices = [i for (i, c) in enumerate(self._comments) if c['id'] in comment_ids]
-        results = []
-        for index in reversed(indices):
-            c = self._comments[index]
-            del self._comments[index]
-            results.append(c)
-        self._write()
-        results.reverse()
-        return copy.deepcopy(results)
+        comment_ids = [int(x) for x in comment_ids]
+        if not comment_ids:
+            return []
+        placeholders = ','.join('?' * len(comment_ids))
+        with self._conn() as conn:
+            rows = conn.execute(
+                'SELECT comment FROM drafts WHERE id IN (%s) ORDER BY rowid' %
+                placeholders, comment_ids).fetchall()
+            conn.execute('DELETE FROM drafts WHERE id IN (%s)' % placeholders,
+                         comment_ids)
+            deleted = [json.loads(row[0]) for row in rows]
+            for key in set((c['login'], c['owner'], c['repo'],
+                            unicode(c['pull_number'])) for c in deleted):
+                self._bump_version(conn, *key)
+        return deleted
 
     def githubify_comment(self, comment):
         comment['is_draft'] = True
@@ -0,0 +1,105 @@
+import comment_db
+import cPickle
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+
+def _comment(**kwargs):
+    comment = {
+        'owner': 'danvk',
+        'repo': 'dygraphs',
+        'pull_number': '296',
+        'original_commit_id': 'abc',
+        'path': 'dygraph.js',
+        'original_position': 4,
+        'diff_hunk': '@@ -30,6 +30,7 @@',
+        'body': 'Nice!'
+    }
+    comment.update(kwargs)
+    return comment
+
+
+class CommentDbTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pickle_file = os.path.join(self.tmp_dir, 'db.pickle')
+        self.pickle_patch = patch('comment_db.LEGACY_PICKLE_FILE',
+                                  self.pickle_file)
+        self.pickle_patch.start()
+
+    def tearDown(self):
+        self.pickle_patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def _db(self):
+        return comment_db.CommentDb(os.path.join(self.tmp_dir, 'drafts.sqlite'))
+
+    def test_add_get_delete(self):
+        db = self._db()
+        c1 = db.add_draft_comment('alice', _comment(body='one'))
+        c2 = db.add_draft_comment('alice', _comment(body='two'))
+        db.add_draft_comment('bob', _comment(body='three'))
+        db.add_draft_comment('alice', _comment(pull_number='297'))
+
+        drafts = db.get_draft_comments('alice', 'danvk', 'dygraphs', '296')
+        self.assertEquals(['one', 'two'], [c['body'] for c in drafts])
+        self.assertEquals(c1, db.get_draft_comment_by_id(c1['id']))
+
+        # Another connection (e.g. another worker) sees the same data.
+        self.assertEquals(drafts, self._db().get_draft_comments(
+                'alice', 'danvk', 'dygraphs', '296'))
+
+        deleted = db.delete_draft_comments([c1['id']])
+        self.assertEquals([c1], deleted)
+        self.assertEquals([c2], db.get_draft_comments(
+                'alice', 'danvk', 'dygraphs', '296'))
+        self.assertEquals(None, db.get_draft_comment_by_id(c1['id']))
+
+    def test_update(self):
+        db = self._db()
+        c = db.add_draft_comment('alice', _comment(body='draft'))
+        updated = db.add_draft_comment('alice', _comment(id=str(c['id']),
+                                                         body='edited'))
+        self.assertEquals(c['id'], updated['id'])
+        self.assertEquals(['edited'], [x['body'] for x in db.get_draft_comments(
+                'alice', 'danvk', 'dygraphs', '296')])
+
+        self.assertEquals(None, db.add_draft_comment('alice', _comment(id=1)))
+        self.assertEquals(None, db.add_draft_comment('bob', _comment(id=c['id'])))
+
+    def test_draft_version(self):
+        db = self._db()
+        def version():
+            return db.get_draft_version('alice', 'danvk', 'dygraphs', '296')
+        self.assertEquals(0, version())
+
+        c = db.add_draft_comment('alice', _comment())
+        v1 = version()
+        db.add_draft_comment('alice', _comment(id=c['id'], body='edited'))
+        v2 = version()
+        db.delete_draft_comments([c['id']])
+        v3 = version()
+        self.assertEquals([1, 2, 3], [v1, v2, v3])
+        self.assertEquals(db.epoch, self._db().epoch)
+
+        # Other users' drafts have their own versions.
+        db.add_draft_comment('bob', _comment())
+        self.assertEquals(v3, version())
+
+    def test_migrate_pickle(self):
+        legacy = dict(_comment(), login='alice', id=1234,
+                      updated_at='2014-07-01T00:00:00Z')
+        cPickle.dump([legacy], open(self.pickle_file, 'wb'))
+
+        db = self._db()
+        self.assertEquals([legacy], db.get_draft_comments(
+                'alice', 'danvk', 'dygraphs', '296'))
+        self.assertFalse(os.path.exists(self.pickle_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
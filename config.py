@@ -10,10 +10,37 @@ import logging
 from flask import Flask
 from flask_debugtoolbar import DebugToolbarExtension
 
+import caching
+import file_contents
+import gitcritic
+import github
 import jinja_filters
+import parallel
+import prefetch
+import ratelimit
+import watchers
 
 class BasicConfig:
     DEBUG_TB_INTERCEPT_REDIRECTS=False  # no interstitial on redirects
+    GITHUB_API_ROOT='https://api.github.com'  # or a fake_github.py server
+    GITHUB_MAX_CONCURRENCY=8  # simultaneous github API calls per page
+    GITHUB_POOL_SIZE=10  # keep-alive connections to github per process
+    GITHUB_CACHE_DIR='/tmp/better-git-pr/cache'
+    GITHUB_CACHE_MAX_BYTES=1024**3  # on disk, shared by all processes
+    GITHUB_MEMORY_CACHE_MAX_BYTES=64 * 1024**2  # per process
+    PULL_REQUEST_CACHE_TTL_SECS=300  # revalidate mutable PR data after this
+    GITHUB_LOCK_DIR=None  # lock files to collapse requests across processes
+    RATE_LIMIT_RESERVE=500  # stop background requests below this budget
+    RATE_LIMIT_MAX_WAIT_SECS=10  # longest a page waits out a rate limit
+    DRAFTS_DB_FILE='/tmp/better-git-pr/drafts.sqlite'
+    PR_FETCH_DEADLINE_SECS=30  # give up on a pull request after this long
+    GITHUB_PR_BACKEND='rest'  # or 'graphql', to fetch PRs in one query
+    PREFETCH_WORKERS=2  # background threads warming the cache; 0 disables
+    PREFETCH_QUEUE_SIZE=1000  # prefetches beyond this are dropped
+    CONTENTS_MAX_BYTES=1024**2  # larger files are only sent in ranges
+    GITHUB_WEBHOOK_SECRET=None  # enables /webhook, see webhooks.py
+    WATCH_INTERVAL_SECS=30  # how often open pull requests are checked
+    EVENT_KEEPALIVE_SECS=15  # between comments on idle event streams
 
 def create_app():
     app = Flask(__name__)
@@ -22,6 +49,30 @@ def create_app():
     toolbar = DebugToolbarExtension(app)
     jinja_filters.install_handlers(app)
 
+    parallel.MAX_WORKERS = app.config['GITHUB_MAX_CONCURRENCY']
+    github.GITHUB_API_ROOT = app.config['GITHUB_API_ROOT']
+    github.client = github.GitHubClient(
+            pool_size=app.config['GITHUB_POOL_SIZE'])
+    github.cache = caching.TieredCache(
+            cache_dir=app.config['GITHUB_CACHE_DIR'],
+            max_disk_bytes=app.config['GITHUB_CACHE_MAX_BYTES'],
+            max_memory_bytes=app.config['GITHUB_MEMORY_CACHE_MAX_BYTES'])
+    github.MUTABLE.ttl = app.config['PULL_REQUEST_CACHE_TTL_SECS']
+    github.inflight = caching.SingleFlight(
+            lock_dir=app.config['GITHUB_LOCK_DIR'])
+    github.ratelimiter = ratelimit.RateLimiter(
+            reserve=app.config['RATE_LIMIT_RESERVE'],
+            max_wait_secs=app.config['RATE_LIMIT_MAX_WAIT_SECS'])
+    gitcritic.PR_FETCH_DEADLINE_SECS = app.config['PR_FETCH_DEADLINE_SECS']
+    gitcritic.PR_BACKEND = app.config['GITHUB_PR_BACKEND']
+    file_contents.MAX_BYTES = app.config['CONTENTS_MAX_BYTES']
+    prefetch.prefetcher = prefetch.Prefetcher(
+            num_workers=app.config['PREFETCH_WORKERS'],
+            max_queue=app.config['PREFETCH_QUEUE_SIZE'])
+    watchers.registry = watchers.WatcherRegistry(
+            interval=app.config['WATCH_INTERVAL_SECS'],
+            webhooks_enabled=bool(app.config['GITHUB_WEBHOOK_SECRET']))
+
     if not (app.config['GITHUB_CLIENT_SECRET']
             and app.config['GITHUB_CLIENT_ID']
             and app.config['ROOT_URI']):
@@ -0,0 +1,678 @@
+'''A local stand-in for the github API, for tests, benchmarks and load tests.
+
+This serves synthetic pull requests through the REST endpoints which the app
+uses (pull requests, commits, diffs, file contents, comments, subscriptions),
+and through the GraphQL query in github_graphql.py. Recorded responses can be
+served too, see FakeGitHub.load_recording. To behave more like the real
+thing, responses can be delayed, fail at random, and count against a rate
+limit. Unchanged responses are revalidated via ETags, as on github.
+
+Usage:
+    fake = FakeGitHub(latency=0.05)
+    fake.start()
+    github.GITHUB_API_ROOT = fake.root
+    ...
+    fake.stop()
+
+Or run it on its own, and set GITHUB_API_ROOT in the app config to match:
+    python fake_github.py --port=8000 --pull-requests=3 --latency=0.05
+
+To skip HTTP altogether (e.g. to time gitcritic itself), use a FakeClient:
+    fake = FakeGitHub()
+    github.client = FakeClient(fake)
+    github.GITHUB_API_ROOT = fake.root
+'''
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import argparse
+import base64
+import contextlib
+import json
+import random
+import re
+import threading
+import time
+import urlparse
+
+from requests.structures import CaseInsensitiveDict
+
+
+def _sha(name):
+    return hashlib.sha1(name).hexdigest()
+
+
+def _timestamp(i):
+    return '2014-07-%02dT12:%02d:00Z' % (1 + i // 60, i % 60)
+
+
+def _user(login):
+    return {'login': login,
+            'avatar_url': 'https://avatars.example.com/%s' % login}
+
+
+def _query_cost(page_size):
+    '''What github charges for PULL_REQUEST_QUERY, in rate limit points.
+
+    That's the number of connections it may have to fetch (four on the pull
+    request, plus one per commit and one per review thread) divided by 100,
+    rounded, minimum 1.
+    '''
+    return max(1, int(round((4 + 2 * page_size) / 100.0)))
+
+
+def _now():
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+class FakePullRequest(object):
+    '''Deterministic data for one pull request, in REST API shapes.'''
+
+    def __init__(self, owner='danvk', repo='dygraphs', number=1,
+                 num_commits=10, num_files=20, num_comments=30,
+                 lines_per_file=3):
+        self.owner = owner
+        self.repo = repo
+        self.number = number
+        self.base_sha = _sha('base')
+        self.commit_shas = [_sha('commit-%d' % i) for i in xrange(num_commits)]
+        self.filenames = ['src/file%d.py' % i for i in xrange(num_files)]
+        self.lines_per_file = lines_per_file
+
+        self.repo_info = {
+            'name': repo,
+            'full_name': '%s/%s' % (owner, repo),
+            'owner': _user(owner)
+        }
+        self.pull_request = {
+            'id': 1000 + number,
+            'number': number,
+            'title': 'Pull request %d' % number,
+            'body': 'Description of the change.',
+            'state': 'open',
+            'html_url': 'https://github.com/%s/%s/pull/%d' % (owner, repo, number),
+            'created_at': _timestamp(0),
+            'updated_at': _timestamp(num_commits),
+            'user': _user('author'),
+            'base': {'ref': 'master', 'sha': self.base_sha,
+                     'repo': self.repo_info},
+            'head': {'ref': 'feature', 'sha': self.commit_shas[-1],
+                     'repo': self.repo_info}
+        }
+
+        self.commits = {}
+        parent = self.base_sha
+        for i, sha in enumerate(self.commit_shas + [self.base_sha]):
+            files = self._files(self.filenames[i % num_files:][:1])
+            self.commits[sha] = self._commit(sha, i, parent, files)
+            parent = sha
+        self.commits[self.base_sha]['parents'] = []
+
+        self.issue_comments = [{
+            'id': 2000 + i,
+            'body': 'Top-level comment %d' % i,
+            'html_url': 'https://github.com/%s/%s/pull/%d#issuecomment-%d' % (
+                owner, repo, number, 2000 + i),
+            'created_at': _timestamp(i),
+            'updated_at': _timestamp(i),
+            'user': _user('reviewer')
+        } for i in xrange(num_comments // 3)]
+
+        self.review_comments = []
+        for i in xrange(num_comments - len(self.issue_comments)):
+            sha = self.commit_shas[i % num_commits]
+            self.review_comments.append({
+                'id': 3000 + i,
+                'body': 'Diff comment %d' % i,
+                'html_url': 'https://github.com/%s/%s/pull/%d#discussion_r%d' % (
+                    owner, repo, number, 3000 + i),
+                'created_at': _timestamp(i),
+                'updated_at': _timestamp(i),
+                'user': _user('reviewer' if i % 2 else 'author'),
+                'path': self.filenames[i % num_files],
+                'position': 1 + i % (lines_per_file + 1),
+                'original_position': 1 + i % (lines_per_file + 1),
+                'diff_hunk': '@@ -1,3 +1,4 @@\n line 1\n+new line',
+                'commit_id': sha,
+                'original_commit_id': sha
+            })
+
+    def _files(self, filenames):
+        return [{
+            'filename': filename,
+            'status': 'modified',
+            'additions': 1,
+            'deletions': 0,
+            'changes': 1
+        } for filename in filenames]
+
+    def _commit(self, sha, i, parent, files):
+        person = {'name': 'Author', 'email': 'author@example.com',
+                  'date': _timestamp(i)}
+        return {
+            'sha': sha,
+            'html_url': 'https://github.com/%s/%s/commit/%s' % (
+                self.owner, self.repo, sha),
+            'author': _user('author'),
+            'committer': _user('author'),
+            'commit': {'message': 'Commit %d\n\nDetails.' % i,
+                       'author': person, 'committer': person},
+            'parents': [{'sha': parent}],
+            'files': files
+        }
+
+    def subscription(self):
+        '''The repo, as listed by /users/:user/subscriptions.'''
+        return dict(self.repo_info,
+                    html_url='https://github.com/%s/%s' % (self.owner, self.repo),
+                    open_issues_count=1,
+                    updated_at=self.pull_request['updated_at'])
+
+    def contents(self, path, sha):
+        '''A file's contents at a commit, or None if it doesn't exist.
+
+        This is consistent with diff(): every commit but the base has the
+        added line.
+        '''
+        if path not in self.filenames or (
+                sha != self.base_sha and sha not in self.commits):
+            return None
+        lines = ['line %d' % i for i in xrange(1, self.lines_per_file + 1)]
+        if sha != self.base_sha:
+            lines.insert(1, 'new line')
+        return ''.join(line + '\n' for line in lines)
+
+    def add_comment(self, kind, comment):
+        '''Posts a comment; kind is 'review' or 'issue'. Returns it.'''
+        comments = (self.review_comments if kind == 'review'
+                    else self.issue_comments)
+        comment = dict(comment)
+        comment.update({
+            'id': 10000 + len(self.review_comments) + len(self.issue_comments),
+            'created_at': _now(),
+            'updated_at': _now(),
+            'user': _user('fakelogin')
+        })
+        if kind == 'review':
+            comment['original_position'] = comment.get('position')
+            comment['original_commit_id'] = comment.get('commit_id')
+            comment.setdefault('diff_hunk', '')
+        comments.append(comment)
+        self.pull_request['updated_at'] = comment['updated_at']
+        return comment
+
+    def diff(self):
+        '''A unified diff touching every file in the pull request.
+
+        Each file gets one hunk, which adds a line after the first of its
+        lines_per_file lines.
+        '''
+        n = self.lines_per_file
+        hunk = ('@@ -1,%d +1,%d @@\n line 1\n+new line\n' % (n, n + 1) +
+                ''.join(' line %d\n' % i for i in xrange(2, n + 1)))
+        return ''.join(
+            'diff --git a/%(f)s b/%(f)s\n'
+            'index 1111111..2222222 100644\n'
+            '--- a/%(f)s\n'
+            '+++ b/%(f)s\n' % {'f': f} + hunk for f in self.filenames)
+
+    def graphql(self, page_size=100):
+        '''The response to github_graphql.PULL_REQUEST_QUERY.'''
+        def actor(user):
+            return {'login': user['login'], 'avatarUrl': user['avatar_url']}
+
+        def repo(r):
+            return {'name': r['name'], 'nameWithOwner': r['full_name'],
+                    'owner': actor(r['owner'])}
+
+        def connection(nodes):
+            return {'pageInfo': {'hasNextPage': False}, 'nodes': nodes}
+
+        def comment(c):
+            return {'databaseId': c['id'], 'body': c['body'],
+                    'url': c['html_url'], 'createdAt': c['created_at'],
+                    'updatedAt': c['updated_at'], 'author': actor(c['user'])}
+
+        def git_actor(person, user):
+            return dict(person, user=actor(user) if user else None)
+
+        def commit(c):
+            return {'oid': c['sha'], 'url': c['html_url'],
+                    'message': c['commit']['message'],
+                    'committedDate': c['commit']['committer']['date'],
+                    'author': git_actor(c['commit']['author'], c['author']),
+                    'committer': git_actor(c['commit']['committer'],
+                                           c['committer']),
+                    'parents': connection([{'oid': p['sha']}
+                                           for p in c['parents']])}
+
+        def review_comment(c):
+            node = comment(c)
+            node.update({
+                'path': c['path'],
+                'position': c['position'],
+                'originalPosition': c['original_position'],
+                'diffHunk': c['diff_hunk'],
+                'commit': {'oid': c['commit_id']},
+                'originalCommit': {'oid': c['original_commit_id']},
+                'replyTo': None
+            })
+            return node
+
+        pr = self.pull_request
+        return {
+            'rateLimit': {'cost': _query_cost(page_size), 'remaining': 4999,
+                          'resetAt': '2014-07-01T13:00:00Z'},
+            'repository': {'pullRequest': {
+                'databaseId': pr['id'],
+                'number': pr['number'],
+                'title': pr['title'],
+                'body': pr['body'],
+                'state': pr['state'].upper(),
+                'url': pr['html_url'],
+                'createdAt': pr['created_at'],
+                'updatedAt': pr['updated_at'],
+                'author': actor(pr['user']),
+                'baseRefName': pr['base']['ref'],
+                'baseRefOid': pr['base']['sha'],
+                'headRefName': pr['head']['ref'],
+                'headRefOid': pr['head']['sha'],
+                'baseRepository': repo(pr['base']['repo']),
+                'headRepository': repo(pr['head']['repo']),
+                'commits': connection([{'commit': commit(self.commits[sha])}
+                                       for sha in self.commit_shas]),
+                'files': connection([
+                    {'path': f, 'additions': 1, 'deletions': 0,
+                     'changeType': 'MODIFIED'} for f in self.filenames]),
+                'comments': connection([comment(c)
+                                        for c in self.issue_comments]),
+                'reviewThreads': connection([
+                    {'comments': connection([review_comment(c)])}
+                    for c in self.review_comments])
+            }}
+        }
+
+
+def synthetic_pull_requests(count, **kwargs):
+    '''Makes count FakePullRequests, each in its own repo.
+
+    The first is danvk/dygraphs#1, the default FakePullRequest; the rest
+    are danvk/repo1#1, danvk/repo2#1, ... kwargs are passed to each.
+    '''
+    return [FakePullRequest(repo='repo%d' % i if i else 'dygraphs', **kwargs)
+            for i in xrange(count)]
+
+
+def _json_response(obj, headers=None, status=200):
+    return status, json.dumps(obj), 'application/json', headers or {}
+
+
+def _error(status, message):
+    return _json_response({'message': message}, status=status)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like api.github.com
+
+    def _respond(self, method, body=None):
+        fake = self.server.fake
+        time.sleep(fake.latency)
+        status, body, content_type, headers = fake.handle(
+                method, self.path, self.headers, body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.iteritems():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self._respond('POST', self.rfile.read(int(self.headers['Content-Length'])))
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True  # don't wait on idle keep-alive connections
+
+
+class _RateLimit(object):
+    '''One token's budget for one resource.'''
+    def __init__(self, limit):
+        self.limit = limit
+        self.remaining = limit
+        self.reset = int(time.time()) + 3600
+
+    def headers(self, resource):
+        if time.time() >= self.reset:
+            self.remaining = self.limit
+            self.reset = int(time.time()) + 3600
+        return {
+            'X-RateLimit-Limit': str(self.limit),
+            'X-RateLimit-Remaining': str(self.remaining),
+            'X-RateLimit-Reset': str(self.reset),
+            'X-RateLimit-Resource': resource
+        }
+
+
+class FakeGitHub(object):
+    '''Runs a fake github API server on a background thread.
+
+    latency is the delay, in seconds, before each response.
+    error_rate is the fraction of requests which fail with a 502.
+    rate_limit is the number of requests each token may make per hour. If
+    it's set, responses carry X-RateLimit-* headers, and requests beyond the
+    limit get a 403.
+    requests records a (method, path) tuple for each request.
+    '''
+    def __init__(self, pull_request=None, latency=0, error_rate=0,
+                 rate_limit=None, seed=0):
+        self.pull_request = pull_request or FakePullRequest()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.requests = []
+        self.root = 'http://fake-github'  # replaced by start()
+        self._pull_requests = {}
+        self._recording = {}
+        self._rate_limits = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self.add_pull_request(self.pull_request)
+
+    def add_pull_request(self, pull_request):
+        pr = pull_request
+        self._pull_requests.setdefault((pr.owner, pr.repo), {})[pr.number] = pr
+
+    def load_recording(self, filename):
+        '''Serves recorded responses, in preference to synthetic ones.
+
+        The file holds a JSON object mapping request paths (including any
+        query string) to responses: {"body": ..., "status": 200,
+        "content_type": "application/json"}. Only "body" is required. A
+        non-string body is served as JSON.
+        '''
+        with open(filename) as f:
+            self._recording.update(json.load(f))
+
+    def record(self, method, path):
+        with self._lock:
+            self.requests.append((method, path))
+
+    def start(self, port=0):
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.fake = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.root = 'http://127.0.0.1:%d' % self._server.server_port
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, method, path, headers, body=None):
+        '''Returns (status, body, content type, headers) for a request.'''
+        self.record(method, path)
+        headers = headers or {}
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+        if failed:
+            return _error(502, 'Server Error')
+
+        resource = 'graphql' if path == '/graphql' else 'core'
+        budget = None
+        if self.rate_limit:
+            key = (headers.get('Authorization'), resource)
+            with self._lock:
+                budget = self._rate_limits.get(key)
+                if budget is None:
+                    budget = self._rate_limits[key] = _RateLimit(self.rate_limit)
+                rate_headers = budget.headers(resource)
+            if budget.remaining <= 0:
+                status, body, content_type, _ = _error(
+                        403, 'API rate limit exceeded')
+                return status, body, content_type, rate_headers
+
+        if method == 'POST':
+            response = self._post(path, body)
+        else:
+            response = self._get(path, headers)
+        status, body, content_type, response_headers = response
+
+        if method == 'GET' and status == 200:
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            response_headers = dict(response_headers, ETag=etag)
+            if headers.get('If-None-Match') == etag:
+                # Like github, this doesn't count against the rate limit.
+                status, body = 304, ''
+        if budget:
+            with self._lock:
+                if status != 304:
+                    budget.remaining -= 1
+                response_headers = dict(response_headers,
+                                        **budget.headers(resource))
+        return status, body, content_type, response_headers
+
+    def _list(self, path, items, query):
+        per_page = int(query.get('per_page', ['30'])[0])
+        page = int(query.get('page', ['1'])[0])
+        last_page = max(1, (len(items) + per_page - 1) // per_page)
+        headers = {}
+        if last_page > 1:
+            base = '%s%s?per_page=%d' % (self.root, path, per_page)
+            links = []
+            if page < last_page:
+                links.append('<%s&page=%d>; rel="next"' % (base, page + 1))
+            links.append('<%s&page=%d>; rel="last"' % (base, last_page))
+            headers['Link'] = ', '.join(links)
+        start = (page - 1) * per_page
+        return _json_response(items[start:start + per_page], headers)
+
+    def _recorded(self, full_path):
+        response = self._recording.get(full_path)
+        if response is None:
+            response = self._recording.get(urlparse.urlparse(full_path).path)
+        if response is None:
+            return None
+        body = response['body']
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        return (response.get('status', 200), body.encode('utf-8'),
+                response.get('content_type', 'application/json'), {})
+
+    def _get(self, full_path, headers):
+        recorded = self._recorded(full_path)
+        if recorded:
+            return recorded
+        url = urlparse.urlparse(full_path)
+        query = urlparse.parse_qs(url.query)
+
+        if url.path == '/user':
+            return _json_response({'login': 'fakelogin'})
+        m = re.match(r'^/users/[^/]+/subscriptions$', url.path)
+        if m:
+            return self._list(url.path, [
+                prs.values()[0].subscription()
+                for _, prs in sorted(self._pull_requests.iteritems())], query)
+
+        m = re.match(r'^/repos/([^/]+)/([^/]+)(/.*)$', url.path)
+        prs = m and self._pull_requests.get((m.group(1), m.group(2)))
+        if not prs:
+            return _error(404, 'Not Found')
+        path = m.group(3)
+
+        if path == '/pulls':
+            return self._list(url.path, [pr.pull_request for _, pr in
+                                         sorted(prs.iteritems())], query)
+        m = re.match(r'^/(pulls|issues)/([0-9]+)(/.*)?$', path)
+        if m:
+            pr = prs.get(int(m.group(2)))
+            rest = m.group(1), m.group(3)
+            if not pr:
+                return _error(404, 'Not Found')
+            if rest == ('pulls', None):
+                return _json_response(pr.pull_request)
+            if rest == ('pulls', '/commits'):
+                # Unlike /commits/:sha, these don't list their files.
+                return self._list(url.path, [
+                        dict((k, v) for k, v in pr.commits[sha].iteritems()
+                             if k != 'files')
+                        for sha in pr.commit_shas], query)
+            if rest == ('pulls', '/comments'):
+                return self._list(url.path, pr.review_comments, query)
+            if rest == ('issues', '/comments'):
+                return self._list(url.path, pr.issue_comments, query)
+            return _error(404, 'Not Found')
+
+        # Commits, diffs and contents are shared by every PR in a repo.
+        pr = prs.values()[0]
+        m = re.match(r'^/commits/([0-9a-f]{40})$', path)
+        if m and m.group(1) in pr.commits:
+            return _json_response(pr.commits[m.group(1)])
+        m = re.match(r'^/compare/([0-9a-f]{40})\.\.\.([0-9a-f]{40})$', path)
+        if m:
+            if 'diff' in headers.get('Accept', ''):
+                return 200, pr.diff(), 'text/plain', {}
+            return _json_response({'files': pr._files(pr.filenames)})
+        m = re.match(r'^/contents/(.+)$', path)
+        if m:
+            contents = pr.contents(m.group(1), query.get('ref', [''])[0])
+            if contents is None:
+                return _error(404, 'Not Found')
+            if 'raw' in headers.get('Accept', ''):
+                return 200, contents, 'text/plain', {}
+            return _json_response({'path': m.group(1), 'encoding': 'base64',
+                                   'content': base64.b64encode(contents)})
+        return _error(404, 'Not Found')
+
+    def _post(self, path, body):
+        request = json.loads(body)
+        if path == '/graphql':
+            return self._post_graphql(request)
+        m = re.match(r'^/repos/([^/]+)/([^/]+)/(pulls|issues)/([0-9]+)/comments$',
+                     path)
+        pr = m and self._pull_requests.get(
+                (m.group(1), m.group(2)), {}).get(int(m.group(4)))
+        if not pr:
+            return _error(404, 'Not Found')
+        if 'body' not in request:
+            return _error(422, 'Validation Failed')
+        with self._lock:
+            comment = pr.add_comment(
+                    'review' if m.group(3) == 'pulls' else 'issue', request)
+        return _json_response(comment, status=201)
+
+    def _post_graphql(self, request):
+        variables = request.get('variables', {})
+        pr = self._pull_requests.get(
+                (variables.get('owner'), variables.get('repo')), {}).get(
+                        variables.get('number'))
+        if pr is None:
+            data = {'repository': {'pullRequest': None},
+                    'rateLimit': {'cost': 1}}
+        else:
+            data = pr.graphql(variables.get('pageSize', 100))
+        return _json_response({'data': data})
+
+
+class _FakeResponse(object):
+    '''Just enough of a requests.Response for github.py.'''
+    def __init__(self, status_code, body, content_type, headers):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = body
+        self.text = body.decode('utf-8')
+        self.headers = CaseInsensitiveDict(headers)
+        self.headers['Content-Type'] = content_type
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1):
+        for i in xrange(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeClient(object):
+    '''Stands in for github.GitHubClient, calling a FakeGitHub directly.
+
+    There's no latency and no HTTP, so only the time spent in this process
+    is measured.
+    '''
+    def __init__(self, fake):
+        self._fake = fake
+
+    def _request(self, method, url, headers, data=None):
+        assert url.startswith(self._fake.root), url
+        return _FakeResponse(*self._fake.handle(
+                method, url[len(self._fake.root):], headers, data))
+
+    def get(self, url, headers=None):
+        return self._request('GET', url, headers)
+
+    @contextlib.contextmanager
+    def stream(self, url, headers=None):
+        yield self.get(url, headers)
+
+    def post(self, url, headers=None, data=None):
+        return self._request('POST', url, headers, data)
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--pull-requests', type=int, default=1,
+                        help='Number of synthetic pull requests to serve.')
+    parser.add_argument('--commits', type=int, default=10,
+                        help='Number of commits in each pull request.')
+    parser.add_argument('--files', type=int, default=20,
+                        help='Number of files in each pull request.')
+    parser.add_argument('--comments', type=int, default=30,
+                        help='Number of comments on each pull request.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds to delay each response.')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of requests which fail with a 502.')
+    parser.add_argument('--rate-limit', type=int, default=None,
+                        help='Requests allowed per token per hour.')
+    parser.add_argument('--recording', default=None,
+                        help='JSON file of recorded responses to serve.')
+    args = parser.parse_args()
+
+    pull_requests = synthetic_pull_requests(
+            args.pull_requests, num_commits=args.commits,
+            num_files=args.files, num_comments=args.comments)
+    fake = FakeGitHub(pull_requests[0], latency=args.latency,
+                      error_rate=args.error_rate, rate_limit=args.rate_limit)
+    for pr in pull_requests[1:]:
+        fake.add_pull_request(pr)
+    if args.recording:
+        fake.load_recording(args.recording)
+    fake.start(args.port)
+    print 'Serving a fake github API at %s' % fake.root
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import fake_github
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class FakeGitHubTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pr = fake_github.FakePullRequest()
+        self.fake = fake_github.FakeGitHub(self.pr)
+
+    def _get(self, path, **headers):
+        return self.fake.handle('GET', path, headers)
+
+    def test_contents_match_diff(self):
+        path = self.pr.filenames[0]
+        status, before, _, _ = self._get(
+                '/repos/danvk/dygraphs/contents/%s?ref=%s' % (
+                    path, self.pr.base_sha),
+                Accept='application/vnd.github.3.raw')
+        self.assertEquals(200, status)
+        _, after, _, _ = self._get(
+                '/repos/danvk/dygraphs/contents/%s?ref=%s' % (
+                    path, self.pr.commit_shas[-1]),
+                Accept='application/vnd.github.3.raw')
+        self.assertEquals('line 1\nline 2\nline 3\n', before)
+        self.assertEquals('line 1\nnew line\nline 2\nline 3\n', after)
+
+        status, _, _, _ = self._get(
+                '/repos/danvk/dygraphs/contents/nope.py?ref=%s' % self.pr.base_sha)
+        self.assertEquals(404, status)
+
+    def test_etags(self):
+        path = '/repos/danvk/dygraphs/pulls/1'
+        status, body, _, headers = self._get(path)
+        self.assertEquals(200, status)
+        status, body, _, _ = self._get(path, **{'If-None-Match': headers['ETag']})
+        self.assertEquals((304, ''), (status, body))
+
+    def test_rate_limit(self):
+        self.fake.rate_limit = 2
+        path = '/repos/danvk/dygraphs/pulls/1'
+        _, _, _, headers = self._get(path, Authorization='token a')
+        self.assertEquals('1', headers['X-RateLimit-Remaining'])
+        # Revalidations are free.
+        self._get(path, Authorization='token a',
+                  **{'If-None-Match': headers['ETag']})
+        self._get(path, Authorization='token a')
+        status, _, _, headers = self._get(path, Authorization='token a')
+        self.assertEquals(403, status)
+        self.assertEquals('0', headers['X-RateLimit-Remaining'])
+        # Each token has its own budget.
+        status, _, _, _ = self._get(path, Authorization='token b')
+        self.assertEquals(200, status)
+
+    def test_errors(self):
+        self.fake.error_rate = 0.5
+        statuses = [self._get('/repos/danvk/dygraphs/pulls/1')[0]
+                    for _ in xrange(100)]
+        self.assertTrue(20 < statuses.count(502) < 80, statuses.count(502))
+        self.assertEquals(100, statuses.count(502) + statuses.count(200))
+
+    def test_post_comment(self):
+        status, body, _, _ = self.fake.handle(
+                'POST', '/repos/danvk/dygraphs/pulls/1/comments', {},
+                json.dumps({'body': 'Nice', 'commit_id': self.pr.commit_shas[0],
+                            'path': self.pr.filenames[0], 'position': 2}))
+        self.assertEquals(201, status)
+        comment = json.loads(body)
+        self.assertEquals(comment, self.pr.review_comments[-1])
+        self.assertEquals(2, comment['original_position'])
+        self.assertEquals(comment['updated_at'],
+                          self.pr.pull_request['updated_at'])
+
+    def test_several_pull_requests(self):
+        for pr in fake_github.synthetic_pull_requests(3)[1:]:
+            self.fake.add_pull_request(pr)
+        status, body, _, _ = self._get('/users/fakelogin/subscriptions')
+        self.assertEquals(['danvk/dygraphs', 'danvk/repo1', 'danvk/repo2'],
+                          [r['full_name'] for r in json.loads(body)])
+        status, body, _, _ = self._get('/repos/danvk/repo2/pulls/1')
+        self.assertEquals('danvk/repo2',
+                          json.loads(body)['base']['repo']['full_name'])
+        self.assertEquals(404, self._get('/repos/danvk/repo2/pulls/2')[0])
+
+    def test_recording(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'recording.json')
+            with open(filename, 'w') as f:
+                json.dump({'/repos/danvk/dygraphs/pulls/1': {
+                    'body': {'number': 1, 'title': 'Recorded'}}}, f)
+            self.fake.load_recording(filename)
+        finally:
+            shutil.rmtree(tmp_dir)
+        _, body, _, _ = self._get('/repos/danvk/dygraphs/pulls/1')
+        self.assertEquals('Recorded', json.loads(body)['title'])
+
+
+if __name__ == '__main__':
+    unittest.main()
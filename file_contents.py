@@ -0,0 +1,54 @@
+'''Serves file contents from the github cache in chunks, with byte ranges.
+
+Large files are never read into memory all at once. Binary files, and text
+files too large to send whole, are described by their size instead; text
+files of any size can still be read a range at a time.
+'''
+
+import os
+
+# Files larger than this are only sent in ranges.
+# This can be set via CONTENTS_MAX_BYTES in the app config.
+MAX_BYTES = 1024**2
+
+# Bytes read from the cache file for each chunk of a response.
+CHUNK_BYTES = 64 * 1024
+
+# Like git, a file is binary if it has a NUL byte in its first few bytes.
+_BINARY_SNIFF_BYTES = 8000
+
+
+def size(f):
+    '''Returns the size of an open file, in bytes.'''
+    try:
+        return os.fstat(f.fileno()).st_size
+    except (AttributeError, IOError, OSError):
+        # e.g. a BytesIO
+        pos = f.tell()
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        f.seek(pos)
+        return end
+
+
+def is_binary(f):
+    '''Sniffs the start of an open file. Leaves it at the start.'''
+    f.seek(0)
+    head = f.read(_BINARY_SNIFF_BYTES)
+    f.seek(0)
+    return '\0' in head
+
+
+def iter_chunks(f, start, end):
+    '''Yields bytes [start, end) of an open file, then closes it.'''
+    try:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
@@ -0,0 +1,65 @@
+import file_contents
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+
+class FileContentsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _open(self, contents):
+        path = os.path.join(self.tmp_dir, 'f')
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return open(path, 'rb')
+
+    def test_size(self):
+        f = self._open('0123456789')
+        self.assertEquals(10, file_contents.size(f))
+        f.close()
+        f = io.BytesIO('01234')
+        f.seek(2)
+        self.assertEquals(5, file_contents.size(f))
+        self.assertEquals(2, f.tell())
+
+    def test_is_binary(self):
+        self.assertFalse(file_contents.is_binary(io.BytesIO('text\n' * 5000)))
+        f = io.BytesIO('GIF89a\0\0\x01')
+        self.assertTrue(file_contents.is_binary(f))
+        self.assertEquals(0, f.tell())
+        # Only the start of the file is sniffed.
+        self.assertFalse(file_contents.is_binary(
+                io.BytesIO('x' * 10000 + '\0')))
+
+    @patch('file_contents.CHUNK_BYTES', 4)
+    def test_iter_chunks(self):
+        f = self._open('0123456789')
+        self.assertEquals(['0123', '4567', '89'],
+                          list(file_contents.iter_chunks(f, 0, 10)))
+        self.assertTrue(f.closed)
+
+        f = self._open('0123456789')
+        self.assertEquals(['2345', '6'],
+                          list(file_contents.iter_chunks(f, 2, 7)))
+        # Past the end of the file, we stop early.
+        f = self._open('0123456789')
+        self.assertEquals(['89'], list(file_contents.iter_chunks(f, 8, 20)))
+
+    def test_iter_chunks_closes_when_abandoned(self):
+        f = self._open('0123456789')
+        chunks = file_contents.iter_chunks(f, 0, 10)
+        next(chunks)
+        chunks.close()
+        self.assertTrue(f.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,89 @@
 '''Application logic and muxing'''
 
 from collections import defaultdict
+import functools
 import json
 import logging
 import re
 import sys
 import json
+import threading
+import time
 import urllib
 
 from flask import url_for, session, request
+import requests
+
 import github
 import github_comments
+import github_graphql
+import metrics
+import parallel
+import ratelimit
+
+# Maximum time to spend fetching the data for a single pull request.
+# This can be set via PR_FETCH_DEADLINE_SECS in the app config.
+PR_FETCH_DEADLINE_SECS = 30
+
+# How to fetch pull requests: 'rest' or 'graphql' (see github_graphql.py).
+# This can be set via GITHUB_PR_BACKEND in the app config.
+PR_BACKEND = 'rest'
+
+# The PullRequest properties which are saved in snapshots (see
+# PullRequest.load). Bump SNAPSHOT_FORMAT whenever their contents change.
+SNAPSHOT_PROPERTIES = ('commits', 'files', 'comments', 'reverted_files')
+SNAPSHOT_FORMAT = 1
+
+# Number of times to try posting each draft comment before giving up, and the
+# delay before the first retry (this doubles on each subsequent retry).
+PUBLISH_ATTEMPTS = 3
+PUBLISH_RETRY_DELAY_SECS = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+def _lazy(fn):
+    '''A PullRequest property which is computed at most once, on demand.
+
+    It's safe to read from several threads; see PullRequest.load.
+    '''
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def get(self):
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._values:
+                self._values[name] = fn(self)
+        return self._values[name]
+    return property(get)
+
+
+def _thread_key(comment):
+    return (comment['path'], comment['original_commit_id'],
+            comment['original_position'])
+
+
+def _add_comment_counts(obj, comments):
+    obj.update({
+        'comments': comments,
+        'total_comment_count': len(comments),
+        'comment_count': len([c for c in comments if 'is_draft' not in c]),
+        'draft_comment_count': len([c for c in comments if 'is_draft' in c])
+    })
 
 
 class PullRequest(object):
+    '''A pull request, along with its commits, files and comments.
+
+    Each piece is only fetched from github when it's first used, so that
+    each view pays for just the data that its template shows. Use load() to
+    fetch several pieces concurrently.
+
+    The pieces are also saved as a snapshot, which is reused until the pull
+    request or the user's drafts on it change.
+    '''
     @staticmethod
     def from_github(db, token, login, owner, repo, number):
         pr = PullRequest()
@@ -23,18 +93,125 @@ class PullRequest(object):
         pr._owner = owner
         pr._repo = repo
         pr._number = number
-
-        pr._get_pr_info()
+        pr._backend = PR_BACKEND
+        pr._deadline = time.time() + PR_FETCH_DEADLINE_SECS
         return pr
 
     def __init__(self):
-        pass
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._values = {}
+        self._snapshot_key = None
+        self._snapshot_restored = False
+        self._snapshot_names = set()
 
     def _api(self, fn, *args):
         '''Helper to pass token, owner, and repo to github.py'''
         all_args = [self._token, self._owner, self._repo] + list(args)
         return fn(*all_args)
 
+    def load(self, *names):
+        '''Computes several properties at once, e.g. load('commits', 'files').
+
+        They come from the snapshot if possible; otherwise they're fetched
+        concurrently and saved to it. Call this before modifying them.
+        '''
+        with metrics.timed('pull_request'):
+            self._restore_snapshot()
+            parallel.run_concurrently(
+                    [functools.partial(getattr, self, name) for name in names],
+                    deadline=self._deadline)
+            self._save_snapshot()
+
+    def _get_snapshot_key(self, draft_version):
+        pr = self.pull_request
+        return 'snapshot:%d:%s/%s/%s:%s:%s:%s:%s.%s' % (
+                SNAPSHOT_FORMAT, self._owner, self._repo, self._number,
+                pr['head']['sha'], pr['updated_at'], self._login,
+                self._db.epoch, draft_version)
+
+    def version(self):
+        '''Changes whenever anything this user sees of the PR might.
+
+        That's its head sha, github's updated_at and the user's drafts. This
+        only needs the pull_request, so it's cheap to check before load().
+        '''
+        if self._snapshot_key is None:
+            self._snapshot_key = self._get_snapshot_key(
+                    self._db.get_draft_version(
+                        self._login, self._owner, self._repo, self._number))
+        return self._snapshot_key
+
+    def _restore_snapshot(self):
+        if self._snapshot_restored:
+            return
+        self._snapshot_restored = True
+        cached = github.cache.get(self.version())
+        if cached is None:
+            metrics.count('pr_snapshot_misses')
+            return
+        metrics.count('pr_snapshot_hits')
+        with metrics.timed('parse_json'):
+            snapshot = json.loads(cached)
+        with self._lock:
+            for name, value in snapshot.iteritems():
+                self._values.setdefault(name, value)
+        self._snapshot_names = set(snapshot)
+
+    def _save_snapshot(self):
+        snapshot = dict((name, self._values[name])
+                        for name in SNAPSHOT_PROPERTIES if name in self._values)
+        if set(snapshot) - self._snapshot_names:
+            github.cache.set(self._snapshot_key, json.dumps(snapshot),
+                             meta={'fetched_at': time.time()})
+            self._snapshot_names = set(snapshot)
+
+    def _patch_snapshot(self, old_version, new_version, saved, deleted_ids):
+        '''Applies a change to the user's drafts to their snapshot.'''
+        cached = github.cache.get(self._get_snapshot_key(old_version))
+        if cached is None:
+            return False
+        snapshot = json.loads(cached)
+        removed = set(deleted_ids)
+        if saved:
+            saved = self._db.githubify_comment(dict(saved))
+            removed.add(saved['id'])
+
+        def patch(comments, add):
+            comments = [c for c in comments if c['id'] not in removed]
+            if saved and add:
+                comments.append(dict(saved))
+            return comments
+
+        for commit in snapshot.get('commits', []):
+            _add_comment_counts(commit, patch(
+                    commit['comments'],
+                    saved and saved['original_commit_id'] == commit['sha']))
+        for f in snapshot.get('files', []):
+            _add_comment_counts(f, patch(
+                    f['comments'], saved and saved['path'] == f['filename']))
+        if 'comments' in snapshot:
+            diff_level = patch(snapshot['comments']['diff_level'], True)
+            # Rethread whatever threads the change was in.
+            threads = set(_thread_key(c) for c in snapshot['comments']['diff_level']
+                          if c['id'] in removed)
+            if saved:
+                threads.add(_thread_key(saved))
+                github_comments.add_line_numbers_to_comments(
+                        self._token, self._owner, self._repo,
+                        self._base_sha(), [diff_level[-1]])
+            for comment in diff_level:
+                if _thread_key(comment) in threads:
+                    comment.pop('in_reply_to', None)
+                    comment.pop('is_addressed', None)
+            github_comments.add_in_response_to(self.pull_request, diff_level)
+            snapshot['comments']['diff_level'] = diff_level
+
+        github.cache.set(self._get_snapshot_key(new_version),
+                         json.dumps(snapshot),
+                         meta={'fetched_at': time.time()})
+        return True
+
     def _get_outdated_commit_shas(self, commit_shas, comments):
         '''Outdated commit SHAs are known only from comments on them.'''
         known_shas = set(commit_shas)
@@ -46,107 +223,163 @@ class PullRequest(object):
 
         return list(outdated_shas)
 
-    def _attach_comments(self):
-        '''Adds 'comments' fields commit, file and file/commit pair.'''
-        sha_to_commit = {}
-        for commit in self.commits:
-          sha_to_commit[commit['sha']] = commit
-        sha_file_map = {}
-        for commit in self.commits:
-            commit['comments'] = []
-            for f in commit['files']:
-                f['comments'] = []
-                sha_file_map[(commit['sha'], f['filename'])] = f
-        path_to_file = {}
-        for f in self.files:
-            f['comments'] = []
-            path_to_file[f['filename']] = f
-
-        for comment in self.comments['diff_level']:
-            sha = comment['original_commit_id']
-            if sha in sha_to_commit:
-                sha_to_commit[sha]['comments'].append(comment)
-            pair = (sha, comment['path'])
-            if pair in sha_file_map:
-                sha_file_map[pair]['comments'].append(comment)
-            path_to_file[comment['path']]['comments'].append(comment)
-
-        def add_counts(obj):
-            cs = obj['comments']
-            obj.update({
-                'total_comment_count': len(cs),
-                'comment_count': len([c for c in cs if 'is_draft' not in c]),
-                'draft_comment_count': len([c for c in cs if 'is_draft' in c])
-            })
-
-        for commit in self.commits:
-            add_counts(commit)
-            for f in commit['files']:
-                add_counts(f)
-        for f in self.files:
-            add_counts(f)
-
-
-    def _get_pr_info(self):
-        '''Fill in basic information about a pull request.'''
-        pr = self._api(github.get_pull_request, self._number)
-
-        # get a list of files which have been affected by this PR, base to
-        # head.
-        sha1 = pr['base']['sha']
-        sha2 = pr['head']['sha']
-        diff_info = self._api(github.get_diff_info, sha1, sha2)
-        files = diff_info['files']
-
-        # get a list of commits in the pull request. The API does not return
-        # "outdated" commits or the base commit. We add these using auxiliary
-        # data.
-        commit_shas = [c['sha'] for c in self._api(github.get_pull_request_commits, self._number)]
-        comments = self._api(github.get_pull_request_comments, self._number)
+    def _get_rest_pr_info(self):
+        '''Fetches the PR, its commits and its comments via REST.'''
+        # None of these depend on one another, so fetch them all at once.
+        pr, pr_commits, comments = parallel.run_concurrently([
+            functools.partial(self._api, github.get_pull_request, self._number),
+            functools.partial(self._api, github.get_pull_request_commits, self._number),
+            functools.partial(self._api, github.get_pull_request_comments, self._number)
+        ], deadline=self._deadline)
+        return {
+            'pull_request': pr,
+            'commit_shas': [c['sha'] for c in pr_commits],
+            'commits': pr_commits,
+            'comments': comments,
+            'files': None
+        }
+
+    @_lazy
+    def _basics(self):
+        '''What every view needs: the PR, its commit shas and its comments.
+
+        Depending on the backend, this may have the commits and files, too.
+        Draft comments are merged in with the published ones.
+        '''
+        snapshot = None
+        if self._backend == 'graphql':
+            snapshot = self._api(github_graphql.get_pull_request, self._number)
+        if snapshot:
+            basics = dict(snapshot)
+            # Snapshots cached by older versions don't have the commits.
+            basics.setdefault('commits', None)
+        else:
+            basics = self._get_rest_pr_info()
 
+        draft_comments = self._db.get_draft_comments(
+                self._login, self._owner, self._repo, self._number)
+        for comment in draft_comments:
+            basics['comments']['diff_level'].append(
+                    self._db.githubify_comment(comment))
+        return basics
+
+    @_lazy
+    def pull_request(self):
+        if self._backend == 'graphql':
+            return self._basics['pull_request']
+        # Everything else may come from the snapshot, which is keyed by this.
+        return self._api(github.get_pull_request, self._number)
+
+    def _base_sha(self):
+        return self.pull_request['base']['sha']
+
+    def _annotate_comments(self, diff_comments):
+        '''Adds line numbers and threading to some diff comments.'''
+        github_comments.add_line_numbers_to_comments(
+                self._token, self._owner, self._repo, self._base_sha(),
+                diff_comments)
+        github_comments.add_in_response_to(self.pull_request, diff_comments)
+
+    @_lazy
+    def comments(self):
+        '''All the comments, with diff comments placed on their diffs.'''
+        comments = self._basics['comments']
+        diff_level = list(comments['diff_level'])
+        self._annotate_comments(diff_level)
+        return {'top_level': comments['top_level'], 'diff_level': diff_level}
+
+    def comments_for_path(self, path):
+        '''Like comments, but only the diff comments on one file.
+
+        This only needs the diffs for that file.
+        '''
+        if 'comments' in self._values:
+            comments = self.comments
+            diff_level = [c for c in comments['diff_level'] if c['path'] == path]
+        else:
+            comments = self._basics['comments']
+            diff_level = [c for c in comments['diff_level'] if c['path'] == path]
+            self._annotate_comments(diff_level)
+        return {'top_level': comments['top_level'], 'diff_level': diff_level}
+
+    def _comments_by(self, key):
+        by_key = defaultdict(list)
+        for comment in self._basics['comments']['diff_level']:
+            by_key[comment[key]].append(comment)
+        return by_key
+
+    @_lazy
+    def commits(self):
+        '''The PR's commits, newest first, then its base commit.
+
+        Each has a short_message and comment counts.
+        '''
+        basics = self._basics
+        base_sha = self._base_sha()
+        if basics['commits'] is not None:
+            # The commit list has everything we show, except the base commit.
+            commits = list(basics['commits']) + [
+                    self._api(github.get_commit_info, base_sha)]
+        else:
+            commits = self._thick_commits
+
+        # The commit list API does not return "outdated" commits or the base
+        # commit. We add these using auxiliary data.
         # NOTE: need to do some more thinking about outdated commits.
         # Since the PR's base sha sha may have changed since the commit, it
         # could be hard to show a meaningful diff.
         # outdated_commit_shas = self._get_outdated_commit_shas(commit_shas, comments)
-        # commit_shas.extend(outdated_commit_shas)
-        commit_shas.append(pr['base']['sha'])
-
-        # Get "thick" commit data.
-        # This includes a list of modified files, whereas
-        # get_pull_request_commits does not. This gives us information about
-        # reverted files.
-        commits = []
-        for sha in commit_shas:
-            commits.append(self._api(github.get_commit_info, sha))
+        commits = [dict(c) for c in commits]
         commits.sort(key=lambda c: c['commit']['committer']['date'])
         commits.reverse()
 
-        # Merge draft and published comments.
-        draft_comments = self._db.get_draft_comments(
-                self._login, self._owner, self._repo, self._number)
-        for comment in draft_comments:
-            comments['diff_level'].append(self._db.githubify_comment(comment))
-
-        github_comments.add_line_numbers_to_comments(
-                self._token, self._owner, self._repo,
-                pr['base']['sha'], comments['diff_level'])
-        github_comments.add_in_response_to(pr, comments['diff_level'])
+        comments_by_sha = self._comments_by('original_commit_id')
+        for commit in commits:
+            commit['short_message'] = re.sub(
+                    r'[\n\r].*', '', commit['commit']['message'])
+            _add_comment_counts(commit, comments_by_sha[commit['sha']])
 
-        self.pull_request = pr
-        self.commits = commits
-        self.comments = comments
-        self.files = files
-
-        self._attach_comments()
-        self.reverted_files = self._find_reverted_files()
-        self._augment_commits()
-        self._augment_files()
-
-    def _find_reverted_files(self):
+        # move the base commit to the bottom.
+        # Even if that's not where it belongs chronologically, it is where
+        # it belongs logically.
+        base_commits = [c for c in commits if c['sha'] == base_sha]
+        if base_commits:
+            base_commits[0]['short_message'] = '(base)'
+            commits.remove(base_commits[0])
+            commits.append(base_commits[0])
+        return commits
+
+    @_lazy
+    def _thick_commits(self):
+        '''Full commit info, including the files changed, for every commit.'''
+        commit_shas = self._basics['commit_shas'] + [self._base_sha()]
+        return parallel.run_concurrently(
+                [functools.partial(self._api, github.get_commit_info, sha)
+                 for sha in commit_shas], deadline=self._deadline)
+
+    @_lazy
+    def files(self):
+        '''The files changed from base to head, with comment counts.'''
+        files = self._basics['files']
+        if files is None:
+            files = self._api(github.get_diff_info, self._base_sha(),
+                              self.pull_request['head']['sha'])['files']
+        files = [dict(f) for f in files]
+        comments_by_path = self._comments_by('path')
+        for f in files:
+            _add_comment_counts(f, comments_by_path[f['filename']])
+        return files
+
+    @_lazy
+    def reverted_files(self):
         '''Look for files appearing only in intermediate commits.'''
         files = set([f['filename'] for f in self.files])
+        # The base may not be the oldest commit, e.g. after a rebase.
+        base_sha = self._base_sha()
         reverted_files = set()
-        for commit in self.commits[:-1]:
+        for commit in self._thick_commits:
+            if commit['sha'] == base_sha:
+                continue
             if len(commit['parents']) >= 2:
                 # ignore merge commits.
                 # See http://stackoverflow.com/questions/6713652/git-diff-unique-to-merge-commit
@@ -157,29 +390,6 @@ class PullRequest(object):
                     reverted_files.add(path)
         return list(reverted_files)
 
-    def _augment_commits(self):
-        base_index = -1
-        for idx, commit in enumerate(self.commits):
-            commit.update({
-                'short_message':
-                    re.sub(r'[\n\r].*', '', commit['commit']['message']),
-            })
-            if commit['sha'] == self.pull_request['base']['sha']:
-                commit['short_message'] = '(base)'
-                base_index = idx
-
-        # move the base commit to the bottom.
-        # Even if that's not where it belongs chronologically, it is where
-        # it belongs logically.
-        if base_index >= 0:
-            base_commit = self.commits[base_index]
-            del self.commits[base_index]
-            self.commits.append(base_commit)
-
-
-    def _augment_files(self):
-        pass
-
     def add_file_diff_links(self, sha1, sha2):
         for f in self.files:
             f.update({
@@ -187,6 +397,21 @@ class PullRequest(object):
             })
 
 
+def update_snapshot_drafts(db, token, login, owner, repo, number, old_version,
+                           saved=None, deleted_ids=()):
+    '''Updates a user's snapshot of a PR after saving or deleting drafts.
+
+    old_version is their draft version from before the change. If the drafts
+    have changed more than once since then, nothing is updated and the next
+    view rebuilds the snapshot. Returns whether the snapshot was updated.
+    '''
+    new_version = db.get_draft_version(login, owner, repo, number)
+    if new_version != old_version + 1:
+        return False
+    pr = PullRequest.from_github(db, token, login, owner, repo, number)
+    return pr._patch_snapshot(old_version, new_version, saved, deleted_ids)
+
+
 def _add_urls_to_pull_requests(prs):
     for pr in prs:
         repo = pr['base']['repo']
@@ -207,11 +432,7 @@ def handle_get_pull_requests(owner, repo):
     }
 
 
-def count_open_pull_requests(owner, repo):
-    token = session['token']
-    login = session['login']
-    pull_requests = github.get_pull_requests(token, owner, repo,
-                                             bust_cache=True)
+def _summarize_open_pull_requests(login, pull_requests):
     _add_urls_to_pull_requests(pull_requests)
 
     own_prs = filter(lambda pr: pr['user']['login'] == login, pull_requests)
@@ -219,3 +440,94 @@ def count_open_pull_requests(owner, repo):
             'count': len(pull_requests),
             'own': own_prs
     }
+
+
+def count_open_pull_requests(owner, repo):
+    token = session['token']
+    login = session['login']
+    pull_requests = github.get_pull_requests(token, owner, repo,
+                                             bust_cache=True)
+    return _summarize_open_pull_requests(login, pull_requests)
+
+
+def _get_open_pull_requests(token, owner, repo):
+    try:
+        return github.get_pull_requests(token, owner, repo, bust_cache=True)
+    except (requests.exceptions.RequestException, github.IncompleteList) as e:
+        logger.warn('Unable to list pull requests for %s/%s: %s', owner, repo, e)
+        return None
+
+
+def iter_open_pull_request_counts(repos):
+    '''Like count_open_pull_requests, but for many (owner, repo) pairs.
+
+    The repos are fetched concurrently and results are yielded as they
+    arrive, each tagged with its owner and repo. Repos which couldn't be
+    fetched get an 'error' instead of a 'count'.
+    '''
+    token = session['token']
+    login = session['login']
+    fetches = parallel.iter_concurrently([
+        functools.partial(_get_open_pull_requests, token, owner, repo)
+        for owner, repo in repos])
+    for idx, pull_requests in fetches:
+        owner, repo = repos[idx]
+        if pull_requests is None:
+            result = {'error': 'Unable to list pull requests'}
+        else:
+            result = _summarize_open_pull_requests(login, pull_requests)
+        result.update({'owner': owner, 'repo': repo})
+        yield result
+
+
+def _publish_draft_comment(db, token, owner, repo, pull_number, comment):
+    '''Posts a single draft to github, retrying on failure.'''
+    result = {
+        'id': comment['id'],
+        'path': comment['path'],
+        'published': False,
+        'attempts': 0,
+        'error': None
+    }
+    for attempt in xrange(PUBLISH_ATTEMPTS):
+        if attempt:
+            time.sleep(PUBLISH_RETRY_DELAY_SECS * 2 ** (attempt - 1))
+        result['attempts'] += 1
+        try:
+            posted = github.post_comment(token, owner, repo, pull_number,
+                                         comment)
+        except github.PostError as e:
+            # Don't risk posting a comment twice, or repeat a rejected one.
+            result['error'] = str(e)
+            if e.retryable:
+                continue
+            break
+        except ratelimit.RateLimited as e:
+            # This draft stays a draft; others may have been published.
+            result['error'] = str(e)
+            break
+        if posted:
+            # Delete each draft as soon as it's on github, so that a failure
+            # elsewhere in the batch can't lead to it being posted twice.
+            db.delete_draft_comments([comment['id']])
+            result.update({'published': True, 'error': None})
+            return result
+        result['error'] = 'The comment is incomplete'
+        break
+
+    logger.warn('Unable to publish comment after %d attempts: %s',
+                result['attempts'], json.dumps(comment))
+    return result
+
+
+def publish_draft_comments(db, token, owner, repo, pull_number, draft_comments):
+    '''Posts draft comments to github in parallel.
+
+    Returns one result per draft, in the same order as draft_comments. Each has
+    'id', 'path', 'published', 'attempts' and 'error' fields. Drafts which
+    could not be published are left in the DB.
+    '''
+    return parallel.run_concurrently([
+        functools.partial(_publish_draft_comment,
+                          db, token, owner, repo, pull_number, comment)
+        for comment in draft_comments])
@@ -0,0 +1,290 @@
+import caching
+import fake_github
+import comment_db
+import gitcritic
+import github
+import github_comments
+import metrics
+import os
+import ratelimit
+import shutil
+import tempfile
+import unittest
+from mock import patch, MagicMock
+
+
+def _draft(comment_id):
+    return {'id': comment_id, 'path': 'file.py', 'body': 'body',
+            'original_commit_id': 'abc', 'original_position': 1}
+
+
+class PublishDraftCommentsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.delay_patch = patch('gitcritic.PUBLISH_RETRY_DELAY_SECS', 0)
+        self.delay_patch.start()
+
+    def tearDown(self):
+        self.delay_patch.stop()
+
+    def test_partial_failure(self):
+        def post_comment(token, owner, repo, pull_number, comment):
+            if comment['id'] != 1:
+                raise github.PostError('github rejected the comment (502)',
+                                       True)
+            return {'id': 100}
+
+        db = MagicMock()
+        with patch('github.post_comment', MagicMock(side_effect=post_comment)):
+            results = gitcritic.publish_draft_comments(
+                    db, 'token', 'owner', 'repo', 1, [_draft(1), _draft(2)])
+
+        self.assertEquals([1, 2], [r['id'] for r in results])
+        self.assertTrue(results[0]['published'])
+        self.assertEquals(1, results[0]['attempts'])
+        self.assertFalse(results[1]['published'])
+        self.assertEquals(gitcritic.PUBLISH_ATTEMPTS, results[1]['attempts'])
+        self.assertTrue(results[1]['error'])
+        db.delete_draft_comments.assert_called_once_with([1])
+
+    def test_retry(self):
+        post_comment = MagicMock(side_effect=[
+                github.PostError('Unable to reach github', True), {'id': 100}])
+        db = MagicMock()
+        with patch('github.post_comment', post_comment):
+            results = gitcritic.publish_draft_comments(
+                    db, 'token', 'owner', 'repo', 1, [_draft(1)])
+
+        self.assertTrue(results[0]['published'])
+        self.assertEquals(2, results[0]['attempts'])
+        db.delete_draft_comments.assert_called_once_with([1])
+
+    def test_no_retry_if_it_might_duplicate(self):
+        # e.g. a 422, or a connection reset after the comment was sent.
+        post_comment = MagicMock(side_effect=github.PostError(
+                'github rejected the comment (422)', False))
+        db = MagicMock()
+        with patch('github.post_comment', post_comment):
+            results = gitcritic.publish_draft_comments(
+                    db, 'token', 'owner', 'repo', 1, [_draft(1)])
+
+        self.assertFalse(results[0]['published'])
+        self.assertEquals(1, results[0]['attempts'])
+        self.assertIn('422', results[0]['error'])
+        self.assertFalse(db.delete_draft_comments.called)
+
+    def test_rate_limited(self):
+        def post_comment(token, owner, repo, pull_number, comment):
+            if comment['id'] == 2:
+                raise ratelimit.RateLimited('github rate limit exceeded', 0)
+            return {'id': 100}
+
+        db = MagicMock()
+        with patch('github.post_comment', MagicMock(side_effect=post_comment)):
+            results = gitcritic.publish_draft_comments(
+                    db, 'token', 'owner', 'repo', 1, [_draft(1), _draft(2)])
+
+        self.assertEquals([True, False], [r['published'] for r in results])
+        self.assertIn('rate limit', results[1]['error'])
+        db.delete_draft_comments.assert_called_once_with([1])
+
+
+def _pull_request(login, number):
+    return {'number': number, 'user': {'login': login},
+            'base': {'repo': {'name': 'repo', 'owner': {'login': 'owner'}}}}
+
+
+class OpenPullRequestCountsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.session_patch = patch('gitcritic.session',
+                                   {'token': 'token', 'login': 'me'})
+        self.session_patch.start()
+        self.url_for_patch = patch('gitcritic.url_for',
+                                   lambda *args, **kwargs: '/pull')
+        self.url_for_patch.start()
+
+    def tearDown(self):
+        self.url_for_patch.stop()
+        self.session_patch.stop()
+
+    def test_counts(self):
+        def get_pull_requests(token, owner, repo, bust_cache):
+            if repo == 'broken':
+                return None
+            return [_pull_request('me', 1), _pull_request('you', 2)]
+
+        with patch('github.get_pull_requests',
+                   MagicMock(side_effect=get_pull_requests)):
+            results = list(gitcritic.iter_open_pull_request_counts(
+                    [('danvk', 'dygraphs'), ('danvk', 'broken')]))
+
+        results.sort(key=lambda r: r['repo'])
+        self.assertEquals('broken', results[0]['repo'])
+        self.assertIn('error', results[0])
+        self.assertEquals('dygraphs', results[1]['repo'])
+        self.assertEquals(2, results[1]['count'])
+        self.assertEquals([1], [pr['number'] for pr in results[1]['own']])
+
+
+class LazyPullRequestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fake_pr = fake_github.FakePullRequest(num_commits=4, num_files=6,
+                                                   num_comments=12)
+        self.fake = fake_github.FakeGitHub(self.fake_pr)
+        self.patches = [
+            patch('github.GITHUB_API_ROOT', self.fake.root),
+            patch('github.cache', caching.TieredCache(self.tmp_dir)),
+            patch('github.client', fake_github.FakeClient(self.fake)),
+            patch('gitcritic.PR_BACKEND', 'rest')
+        ]
+        for p in self.patches:
+            p.start()
+        github_comments._parsed_diffs.clear()
+        self.db = comment_db.CommentDb(os.path.join(self.tmp_dir, 'drafts.sqlite'))
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        github_comments._parsed_diffs.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def _from_github(self):
+        return gitcritic.PullRequest.from_github(
+                self.db, 'token', 'login', 'danvk', 'dygraphs', 1)
+
+    def test_nothing_fetched_until_used(self):
+        pr = self._from_github()
+        self.assertEquals([], self.fake.requests)
+        self.assertEquals(1, pr.pull_request['number'])
+        self.assertTrue(self.fake.requests)
+
+    def _traced(self, fn):
+        '''Calls fn, returning its result and the counts from its Trace.'''
+        metrics.start_trace()
+        try:
+            result = fn()
+        finally:
+            trace, _ = metrics.finish_trace('test')
+        return result, trace.counts
+
+    def _cold(self, fn):
+        '''Calls fn with empty caches, returning (result, github requests).'''
+        github.cache = caching.TieredCache(tempfile.mkdtemp(dir=self.tmp_dir))
+        github_comments._parsed_diffs.clear()
+        result, counts = self._traced(fn)
+        return result, counts.get('github_requests', 0)
+
+    def _pull(self):
+        pr = self._from_github()
+        pr.load('commits', 'files', 'comments')
+        return pr
+
+    def test_file_diff_needs_less(self):
+        path = self.fake_pr.filenames[0]
+
+        def file_diff():
+            pr = self._from_github()
+            pr.load('commits', 'files')
+            return pr.comments_for_path(path)
+
+        file_comments, file_diff_requests = self._cold(file_diff)
+        comments, pull_requests = self._cold(lambda: self._pull().comments)
+        self.assertLess(file_diff_requests, pull_requests)
+        # ... but that file's comments are the same.
+        self.assertEquals(
+                [c for c in comments['diff_level'] if c['path'] == path],
+                file_comments['diff_level'])
+        self.assertTrue(file_comments['diff_level'])
+        self.assertEquals(comments['top_level'], file_comments['top_level'])
+
+    def test_snapshot(self):
+        pr, counts = self._traced(self._pull)
+        self.assertEquals(1, counts['pr_snapshot_misses'])
+
+        github_comments._parsed_diffs.clear()
+        del self.fake.requests[:]
+        snapshot_pr, counts = self._traced(self._pull)
+        self.assertEquals(1, counts['pr_snapshot_hits'])
+        self.assertEquals([], self.fake.requests)
+        self.assertNotIn('parse_diff', counts)
+        for name in ('commits', 'files', 'comments'):
+            self.assertEquals(getattr(pr, name), getattr(snapshot_pr, name))
+
+        # A new draft means a new snapshot.
+        self.db.add_draft_comment('login', self._draft(0))
+        _, counts = self._traced(self._pull)
+        self.assertEquals(1, counts['pr_snapshot_misses'])
+
+    def test_version(self):
+        version = self._from_github().version()
+        # Only the pull request itself is needed.
+        self.assertEquals(1, len(self.fake.requests))
+        self.assertEquals(version, self._pull().version())
+
+        self.db.add_draft_comment('login', self._draft(0))
+        self.assertNotEquals(version, self._from_github().version())
+
+    def test_reverted_files(self):
+        # The base commit is the newest one here, as after a rebase.
+        first, base = self.fake_pr.commit_shas[0], self.fake_pr.base_sha
+        self.fake_pr.commits[first]['files'] = self.fake_pr._files(
+                ['src/reverted.py'])
+        self.fake_pr.commits[base]['files'] = self.fake_pr._files(
+                ['src/unrelated.py'])
+        self.assertEquals(['src/reverted.py'], self._pull().reverted_files)
+
+    def _draft(self, i):
+        comment = self.fake_pr.review_comments[i]
+        return {
+            'owner': 'danvk', 'repo': 'dygraphs', 'pull_number': 1,
+            'path': comment['path'],
+            'original_commit_id': comment['original_commit_id'],
+            'original_position': comment['original_position'],
+            'diff_hunk': comment['diff_hunk'],
+            'body': 'Draft reply %d' % i
+        }
+
+    def _assert_same_as_rebuilt(self):
+        _, counts = self._traced(self._pull)
+        self.assertEquals(1, counts.get('pr_snapshot_hits'))
+        patched = self._pull()
+        self.db.epoch += 1  # i.e. a different snapshot
+        rebuilt = self._pull()
+        self.assertEquals(rebuilt.comments, patched.comments)
+        def counts(objs):
+            return [(o['comment_count'], o['draft_comment_count'],
+                     sorted(c['id'] for c in o['comments'])) for o in objs]
+        self.assertEquals(counts(rebuilt.commits), counts(patched.commits))
+        self.assertEquals(counts(rebuilt.files), counts(patched.files))
+        self.db.epoch -= 1
+
+    def test_drafts_patch_snapshot(self):
+        def update(version, **kwargs):
+            return gitcritic.update_snapshot_drafts(
+                    self.db, 'token', 'login', 'danvk', 'dygraphs', 1,
+                    version, **kwargs)
+        draft = self.db.add_draft_comment('login', self._draft(1))
+        self._pull()
+
+        version = self.db.get_draft_version('login', 'danvk', 'dygraphs', 1)
+        saved = self.db.add_draft_comment('login', self._draft(4))
+        self.assertTrue(update(version, saved=saved))
+        self._assert_same_as_rebuilt()
+
+        version = self.db.get_draft_version('login', 'danvk', 'dygraphs', 1)
+        self.db.delete_draft_comments([draft['id']])
+        self.assertTrue(update(version, deleted_ids=[draft['id']]))
+        self._assert_same_as_rebuilt()
+
+        # Two changes at once can't be patched.
+        version = self.db.get_draft_version('login', 'danvk', 'dygraphs', 1)
+        saved = self.db.add_draft_comment('login', self._draft(2))
+        self.db.add_draft_comment('login', self._draft(3))
+        self.assertFalse(update(version, saved=saved))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,149 +1,499 @@
 '''Wrapper for the github API.
 
-This maintains an on-disk cache of API calls and maps github API calls onto
-Python functions.
+This maintains a cache of API calls (see caching.py) and maps github API calls
+onto Python functions.
 '''
 
+import errno
 import sys
 import logging
 import json
 import re
 
+import contextlib
+import functools
 import os
-import hashlib
-import cPickle
+import socket
+import threading
+import time
 
 import requests
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+
+import caching
+import metrics
+import parallel
+import ratelimit
 
 GITHUB_API_ROOT = 'https://api.github.com'
 
 WHITESPACE_RE = re.compile(r'^[ \t\n\r]*$')
+DIFF_START_RE = re.compile(r'^diff --git a/(.*?) b/(.*?)$', re.MULTILINE)
 
-logger = logging.getLogger(__name__)
-
-
-# TODO(danvk): inject a cache from the server module
-#from werkzeug.contrib.cache import SimpleCache
-#cache = SimpleCache()
-class SimpleCache(object):
-    def __init__(self):
-        self._cache_dir = '/tmp/better-git-pr/cache'
-        if not os.path.exists(self._cache_dir):
-            os.makedirs(self._cache_dir)
-
-    def _file_for_key(self, k):
-        return os.path.join(self._cache_dir, hashlib.md5(k).hexdigest())
+DIFF_HEADERS = {'Accept': 'application/vnd.github.3.diff'}
 
-    def get(self, k):
-        f = self._file_for_key(k)
-        if os.path.exists(f):
-            try:
-                return open(f).read().decode('utf-8')
-            except:
-                return None
-
-    def set(self, k, v):
-        f = self._file_for_key(k)
-        open(f, 'wb').write(v.encode('utf-8'))
-
-    def delete_multi(self, ks):
-        for k in ks:
-            f = self._file_for_key(k)
-            if os.path.exists(f):
-                os.unlink(f)
+# e.g. <https://api.github.com/user/repos?page=3&per_page=100>; rel="next"
+LINK_RE = re.compile(r'<([^>]+)>;\s*rel="([^"]+)"')
+PAGE_RE = re.compile(r'[?&]page=([0-9]+)')
 
+# Items per page for list endpoints, and a cap on the pages fetched.
+PER_PAGE = 100
+MAX_PAGES = 50
 
-cache = SimpleCache()
+logger = logging.getLogger(__name__)
 
 
-def _fetch_url(token, url, extra_headers=None, bust_cache=False):
-    key = url + json.dumps(extra_headers)
-    cached = cache.get(key)
-    if cached is not None and not bust_cache:
-        return cached
-    logger.info('Uncached request for %s', url)
+# Cache policies for the various endpoints.
+# Anything addressed by a commit sha can never change.
+IMMUTABLE = caching.Immutable()
+# Data which changes as a pull request is updated. This is served from cache
+# for a while, then revalidated with github (which is cheap, see _fetch_url).
+# check_for_updates marks it stale as soon as it notices a change.
+# The TTL can be set via PULL_REQUEST_CACHE_TTL_SECS in the app config.
+MUTABLE = caching.Revalidate(ttl=300)
+# Data which should be revalidated on every use.
+ALWAYS_REVALIDATE = caching.Revalidate(ttl=0)
+NEVER_CACHE = caching.NeverCache()
+
+# This is replaced using the GITHUB_CACHE_* settings in the app config.
+cache = caching.TieredCache()
+
+# Tracks each token's API budget. This is replaced using the RATE_LIMIT_*
+# settings in the app config.
+ratelimiter = ratelimit.RateLimiter()
+
+# Collapses concurrent requests for the same URL. Set GITHUB_LOCK_DIR in the
+# app config to collapse them across processes, too.
+inflight = caching.SingleFlight()
+
+
+# Socket errors which mean a connection was never made, so nothing was sent.
+_NOT_CONNECTED_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                         errno.ENETUNREACH)
+
+
+class PostError(Exception):
+    '''Raised when github doesn't accept something posted to it.
+
+    retryable is True if posting it again can't create a duplicate: github
+    had a server error, or the request never reached it.
+    '''
+    def __init__(self, message, retryable):
+        Exception.__init__(self, message)
+        self.retryable = retryable
+
+
+class IncompleteList(Exception):
+    '''Raised when only some pages of a paginated list could be fetched.'''
+
+
+def _never_sent(error):
+    '''Did a requests ConnectionError happen before anything was sent?'''
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason)  # unwrap a MaxRetryError
+    if isinstance(reason, (socket.gaierror, ConnectTimeoutError)):
+        return True
+    return (isinstance(reason, socket.error) and
+            reason.errno in _NOT_CONNECTED_ERRNOS)
+
+
+class GitHubClient(object):
+    """Issues HTTP requests to the github API over pooled connections.
+
+    Connections are kept alive between requests, which saves a TCP + TLS
+    handshake on every API call. The client is safe to share between threads.
+    Sockets can't be shared across a fork, so each WSGI worker process lazily
+    creates its own session.
+
+    However many threads use it (parallel.run_concurrently calls can nest, and
+    pages are served concurrently), at most pool_size requests are in flight
+    per process; the rest wait for a connection rather than opening one that
+    the pool would then discard.
+    """
+    def __init__(self, pool_size=10):
+        self._pool_size = pool_size
+        self._lock = threading.Lock()
+        self._session = None
+        self._adapter = None
+        self._slots = None
+        self._pid = None
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self._pool_size)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+                self._adapter = adapter
+                self._slots = threading.BoundedSemaphore(self._pool_size)
+                self._pid = os.getpid()
+            return self._session, self._slots
+
+    def get(self, url, headers=None):
+        session, slots = self._get_session()
+        with slots:
+            return session.get(url, headers=headers)
+
+    @contextlib.contextmanager
+    def stream(self, url, headers=None):
+        """Like get, but the body is left to be read via iter_content.
+
+        The connection is held until the with block exits.
+        """
+        session, slots = self._get_session()
+        with slots:
+            r = session.get(url, headers=headers, stream=True)
+            try:
+                yield r
+            finally:
+                r.close()
+
+    def close(self):
+        """Closes any pooled connections."""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._adapter = None
+
+    def post(self, url, headers=None, data=None):
+        session, slots = self._get_session()
+        with slots:
+            return session.post(url, headers=headers, data=data)
+
+    def stats(self):
+        """Returns connection pool counters for this process.
+
+        'requests' is the number of HTTP requests issued, 'connections' the
+        number of connections opened to serve them and 'reused' the number
+        which were served over an already-open connection.
+        """
+        num_requests = 0
+        num_connections = 0
+        with self._lock:
+            if self._adapter is not None and self._pid == os.getpid():
+                pools = self._adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+        reused = max(0, num_requests - num_connections)
+        return {
+            'requests': num_requests,
+            'connections': num_connections,
+            'reused': reused,
+            'hit_rate': float(reused) / num_requests if num_requests else 0.0
+        }
+
+
+# This can be resized via GITHUB_POOL_SIZE in the app config.
+client = GitHubClient()
+
+
+def _response_meta(response):
+    """Extracts the headers needed to revalidate or paginate a response."""
+    meta = {}
+    if response.headers.get('ETag'):
+        meta['etag'] = response.headers['ETag']
+    if response.headers.get('Last-Modified'):
+        meta['last_modified'] = response.headers['Last-Modified']
+    if response.headers.get('Link'):
+        meta['link'] = response.headers['Link']
+    return meta
+
+
+def _cache_key(url, extra_headers=None):
+    return url + json.dumps(extra_headers)
+
+
+def _fetch_url(token, url, extra_headers=None, bust_cache=False,
+               policy=IMMUTABLE):
+    """Fetches a URL from github, going through the cache.
+
+    policy determines whether a cached response can be used as-is. If
+    bust_cache is set, cached responses are always revalidated.
+    """
+    return _fetch_entry(token, url, extra_headers, bust_cache, policy)[0]
+
+
+def _fetch_entry(token, url, extra_headers=None, bust_cache=False,
+                 policy=IMMUTABLE):
+    """Like _fetch_url, but returns a (response, metadata) tuple.
+
+    The metadata includes pagination links, see _response_meta.
+    """
+    key = _cache_key(url, extra_headers)
+    if policy.store:
+        cached, meta = cache.get_entry(key)
+        if (cached is not None and not bust_cache and
+                policy.is_fresh(meta, time.time())):
+            metrics.count('github_cache_hits')
+            return cached, meta
+        flight_key = key
+    else:
+        # Uncached responses may differ from user to user.
+        flight_key = key + (token or '')
+
+    metrics.count('github_cache_misses')
+    # Concurrent misses for the same URL share a single request.
+    asked_at = time.time()
+    fetch = lambda: _fetch_upstream(token, url, key, extra_headers, policy,
+                                    asked_at)
+    try:
+        response, meta = inflight.do(flight_key, fetch)
+    except ratelimit.RateLimited:
+        if ratelimit.current_priority() == ratelimit.BACKGROUND:
+            raise
+        # The shared request may have been shed as background work.
+        response, meta = inflight.do(flight_key, fetch)
+    return response, dict(meta)
+
+
+def _fetch_upstream(token, url, key, extra_headers, policy, asked_at):
+    if policy.store:
+        # Another process may have fetched this while we waited on it.
+        # get_entry checks the disk tier, so this sees what it wrote.
+        cached, meta = cache.get_entry(key)
+        if (cached is not None and not meta.get('stale') and
+                meta.get('fetched_at', 0) >= asked_at):
+            return cached, meta
+    else:
+        cached, meta = None, {}
 
     headers = {}
     if token:
         headers.update({'Authorization': 'token ' + token})
     if extra_headers:
         headers.update(extra_headers)
-    r = requests.get(url, headers=headers)
+    # If we have a copy of the response, ask github to only send it again if
+    # it's changed. 304 responses don't count against the rate limit.
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    if 'If-None-Match' in headers or 'If-Modified-Since' in headers:
+        logger.info('Revalidating cached response for %s', url)
+    else:
+        logger.info('Uncached request for %s', url)
+
+    for attempt in xrange(2):
+        try:
+            ratelimiter.acquire(token)
+        except ratelimit.RateLimited:
+            if cached is None:
+                raise
+            logger.warn('Rate limited; serving a stale copy of %s', url)
+            return cached, meta
+        with metrics.timed('github'):
+            r = client.get(url, headers=headers)
+        metrics.count('github_requests')
+        metrics.count('github_bytes_fetched', len(r.content))
+        if ratelimiter.record(token, r):
+            break
+        # Otherwise acquire() waits out the backoff, or gives up.
+
+    if r.status_code == 304 and cached is not None:
+        metrics.count('github_not_modified')
+        meta.pop('stale', None)
+        meta['fetched_at'] = time.time()
+        cache.set_meta(key, meta)
+        return cached, meta
     if not r.ok:
         logger.warn('Request for %s failed: %s', url, r.text)
-        return False
+        return False, {}
 
     response = r.text
-    cache.set(key, response)
-    return response
+    meta = _response_meta(r)
+    meta['fetched_at'] = time.time()
+    if policy.store:
+        cache.set(key, response, meta=meta)
+    return response, meta
 
 
-def _post_api(token, path, obj, **kwargs):
+def _post(token, path, obj, **kwargs):
+    '''Posts obj to github, returning its JSON response or raising PostError.
+
+    Posts aren't idempotent, so this doesn't retry; see PostError.retryable.
+    '''
     url = (GITHUB_API_ROOT + path) % kwargs
     assert '%' not in url
     logger.info('Posting to %s', url)
-    r = requests.post(url, headers={'Authorization': 'token ' + token, 'Content-type': 'application/json'}, data=json.dumps(obj))
+    ratelimiter.acquire(token)
+    try:
+        with metrics.timed('github'):
+            r = client.post(url, headers={'Authorization': 'token ' + token, 'Content-type': 'application/json'}, data=json.dumps(obj))
+    except requests.exceptions.ConnectionError as e:
+        logger.warn('Posting to %s failed: %s', url, e)
+        raise PostError('Unable to reach github: %s' % e, _never_sent(e))
+    metrics.count('github_requests')
+    rate_limited = not ratelimiter.record(token, r)
     if not r.ok:
         logger.warn('Request for %s failed.', url)
         logger.warn('%s', r)
         logger.warn('%s', r.text)
         logger.warn('Posted:\n%s', json.dumps(obj))
-        return False
+        # Rate limited and failed requests weren't acted on.
+        raise PostError('github rejected the comment (%d)' % r.status_code,
+                        rate_limited or r.status_code >= 500)
 
     return r.json()
 
 
-def _fetch_api(token, url, bust_cache=False):
-    response = _fetch_url(token, url, bust_cache=bust_cache)
+def _post_api(token, path, obj, **kwargs):
+    '''Like _post, but returns False on failure.'''
+    try:
+        return _post(token, path, obj, **kwargs)
+    except PostError:
+        return False
+
+
+def _fetch_api(token, url, bust_cache=False, policy=IMMUTABLE):
+    response = _fetch_url(token, url, bust_cache=bust_cache, policy=policy)
+    return _parse_api_response(response)
+
+
+def _parse_api_response(response):
     if response is None or response is False:
         return None
     if WHITESPACE_RE.match(response):
         return None
 
+    metrics.count('json_bytes_parsed', len(response))
     try:
-        j = json.loads(response)
+        with metrics.timed('parse_json'):
+            j = json.loads(response)
     except ValueError:
         logger.warn('Failed to parse as JSON:\n%s', response)
         raise
     return j
 
 
-# caching: never
+def _page_url(url, page):
+    if page == 1:
+        return url
+    return url + ('&' if '?' in url else '?') + 'page=%d' % page
+
+
+def _last_page(meta):
+    """Returns the number of pages in a paginated response, if known."""
+    for link_url, rel in LINK_RE.findall(meta.get('link', '')):
+        if rel == 'last':
+            m = PAGE_RE.search(link_url)
+            if m:
+                return int(m.group(1))
+    return 1
+
+
+def _iter_later_pages(token, url, first_meta, refreshed, policy):
+    """Yields the items on pages 2..N, given the metadata for page 1.
+
+    The pages are fetched concurrently (and cached individually), but their
+    items are still yielded in order. So that all the pages are from the same
+    time, they're revalidated if page 1 was just fetched from github (i.e.
+    refreshed), and otherwise served from cache whatever their age.
+
+    Raises IncompleteList if a page can't be fetched, or there are more than
+    MAX_PAGES of them.
+    """
+    last_page = _last_page(first_meta)
+    if last_page > MAX_PAGES:
+        raise IncompleteList('%s has %d pages; only %d are fetched' % (
+                url, last_page, MAX_PAGES))
+    page_urls = [_page_url(url, page) for page in xrange(2, last_page + 1)]
+    if not refreshed:
+        policy = IMMUTABLE
+    pages = parallel.iter_concurrently([
+        functools.partial(_fetch_api, token, page_url, refreshed, policy)
+        for page_url in page_urls])
+    buffered = {}
+    next_idx = 0
+    for idx, page_items in pages:
+        buffered[idx] = page_items
+        while next_idx in buffered:
+            page_items = buffered.pop(next_idx)
+            if page_items is None:
+                raise IncompleteList('Unable to fetch %s' % page_urls[next_idx])
+            for item in page_items:
+                yield item
+            next_idx += 1
+
+
+def _fetch_first_page(token, url, bust_cache, policy):
+    """Returns (items, meta, refreshed) for page 1 of a paginated list."""
+    asked_at = time.time()
+    response, meta = _fetch_entry(token, url, bust_cache=bust_cache,
+                                  policy=policy)
+    refreshed = (not policy.store or
+                 meta.get('fetched_at', asked_at) >= asked_at)
+    return _parse_api_response(response), meta, refreshed
+
+
+def iter_paginated(token, url, bust_cache=False, policy=MUTABLE):
+    """Yields every item from a paginated list endpoint.
+
+    The first page's Link header says how many pages there are; the rest are
+    then requested all at once. Raises IncompleteList (see _iter_later_pages)
+    after yielding the items it could get.
+    """
+    items, meta, refreshed = _fetch_first_page(token, url, bust_cache, policy)
+    for item in items or []:
+        yield item
+    for item in _iter_later_pages(token, url, meta, refreshed, policy):
+        yield item
+
+
+def fetch_paginated(token, url, bust_cache=False, policy=MUTABLE):
+    """Returns all items from a paginated list endpoint.
+
+    Returns None if the first page can't be fetched, and raises
+    IncompleteList if a later one can't be (see _iter_later_pages).
+    """
+    items, meta, refreshed = _fetch_first_page(token, url, bust_cache, policy)
+    if items is None:
+        return None
+    return items + list(
+        _iter_later_pages(token, url, meta, refreshed, policy))
+
+
 def get_current_user_info(token):
     """Returns information about the authenticated user."""
-    return _fetch_api(token, GITHUB_API_ROOT + '/user', bust_cache=True)
+    return _fetch_api(token, GITHUB_API_ROOT + '/user', policy=NEVER_CACHE)
+
+
+def _pull_requests_url(owner, repo):
+    return (GITHUB_API_ROOT + '/repos/%(owner)s/%(repo)s/pulls?per_page=%(per_page)s') % {'owner': owner, 'repo': repo, 'per_page': PER_PAGE}
 
 
-# caching: should always check after calling
 def get_pull_requests(token, owner, repo, bust_cache=False):
-    url = (GITHUB_API_ROOT + '/repos/%(owner)s/%(repo)s/pulls') % {'owner': owner, 'repo': repo}
-    return _fetch_api(token, url, bust_cache=bust_cache)
+    url = _pull_requests_url(owner, repo)
+    return fetch_paginated(token, url, bust_cache=bust_cache)
 
 
 def _pull_request_url(owner, repo, pull_number):
     return (GITHUB_API_ROOT + '/repos/%(owner)s/%(repo)s/pulls/%(pull_number)s') % {'owner': owner, 'repo': repo, 'pull_number': pull_number}
 
 
-# caching: should check after calling
 def get_pull_request(token, owner, repo, pull_number, bust_cache=False):
     url = _pull_request_url(owner, repo, pull_number)
-    return _fetch_api(token, url, bust_cache=bust_cache)
+    return _fetch_api(token, url, bust_cache=bust_cache, policy=MUTABLE)
 
 
-# caching: never expires
 def get_commit_info(token, owner, repo, sha):
     url = (GITHUB_API_ROOT + '/repos/%(owner)s/%(repo)s/commits/%(sha)s') % {'owner': owner, 'repo': repo, 'sha': sha}
     return _fetch_api(token, url)
 
 
 def _commits_url(owner, repo, pull_number):
-    return (GITHUB_API_ROOT + '/repos/%(owner)s/%(repo)s/pulls/%(pull_number)s/commits') % {
-            'owner': owner, 'repo': repo, 'pull_number': pull_number}
+    return (GITHUB_API_ROOT + '/repos/%(owner)s/%(repo)s/pulls/%(pull_number)s/commits?per_page=%(per_page)s') % {
+            'owner': owner, 'repo': repo, 'pull_number': pull_number,
+            'per_page': PER_PAGE}
 
-# caching: expires when pull_request's updated_at changes
 def get_pull_request_commits(token, owner, repo, pull_number):
     """Returns commits from first to last."""
-    commits = _fetch_api(token, _commits_url(owner, repo, pull_number))
+    commits = fetch_paginated(token, _commits_url(owner, repo, pull_number))
 
     if not commits:
         return None
@@ -154,25 +504,26 @@ def get_pull_request_commits(token, owner, repo, pull_number):
 
 
 def _comments_urls(owner, repo, pull_number):
-    issue_url = '/repos/%(owner)s/%(repo)s/issues/%(pull_number)s/comments' % {'owner': owner, 'repo': repo, 'pull_number': pull_number}
-    diff_url = '/repos/%(owner)s/%(repo)s/pulls/%(pull_number)s/comments' % {'owner': owner, 'repo': repo, 'pull_number': pull_number}
+    params = {'owner': owner, 'repo': repo, 'pull_number': pull_number,
+              'per_page': PER_PAGE}
+    issue_url = '/repos/%(owner)s/%(repo)s/issues/%(pull_number)s/comments?per_page=%(per_page)s' % params
+    diff_url = '/repos/%(owner)s/%(repo)s/pulls/%(pull_number)s/comments?per_page=%(per_page)s' % params
     return GITHUB_API_ROOT + issue_url, GITHUB_API_ROOT + diff_url
 
 
-# caching: expires when pull_request's updated_at changes
 def get_pull_request_comments(token, owner, repo, pull_number):
     # There are two types of comments:
     # 1. top level (these are issue comments)
     # 2. diff-level (these are pull requests comments)
     # TODO(danvk): are there also file-level comments?
     issue_url, diff_url = _comments_urls(owner, repo, pull_number)
-    issue_comments = _fetch_api(token, issue_url) or []
-    pr_comments = _fetch_api(token, diff_url) or []
+    issue_comments, pr_comments = parallel.run_concurrently([
+        functools.partial(fetch_paginated, token, issue_url),
+        functools.partial(fetch_paginated, token, diff_url)])
 
-    return {'top_level': issue_comments, 'diff_level': pr_comments}
+    return {'top_level': issue_comments or [], 'diff_level': pr_comments or []}
 
 
-# caching: never expires
 def get_diff_info(token, owner, repo, sha1, sha2):
     # https://developer.github.com/v3/repos/commits/#compare-two-commits
     # Highlights include files.{filename,additions,deletions,changes}
@@ -180,46 +531,147 @@ def get_diff_info(token, owner, repo, sha1, sha2):
     return _fetch_api(token, url)
 
 
-# caching: never expires
+def _index_diff(unified_diff):
+    """Maps each file in a unified diff to the span of its segment.
+
+    Spans are (byte_start, byte_end, char_start, char_end), see
+    caching.TieredCache.read_span.
+    """
+    ms = [m for m in DIFF_START_RE.finditer(unified_diff)]
+    starts = [m.start() for m in ms] + [len(unified_diff)]
+    byte_starts = []
+    byte_offset = 0
+    last_start = 0
+    for start in starts:
+        byte_offset += len(unified_diff[last_start:start].encode('utf-8'))
+        byte_starts.append(byte_offset)
+        last_start = start
+
+    index = {}
+    for idx, m in enumerate(ms):
+        # is it possible that m.group(1) != m.group(2)
+        if m.group(1) != m.group(2) or m.group(2) in index:
+            continue
+        index[m.group(2)] = (byte_starts[idx], byte_starts[idx + 1],
+                             starts[idx], starts[idx + 1])
+    return index
+
+
 def get_file_diff(token, owner, repo, path, sha1, sha2):
     # https://developer.github.com/v3/repos/commits/#compare-two-commits
     # Highlights include files.{filename,additions,deletions,changes}
     url = (GITHUB_API_ROOT + '/repos/%(owner)s/%(repo)s/compare/%(sha1)s...%(sha2)s') % {'owner': owner, 'repo': repo, 'sha1': sha1, 'sha2': sha2}
-    unified_diff = _fetch_url(token, url, extra_headers={'Accept': 'application/vnd.github.3.diff'})
+    key = _cache_key(url, DIFF_HEADERS)
+
+    # The compare diff can be many megabytes. It's split up into per-file
+    # segments once, and the index is stored alongside the cached diff. After
+    # that, we only need to read the relevant segment.
+    index = cache.get_meta(key).get('file_index')
+    if index is not None:
+        if path not in index:
+            logger.info('Unable to find diff for %s in %s', path, url)
+            return None
+        file_diff = cache.read_span(key, index[path])
+        if file_diff is not None:
+            return file_diff
+
+    unified_diff = _fetch_url(token, url, extra_headers=DIFF_HEADERS)
     if not unified_diff:
         logger.info('Unable to get unified diff %s', url)
         return None
 
-    # Parse out the bit that's relevant to the file 
-    diff_start_re = re.compile(r'^diff --git a/(.*?) b/(.*?)$', re.MULTILINE)
-    ms = [m for m in diff_start_re.finditer(unified_diff)]
-    file_idx = -1
-    for idx, m in enumerate(ms):
-        # is it possible that m.group(1) != m.group(2)
-        if m.group(1) == path and m.group(2) == path:
-            file_idx = idx
-            break
+    index = _index_diff(unified_diff)
+    meta = cache.get_meta(key)
+    if meta:
+        meta['file_index'] = index
+        cache.set_meta(key, meta)
 
-    if file_idx == -1:
+    if path not in index:
         logger.info('Unable to find diff for %s in %s', path, url)
         return None
-
-    start = ms[file_idx].start()
-    if file_idx < len(ms) - 1:
-        limit = ms[file_idx + 1].start()
-    else:
-        limit = len(unified_diff)
+    _, _, start, limit = index[path]
     return unified_diff[start:limit]
 
 
-# caching: never expires
+_RAW_HEADERS = {'Accept': 'application/vnd.github.3.raw'}
+
+
+def _file_url(owner, repo, path, sha):
+    return (GITHUB_API_ROOT + '/repos/%(owner)s/%(repo)s/contents/%(path)s?ref=%(sha)s') % {'owner': owner, 'repo': repo, 'path': path, 'sha': sha}
+
+
+# Bytes read from github at a time when downloading file contents.
+_DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+
 def get_file_at_ref(token, owner, repo, path, sha):
-    url = (GITHUB_API_ROOT + '/repos/%(owner)s/%(repo)s/contents/%(path)s?ref=%(sha)s') % {'owner': owner, 'repo': repo, 'path': path, 'sha': sha}
-    return _fetch_url(token, url, extra_headers={'Accept': 'application/vnd.github.3.raw'})
+    f = open_file_at_ref(token, owner, repo, path, sha)
+    if f is None:
+        return False
+    with f:
+        return f.read().decode('utf-8', 'replace')
+
+
+def open_file_at_ref(token, owner, repo, path, sha):
+    """Returns an open binary file of a file's contents, as stored on github.
+
+    The file is read from the cache, so large files can be streamed rather
+    than held in memory. Returns None if the file can't be fetched.
+    """
+    url = _file_url(owner, repo, path, sha)
+    key = _cache_key(url, _RAW_HEADERS)
+    f = cache.open(key)
+    if f is not None:
+        metrics.count('github_cache_hits')
+        return f
+    metrics.count('github_cache_misses')
+    # Contents at a sha never change, so there's no need to revalidate.
+    fetch = lambda: _download(token, url, key, _RAW_HEADERS)
+    if not inflight.do(key, fetch):
+        return None
+    return cache.open(key)
+
+
+def _download(token, url, key, extra_headers):
+    '''Streams a response's bytes straight into the cache, unconverted.
+
+    Unlike _fetch_upstream, the body is never held in memory. Returns whether
+    the download succeeded.
+    '''
+    f = cache.open(key)
+    if f is not None:
+        # Another process fetched this while we waited on it.
+        f.close()
+        return True
+
+    headers = dict(extra_headers)
+    if token:
+        headers['Authorization'] = 'token ' + token
+    logger.info('Uncached request for %s', url)
+
+    def counted(chunks):
+        for chunk in chunks:
+            metrics.count('github_bytes_fetched', len(chunk))
+            yield chunk
+
+    for attempt in xrange(2):
+        ratelimiter.acquire(token)
+        with metrics.timed('github'), client.stream(url, headers=headers) as r:
+            metrics.count('github_requests')
+            if not ratelimiter.record(token, r) and attempt == 0:
+                continue  # acquire() waits out the backoff, or gives up.
+            if not r.ok:
+                logger.warn('Request for %s failed: %s', url, r.text)
+                return False
+            meta = _response_meta(r)
+            meta['fetched_at'] = time.time()
+            cache.set_file(key, counted(
+                    r.iter_content(_DOWNLOAD_CHUNK_BYTES)), meta=meta)
+            return True
 
 
-# caching: n/a
 def post_comment(token, owner, repo, pull_number, comment):
+    '''Posts a review comment. Raises PostError if github doesn't take it.'''
     # Have to have 'body', then either 'in_reply_to' or a full position spec.
     if not 'body' in comment and (
             ('in_reply_to' in comment) or
@@ -237,11 +689,10 @@ def post_comment(token, owner, repo, pull_number, comment):
         filtered_comment['position'] = comment['original_position']
         filtered_comment['path'] = comment['path']
 
-    return _post_api(token, post_path, filtered_comment,
-                     owner=owner, repo=repo, pull_number=pull_number)
+    return _post(token, post_path, filtered_comment,
+                 owner=owner, repo=repo, pull_number=pull_number)
 
 
-# caching: n/a
 def post_issue_comment(token, owner, repo, issue_number, body):
     post_path = '/repos/%(owner)s/%(repo)s/issues/%(issue_number)s/comments'
 
@@ -250,12 +701,10 @@ def post_issue_comment(token, owner, repo, issue_number, body):
         }, owner=owner, repo=repo, issue_number=issue_number)
 
 
-# caching: never
 def get_user_subscriptions(token, user):
     '''Returns a list of repos to which the user subscribes.'''
-    # TODO(danvk): follow paginated results here.
-    url = (GITHUB_API_ROOT + '/users/%(user)s/subscriptions?per_page=100') % {'user': user}
-    subscriptions = _fetch_api(token, url)
+    url = (GITHUB_API_ROOT + '/users/%(user)s/subscriptions?per_page=%(per_page)s') % {'user': user, 'per_page': PER_PAGE}
+    subscriptions = fetch_paginated(token, url, policy=ALWAYS_REVALIDATE)
     if not subscriptions:
         return None
     subscriptions.sort(key=lambda repo: repo['updated_at'])
@@ -264,17 +713,93 @@ def get_user_subscriptions(token, user):
 
 
 def _expire_urls(urls):
-    keys = [url + json.dumps(None) for url in urls]
-    cache.delete_multi(keys)
+    """Forces the next fetch of these URLs to go to github.
+
+    The cached responses are kept so that they can be revalidated cheaply.
+    All pages of paginated responses are expired.
+    """
+    for url in urls:
+        last_page = _last_page(cache.get_meta(_cache_key(url)))
+        for page in xrange(1, min(last_page, MAX_PAGES) + 1):
+            key = _cache_key(_page_url(url, page))
+            meta = cache.get_meta(key)
+            if meta:
+                meta['stale'] = True
+                cache.set_meta(key, meta)
+            else:
+                cache.delete_multi([key])
+
+
+def _snapshot_url(owner, repo, pull_number):
+    """Cache key for a whole pull request, as fetched by github_graphql."""
+    return (GITHUB_API_ROOT + '/graphql#%(owner)s/%(repo)s/pull/%(pull_number)s') % {'owner': owner, 'repo': repo, 'pull_number': pull_number}
 
 
 def expire_cache_for_pull_request_children(owner, repo, pull_number):
-    """Delete all non-permanent cache entries relating to this PR."""
+    """Mark all non-permanent cache entries relating to this PR as stale."""
     urls = (list(_comments_urls(owner, repo, pull_number)) +
-            [_commits_url(owner, repo, pull_number)])
+            [_commits_url(owner, repo, pull_number),
+             _snapshot_url(owner, repo, pull_number)])
     _expire_urls(urls)
 
 
 def expire_cache_for_pull_request(owner, repo, pull_number):
-    """Delete the Pull Request RPC itself from the cache."""
-    _expire_urls([_pull_request_url(owner, repo, pull_number)])
+    """Mark the Pull Request RPC itself as stale."""
+    _expire_urls([_pull_request_url(owner, repo, pull_number),
+                  _snapshot_url(owner, repo, pull_number)])
+
+
+def expire_cache_for_snapshot(owner, repo, pull_number):
+    """Mark the GraphQL snapshot of a PR (see github_graphql) as stale."""
+    _expire_urls([_snapshot_url(owner, repo, pull_number)])
+
+
+def expire_cache_for_pull_requests(owner, repo):
+    """Mark the list of open pull requests for a repo as stale."""
+    _expire_urls([_pull_requests_url(owner, repo)])
+
+
+def expire_cache_for_comments(owner, repo, pull_number, top_level=True,
+                              diff_level=True):
+    """Mark one or both kinds of comments on a pull request as stale.
+
+    New comments change the pull request's updated_at, so it's stale, too.
+    """
+    issue_url, diff_url = _comments_urls(owner, repo, pull_number)
+    urls = [_pull_request_url(owner, repo, pull_number),
+            _snapshot_url(owner, repo, pull_number)]
+    if top_level:
+        urls.append(issue_url)
+    if diff_level:
+        urls.append(diff_url)
+    _expire_urls(urls)
+
+
+def update_cached_pull_request(owner, repo, pull_request):
+    """Replaces the cached copy of a pull request, e.g. from a webhook.
+
+    Returns False (and leaves the cache alone) if the cached copy is newer.
+    """
+    key = _cache_key(_pull_request_url(owner, repo, pull_request['number']))
+    cached = cache.get(key)
+    if cached:
+        old = json.loads(cached)
+        if old.get('updated_at', '') > pull_request['updated_at']:
+            return False
+    cache.set(key, json.dumps(pull_request), meta={'fetched_at': time.time()})
+    return True
+
+
+def get_cached_pull_requests(owner, repo):
+    """Returns the open pull requests for a repo as last cached.
+
+    This never goes to github; it returns [] if nothing is cached.
+    """
+    url = _pull_requests_url(owner, repo)
+    last_page = _last_page(cache.get_meta(_cache_key(url)))
+    pull_requests = []
+    for page in xrange(1, min(last_page, MAX_PAGES) + 1):
+        pull_requests.extend(
+                _parse_api_response(cache.get(_cache_key(_page_url(url, page))))
+                or [])
+    return pull_requests
@@ -1,87 +1,173 @@
+import bisect
+import functools
 import re
 import sys
+import caching
 import github
 import itertools
+import metrics
+import parallel
 from collections import defaultdict
 
-DIFF_HUNK_HEADER_RE = re.compile(r'^@@ -([0-9]+),[0-9]+ \+([0-9]+),[0-9]+ @@')
-
-def _find_position_in_diff_hunk(diff_lines, position):
-    idx = position
-    while idx >= 0 and not DIFF_HUNK_HEADER_RE.match(diff_lines[idx]):
-        idx -= 1
-    return position - idx
-
-
-def _get_github_diff_lines(token, owner, repo, path, sha1, sha2):
-    diff = github.get_file_diff(token, owner, repo, path, sha1, sha2)
-    if not diff:
+# Line counts are omitted for single-line hunks, e.g. "@@ -1 +1 @@".
+DIFF_HUNK_HEADER_RE = re.compile(r'^@@ -([0-9]+)(?:,[0-9]+)? \+([0-9]+)(?:,[0-9]+)? @@')
+
+class ParsedDiff(object):
+    """A single file's diff, indexed the way github counts positions.
+
+    Position p refers to lines[p]; the first hunk header is position 0. This
+    does one pass over the diff up front, after which positions can be mapped
+    to line numbers on either side (and vice versa) without rescanning it.
+    """
+    def __init__(self, diff_lines):
+        self.lines = diff_lines
+        # Per position: the position of the enclosing hunk header and the
+        # line number on each side (None if the line isn't on that side).
+        self.hunk_starts = []
+        self.left_line_numbers = []
+        self.right_line_numbers = []
+        # (first position, last position) of each hunk.
+        self.hunks = []
+        # Sorted line numbers for each side, with their positions.
+        self._left_lines, self._left_positions = [], []
+        self._right_lines, self._right_positions = [], []
+
+        left_line_no = right_line_no = None
+        hunk_start = -1
+        for position, diff_line in enumerate(diff_lines):
+            left = right = None
+            m = DIFF_HUNK_HEADER_RE.match(diff_line)
+            if m:
+                left_line_no = int(m.group(1)) - 1
+                right_line_no = int(m.group(2)) - 1
+                if hunk_start >= 0:
+                    self.hunks.append((hunk_start, position - 1))
+                hunk_start = position
+            elif hunk_start < 0 or diff_line.startswith('\\'):
+                pass  # e.g. "\ No newline at end of file"
+            elif diff_line.startswith('-'):
+                left_line_no += 1
+                left = left_line_no
+            elif diff_line.startswith('+'):
+                right_line_no += 1
+                right = right_line_no
+            else:
+                left_line_no += 1
+                right_line_no += 1
+                left, right = left_line_no, right_line_no
+
+            self.hunk_starts.append(hunk_start)
+            self.left_line_numbers.append(left)
+            self.right_line_numbers.append(right)
+            if left is not None:
+                self._left_lines.append(left)
+                self._left_positions.append(position)
+            if right is not None:
+                self._right_lines.append(right)
+                self._right_positions.append(position)
+        if hunk_start >= 0:
+            self.hunks.append((hunk_start, len(diff_lines) - 1))
+
+    @staticmethod
+    def from_diff(diff):
+        """Parses the output of github.get_file_diff."""
+        diff_lines = diff.split('\n')
+        if diff_lines and diff_lines[-1] == '':
+            diff_lines.pop()  # trailing newline
+        # The first several lines are headers which github ignores in indexing.
+        start = 0
+        while start < len(diff_lines) and not DIFF_HUNK_HEADER_RE.match(diff_lines[start]):
+            start += 1
+        return ParsedDiff(diff_lines[start:])
+
+    def position_for_line(self, line_number, on_left):
+        """Returns the position of a line on one side of the diff, or None."""
+        if on_left:
+            lines, positions = self._left_lines, self._left_positions
+        else:
+            lines, positions = self._right_lines, self._right_positions
+        idx = bisect.bisect_left(lines, line_number)
+        if idx < len(lines) and lines[idx] == line_number:
+            return positions[idx]
+        return None
+
+    def hunk_for_position(self, position):
+        """Returns the diff hunk up to and including position."""
+        return '\n'.join(self.lines[self.hunk_starts[position]:1 + position])
+
+
+# Diffs between two shas never change, so parsed diffs can be shared freely.
+_parsed_diffs = caching.LruCache(512)
+
+def get_parsed_diff(token, owner, repo, path, sha1, sha2):
+    """Returns a ParsedDiff for a file between two commits, or None."""
+    key = (owner, repo, path, sha1, sha2)
+    parsed = _parsed_diffs.get(key)
+    if parsed is None:
+        metrics.count('parsed_diff_cache_misses')
+        diff = github.get_file_diff(token, owner, repo, path, sha1, sha2)
+        if not diff:
+            return None
+        metrics.count('diff_bytes_parsed', len(diff))
+        with metrics.timed('parse_diff'):
+            parsed = ParsedDiff.from_diff(diff)
+        _parsed_diffs.set(key, parsed)
+    else:
+        metrics.count('parsed_diff_cache_hits')
+    return parsed
+
+
+def _annotate_comment(parsed_diff, comment):
+    position = comment['original_position']
+    if position >= len(parsed_diff.lines):
         return False
-
-    # The first several lines are headers which github ignores in indexing.
-    diff_lines = diff.split('\n')
-    while diff_lines and not DIFF_HUNK_HEADER_RE.match(diff_lines[0]):
-        del diff_lines[0]
-    return diff_lines
+    comment['diff_line'] = parsed_diff.lines[position]
+    comment['position_in_diff_hunk'] = position - parsed_diff.hunk_starts[position]
+    # TODO(danvk): compute line numbers here (instead of in JS)
+    return True
 
 
 def add_line_number_to_comment(token, owner, repo, base_sha, comment):
     path = comment['path']
     comment_sha = comment['original_commit_id']
-    position = comment['original_position']
 
-    diff_lines = _get_github_diff_lines(token, owner, repo, path, base_sha, comment_sha)
-    if not diff_lines:
+    parsed_diff = get_parsed_diff(token, owner, repo, path, base_sha, comment_sha)
+    if not parsed_diff:
         return False
-    diff_line = diff_lines[position]
-
-    comment['diff_line'] = diff_line
-    comment['position_in_diff_hunk'] = _find_position_in_diff_hunk(diff_lines, position)
-    # TODO(danvk): compute line numbers here (instead of in JS)
+    return _annotate_comment(parsed_diff, comment)
 
 
 def add_line_numbers_to_comments(token, owner, repo, base_sha, comments):
+    # Comments tend to cluster on a few files, so group them by diff. Each
+    # distinct diff is fetched (concurrently) and parsed just once.
+    comments_by_diff = defaultdict(list)
     for comment in comments:
-        add_line_number_to_comment(token, owner, repo, base_sha, comment)
+        key = (comment['path'], comment['original_commit_id'])
+        comments_by_diff[key].append(comment)
 
+    keys = comments_by_diff.keys()
+    parsed_diffs = parallel.run_concurrently([
+        functools.partial(get_parsed_diff,
+                          token, owner, repo, path, base_sha, sha)
+        for path, sha in keys])
 
-def lineNumberToDiffPositionAndHunk(token, owner, repo, base_sha, path, commit_id, line_number, on_left):
-    diff_lines = _get_github_diff_lines(token, owner, repo, path, base_sha, commit_id)
-    if not diff_lines:
-        sys.stderr.write('Unable to get diff\n')
-        return False
-
-    left_line_no = None
-    right_line_no = None
-    hunk_start = None
-    for position, diff_line in enumerate(diff_lines):
-        m = DIFF_HUNK_HEADER_RE.match(diff_line)
-        if m:
-            left_line_no = int(m.group(1)) - 1
-            right_line_no = int(m.group(2)) - 1
-            hunk_start = position
+    for key, parsed_diff in zip(keys, parsed_diffs):
+        if not parsed_diff:
             continue
-        assert left_line_no != None and right_line_no != None, ('%s, %s' % (position, diff_lines))
+        for comment in comments_by_diff[key]:
+            _annotate_comment(parsed_diff, comment)
 
-        if len(diff_line) > 0:
-            sign = diff_line[0]
-        else:
-            sign = ''
 
-        if sign == '-':
-            left_line_no += 1
-        elif sign == '+':
-            right_line_no += 1
-        else:
-            left_line_no += 1
-            right_line_no += 1
-
-        # sys.stderr.write('%d/%d (want %d) %s\n' % (left_line_no, right_line_no, line_number, diff_line))
-        if ((on_left and left_line_no == line_number) or
-            (not on_left and right_line_no == line_number)):
-            return (position, '\n'.join(diff_lines[hunk_start:1+position]))
+def lineNumberToDiffPositionAndHunk(token, owner, repo, base_sha, path, commit_id, line_number, on_left):
+    parsed_diff = get_parsed_diff(token, owner, repo, path, base_sha, commit_id)
+    if not parsed_diff:
+        sys.stderr.write('Unable to get diff\n')
+        return False, None
 
-    return False, None
+    position = parsed_diff.position_for_line(line_number, on_left)
+    if position is None:
+        return False, None
+    return (position, parsed_diff.hunk_for_position(position))
 
 
 def _threadify(comments):
@@ -8,7 +8,7 @@ _ = ''  # a "don't care" value
 class GithubCommentsTestCase(unittest.TestCase):
 
     def setUp(self):
-        pass
+        github_comments._parsed_diffs.clear()
 
     def tearDown(self):
         pass
@@ -32,6 +32,73 @@ class GithubCommentsTestCase(unittest.TestCase):
             self.assertEquals(4, position)
             self.assertEquals('@@ -30,6 +30,7 @@', diff_hunk.split('\n')[0])
 
+    def test_lineNumberToDiffPositionAndHunkOnLeft(self):
+        # Line 33 of the base is after the inserted line, at position 5.
+        mock = MagicMock(return_value=open('testdata/small-inline.diff.txt').read())
+        with patch('github.get_file_diff', mock):
+            position, diff_hunk = github_comments.lineNumberToDiffPositionAndHunk(
+                    _, _, _, _, _, _, 33, True)
+            self.assertEquals(5, position)
+            self.assertEquals(6, len(diff_hunk.split('\n')))
+
+        with patch('github.get_file_diff', MagicMock(return_value=None)):
+            self.assertEquals((False, None),
+                              github_comments.lineNumberToDiffPositionAndHunk(
+                                  _, _, _, _, 'other.js', _, 33, True))
+
+    def test_addLineNumbersToCommentsGroupsByDiff(self):
+        mock = MagicMock(return_value=open('testdata/small-inline.diff.txt').read())
+        comments = [
+            {'path': 'a.js', 'original_commit_id': 'abc', 'original_position': 4},
+            {'path': 'a.js', 'original_commit_id': 'abc', 'original_position': 1},
+            {'path': 'a.js', 'original_commit_id': 'def', 'original_position': 4}
+        ]
+        with patch('github.get_file_diff', mock):
+            github_comments.add_line_numbers_to_comments(_, _, _, _, comments)
+
+        self.assertEquals(2, mock.call_count)
+        self.assertEquals([4, 1, 4], [c['position_in_diff_hunk'] for c in comments])
+        self.assertEquals(comments[0]['diff_line'], comments[2]['diff_line'])
+
+    def test_parsedDiffLookups(self):
+        diff = github_comments.ParsedDiff.from_diff(
+                open('testdata/small-inline.diff.txt').read())
+        self.assertEquals('@@ -30,6 +30,7 @@', diff.lines[0])
+        self.assertEquals([(0, 7)], diff.hunks)
+
+        # Context lines are on both sides.
+        self.assertEquals(1, diff.position_for_line(30, False))
+        self.assertEquals(1, diff.position_for_line(30, True))
+        # The added line is only on the right.
+        self.assertEquals(4, diff.position_for_line(33, False))
+        self.assertEquals(33, diff.right_line_numbers[4])
+        self.assertEquals(None, diff.left_line_numbers[4])
+        self.assertEquals(5, diff.position_for_line(33, True))
+        # Lines outside the hunk aren't in the diff.
+        self.assertEquals(None, diff.position_for_line(29, False))
+        self.assertEquals(None, diff.position_for_line(37, False))
+
+        self.assertEquals(diff.lines[0:5], diff.hunk_for_position(4).split('\n'))
+
+    def test_parsedDiffOnLeft(self):
+        diff = github_comments.ParsedDiff([
+            '@@ -10,3 +10,2 @@',
+            ' same',
+            '-removed',
+            ' same again',
+            '@@ -20 +19 @@',
+            '-old',
+            '+new',
+            '\\ No newline at end of file'])
+        self.assertEquals([(0, 3), (4, 7)], diff.hunks)
+        self.assertEquals(2, diff.position_for_line(11, True))
+        self.assertEquals(3, diff.position_for_line(12, True))
+        self.assertEquals(3, diff.position_for_line(11, False))
+        self.assertEquals(5, diff.position_for_line(20, True))
+        self.assertEquals(6, diff.position_for_line(19, False))
+        self.assertEquals(None, diff.position_for_line(21, True))
+        self.assertEquals('@@ -20 +19 @@\n-old', diff.hunk_for_position(5))
+
 
 if __name__ == '__main__':
     unittest.main()
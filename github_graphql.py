@@ -0,0 +1,294 @@
+'''Fetches a whole pull request from github's GraphQL (v4) API.
+
+The REST API needs a request apiece for the pull request, its commits, the
+compare view and both kinds of comments. A single GraphQL query returns all of
+these. The results are normalised into the same dicts which the REST API
+returns, so the rest of gitcritic can't tell the difference.
+
+GraphQL doesn't expose the files changed by each commit. Only reverted_files
+needs those, and it gets them from the (sha-addressed, permanently cached) REST
+commit endpoint.
+'''
+
+import json
+import logging
+import time
+
+import github
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Connections are requested in pages of this size. Pull requests which don't
+# fit in one page are left to the REST API, which paginates properly.
+PAGE_SIZE = 100
+
+PULL_REQUEST_QUERY = '''
+query($owner: String!, $repo: String!, $number: Int!, $pageSize: Int!) {
+  rateLimit { cost remaining resetAt }
+  repository(owner: $owner, name: $repo) {
+    pullRequest(number: $number) {
+      databaseId number title body state url createdAt updatedAt
+      author { login avatarUrl }
+      baseRefName baseRefOid headRefName headRefOid
+      baseRepository { name nameWithOwner owner { login avatarUrl } }
+      headRepository { name nameWithOwner owner { login avatarUrl } }
+      commits(first: $pageSize) {
+        pageInfo { hasNextPage }
+        nodes {
+          commit {
+            oid url message committedDate
+            author { name email date user { login avatarUrl } }
+            committer { name email date user { login avatarUrl } }
+            parents(first: 2) { nodes { oid } }
+          }
+        }
+      }
+      files(first: $pageSize) {
+        pageInfo { hasNextPage }
+        nodes { path additions deletions changeType }
+      }
+      comments(first: $pageSize) {
+        pageInfo { hasNextPage }
+        nodes {
+          databaseId body url createdAt updatedAt
+          author { login avatarUrl }
+        }
+      }
+      reviewThreads(first: $pageSize) {
+        pageInfo { hasNextPage }
+        nodes {
+          comments(first: $pageSize) {
+            pageInfo { hasNextPage }
+            nodes {
+              databaseId body url createdAt updatedAt path
+              position originalPosition diffHunk
+              author { login avatarUrl }
+              commit { oid }
+              originalCommit { oid }
+              replyTo { databaseId }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+# GraphQL's changeType vs. the REST API's file status.
+_FILE_STATUSES = {
+    'ADDED': 'added',
+    'DELETED': 'removed',
+    'MODIFIED': 'modified',
+    'RENAMED': 'renamed',
+    'COPIED': 'copied',
+    'CHANGED': 'changed'
+}
+
+
+def _user(actor):
+    # Deleted accounts come back as null.
+    if not actor:
+        return {'login': 'ghost', 'avatar_url': ''}
+    return {'login': actor['login'], 'avatar_url': actor['avatarUrl']}
+
+
+def _oid(obj):
+    return obj['oid'] if obj else None
+
+
+def _normalize_repo(repo):
+    if not repo:
+        return None
+    return {
+        'name': repo['name'],
+        'full_name': repo['nameWithOwner'],
+        'owner': _user(repo['owner'])
+    }
+
+
+def _normalize_pull_request(pr):
+    return {
+        'id': pr['databaseId'],
+        'number': pr['number'],
+        'title': pr['title'],
+        'body': pr['body'],
+        'state': pr['state'].lower(),
+        'html_url': pr['url'],
+        'created_at': pr['createdAt'],
+        'updated_at': pr['updatedAt'],
+        'user': _user(pr['author']),
+        'base': {
+            'ref': pr['baseRefName'],
+            'sha': pr['baseRefOid'],
+            'repo': _normalize_repo(pr['baseRepository'])
+        },
+        'head': {
+            'ref': pr['headRefName'],
+            'sha': pr['headRefOid'],
+            'repo': _normalize_repo(pr['headRepository'])
+        }
+    }
+
+
+def _git_actor(actor):
+    return {'name': actor['name'], 'email': actor['email'],
+            'date': actor['date']}
+
+
+def _normalize_commit(c):
+    # Like the REST API, authors without a github account are null.
+    def user(actor):
+        return _user(actor['user']) if actor and actor['user'] else None
+    committer = _git_actor(c['committer'])
+    committer['date'] = c['committedDate']
+    return {
+        'sha': c['oid'],
+        'html_url': c['url'],
+        'author': user(c['author']),
+        'committer': user(c['committer']),
+        'commit': {
+            'message': c['message'],
+            'author': _git_actor(c['author']),
+            'committer': committer
+        },
+        'parents': [{'sha': p['oid']} for p in c['parents']['nodes']]
+    }
+
+
+def _normalize_file(f):
+    return {
+        'filename': f['path'],
+        'status': _FILE_STATUSES.get(f['changeType'], 'modified'),
+        'additions': f['additions'],
+        'deletions': f['deletions'],
+        'changes': f['additions'] + f['deletions']
+    }
+
+
+def _normalize_issue_comment(c):
+    return {
+        'id': c['databaseId'],
+        'body': c['body'],
+        'html_url': c['url'],
+        'created_at': c['createdAt'],
+        'updated_at': c['updatedAt'],
+        'user': _user(c['author'])
+    }
+
+
+def _normalize_review_comment(c):
+    comment = _normalize_issue_comment(c)
+    comment.update({
+        'path': c['path'],
+        'position': c['position'],
+        'original_position': c['originalPosition'],
+        'diff_hunk': c['diffHunk'],
+        'commit_id': _oid(c['commit']),
+        'original_commit_id': _oid(c['originalCommit'])
+    })
+    if c['replyTo']:
+        comment['in_reply_to_id'] = c['replyTo']['databaseId']
+    return comment
+
+
+def _is_truncated(connection):
+    return connection['pageInfo']['hasNextPage']
+
+
+def normalize_pull_request(data):
+    '''Converts the result of PULL_REQUEST_QUERY to REST-style dicts.
+
+    Returns a dict with 'pull_request', 'commit_shas', 'commits', 'files' and
+    'comments' keys, or None if the pull request doesn't fit in a single page.
+    The commits are as listed by the REST API, i.e. without their files.
+    '''
+    pr = data['repository']['pullRequest']
+    threads = pr['reviewThreads']
+    connections = ([pr['commits'], pr['files'], pr['comments'], threads] +
+                   [thread['comments'] for thread in threads['nodes']])
+    if any(_is_truncated(c) for c in connections):
+        return None
+
+    review_comments = [_normalize_review_comment(c)
+                       for thread in threads['nodes']
+                       for c in thread['comments']['nodes']]
+    # The REST API lists these in the order they were made.
+    review_comments.sort(key=lambda c: c['id'])
+
+    commits = [_normalize_commit(node['commit'])
+               for node in pr['commits']['nodes']]
+    return {
+        'pull_request': _normalize_pull_request(pr),
+        'commit_shas': [c['sha'] for c in commits],
+        'commits': commits,
+        'files': [_normalize_file(f) for f in pr['files']['nodes']],
+        'comments': {
+            'top_level': [_normalize_issue_comment(c)
+                          for c in pr['comments']['nodes']],
+            'diff_level': review_comments
+        }
+    }
+
+
+def _post_query(token, query, variables):
+    '''Runs a GraphQL query, returning its data or None on failure.'''
+    url = github.GITHUB_API_ROOT + '/graphql'
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = 'bearer ' + token
+    github.ratelimiter.acquire(token, 'graphql')
+    with metrics.timed('github'):
+        r = github.client.post(url, headers=headers, data=json.dumps({
+            'query': query,
+            'variables': variables
+        }))
+    metrics.count('github_requests')
+    metrics.count('github_bytes_fetched', len(r.content))
+    github.ratelimiter.record(token, r)
+    if not r.ok:
+        logger.warn('GraphQL query failed: %s', r.text)
+        return None
+    with metrics.timed('parse_json'):
+        response = r.json()
+    if response.get('errors'):
+        logger.warn('GraphQL query failed: %s', response['errors'])
+        return None
+    return response['data']
+
+
+def get_pull_request(token, owner, repo, pull_number, bust_cache=False):
+    '''Returns everything about a pull request, see normalize_pull_request.
+
+    Returns None if the pull request couldn't be fetched this way, in which
+    case the caller should fall back to the REST API. The result is cached
+    like the REST responses it replaces and is expired along with them.
+    '''
+    key = github._cache_key(github._snapshot_url(owner, repo, pull_number))
+    cached, meta = github.cache.get_entry(key)
+    if (cached is not None and not bust_cache and
+            github.MUTABLE.is_fresh(meta, time.time())):
+        return json.loads(cached)
+
+    data = _post_query(token, PULL_REQUEST_QUERY, {
+        'owner': owner,
+        'repo': repo,
+        'number': int(pull_number),
+        'pageSize': PAGE_SIZE
+    })
+    if not data or not data['repository']['pullRequest']:
+        return None
+    cost = data['rateLimit']['cost']
+    logger.info('GraphQL query for %s/%s#%s cost %s', owner, repo,
+                pull_number, cost)
+    metrics.count('github_graphql_cost', cost)
+
+    snapshot = normalize_pull_request(data)
+    if snapshot is None:
+        logger.info('%s/%s#%s is too large for one GraphQL query',
+                    owner, repo, pull_number)
+        return None
+    github.cache.set(key, json.dumps(snapshot),
+                     meta={'fetched_at': time.time()})
+    return snapshot
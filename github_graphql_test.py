@@ -0,0 +1,90 @@
+import caching
+import fake_github
+import gitcritic
+import github
+import github_comments
+import github_graphql
+import shutil
+import tempfile
+import unittest
+from mock import patch, MagicMock
+
+
+class GraphQLBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = fake_github.FakeGitHub()
+        self.fake.start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.patches = [
+            patch('github.GITHUB_API_ROOT', self.fake.root),
+            patch('github.cache', caching.TieredCache(self.cache_dir)),
+            patch('github.client', github.GitHubClient())
+        ]
+        for p in self.patches:
+            p.start()
+        github_comments._parsed_diffs.clear()
+
+    def tearDown(self):
+        github.client.close()
+        for p in reversed(self.patches):
+            p.stop()
+        shutil.rmtree(self.cache_dir)
+        self.fake.stop()
+
+    def _load(self, backend):
+        db = MagicMock()
+        db.get_draft_comments.return_value = []
+        with patch('gitcritic.PR_BACKEND', backend):
+            pr = gitcritic.PullRequest.from_github(
+                    db, 'token', 'login', 'danvk', 'dygraphs', 1)
+            pr.load('commits', 'files', 'comments')
+            return pr
+
+    def test_same_as_rest(self):
+        rest_pr = self._load('rest')
+        num_rest_requests = len(self.fake.requests)
+        github.cache = caching.TieredCache(tempfile.mkdtemp(dir=self.cache_dir))
+        github_comments._parsed_diffs.clear()
+        del self.fake.requests[:]
+        graphql_pr = self._load('graphql')
+
+        self.assertEquals(rest_pr.pull_request, graphql_pr.pull_request)
+        self.assertEquals(rest_pr.commits, graphql_pr.commits)
+        self.assertEquals(rest_pr.files, graphql_pr.files)
+        self.assertEquals(rest_pr.comments, graphql_pr.comments)
+
+        paths = [path for _, path in self.fake.requests]
+        self.assertEquals(1, paths.count('/graphql'))
+        self.assertFalse([p for p in paths if '/pulls' in p or '/issues' in p])
+        # The commit list comes from the query, too; only the base commit
+        # (which isn't on the pull request) is fetched separately.
+        self.assertEquals(
+                ['/repos/danvk/dygraphs/commits/' + self.fake.pull_request.base_sha],
+                [p for p in paths if '/commits/' in p])
+        self.assertLess(len(self.fake.requests), num_rest_requests)
+
+    def test_cached_until_expired(self):
+        self._load('graphql')
+        self._load('graphql')
+        self.assertEquals(1, self.fake.requests.count(('POST', '/graphql')))
+
+        github.expire_cache_for_pull_request_children('danvk', 'dygraphs', 1)
+        self._load('graphql')
+        self.assertEquals(2, self.fake.requests.count(('POST', '/graphql')))
+
+    def test_truncated_falls_back_to_rest(self):
+        data = self.fake.pull_request.graphql()
+        self.assertTrue(github_graphql.normalize_pull_request(data))
+        data['repository']['pullRequest']['commits']['pageInfo']['hasNextPage'] = True
+        self.assertEquals(None, github_graphql.normalize_pull_request(data))
+
+        with patch('github_graphql.normalize_pull_request', lambda data: None):
+            pr = self._load('graphql')
+        self.assertEquals(1, pr.pull_request['number'])
+        self.assertIn(('GET', '/repos/danvk/dygraphs/pulls/1'),
+                      self.fake.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
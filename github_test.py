@@ -0,0 +1,332 @@
+import BaseHTTPServer
+import SocketServer
+import re
+import caching
+import github
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from mock import patch
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    requests = []
+    num_pages = 3  # for list endpoints, i.e. URLs with per_page.
+    delay = 0
+    fail_pattern = None  # paths matching this get a 500
+    contents = 'GIF89a\0\xff\xfe'  # for /contents/ URLs
+
+    def do_GET(self):
+        _Handler.requests.append((self.path, dict(self.headers)))
+        time.sleep(_Handler.delay)
+        if _Handler.fail_pattern and re.search(_Handler.fail_pattern, self.path):
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"%s"' % self.path
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        link = None
+        if 'per_page=' in self.path:
+            m = re.search(r'[?&]page=([0-9]+)', self.path)
+            page = int(m.group(1)) if m else 1
+            body = '[{"page": %d}, {"page": %d}]' % (page, page)
+            if page < _Handler.num_pages:
+                base = 'http://%s%s' % (self.headers['Host'],
+                                        self.path.split('&page=')[0])
+                link = '<%s&page=%d>; rel="next", <%s&page=%d>; rel="last"' % (
+                        base, page + 1, base, _Handler.num_pages)
+        elif '/contents/' in self.path:
+            body = _Handler.contents
+        else:
+            body = '{"path": "%s"}' % self.path
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        if link:
+            self.send_header('Link', link)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True  # don't wait on idle keep-alive connections
+
+
+class GitHubClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        _Handler.requests = []
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.root = 'http://127.0.0.1:%d' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_patch = patch('github.cache',
+                                 caching.TieredCache(self.cache_dir))
+        self.cache_patch.start()
+        self.client_patch = patch('github.client', github.GitHubClient())
+        self.client_patch.start()
+
+    def tearDown(self):
+        github.client.close()
+        self.client_patch.stop()
+        self.cache_patch.stop()
+        shutil.rmtree(self.cache_dir)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        client = github.GitHubClient(pool_size=2)
+        for i in xrange(3):
+            r = client.get(self.root + '/repos/%d' % i)
+            self.assertEquals({'path': '/repos/%d' % i}, r.json())
+
+        stats = client.stats()
+        self.assertEquals(3, stats['requests'])
+        self.assertEquals(1, stats['connections'])
+        self.assertEquals(2, stats['reused'])
+
+    @patch.object(_Handler, 'delay', 0.05)
+    def test_requests_limited_to_pool_size(self):
+        client = github.GitHubClient(pool_size=2)
+        threads = [threading.Thread(target=client.get,
+                                    args=(self.root + '/repos/%d' % i,))
+                   for i in xrange(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # No connection was opened only to be discarded by a full pool.
+        self.assertEquals(6, client.stats()['requests'])
+        self.assertLessEqual(client.stats()['connections'], 2)
+
+    def test_post_errors(self):
+        # Nothing listens here, so the comment can't have been posted.
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        root = 'http://127.0.0.1:%d' % s.getsockname()[1]
+        s.close()
+        with patch('github.GITHUB_API_ROOT', root):
+            with self.assertRaises(github.PostError) as cm:
+                github.post_comment('token', 'danvk', 'dygraphs', 1, {
+                    'body': 'hi', 'path': 'a.py', 'original_commit_id': 'abc',
+                    'original_position': 1})
+        self.assertTrue(cm.exception.retryable)
+
+    def test_open_file_at_ref(self):
+        with patch('github.GITHUB_API_ROOT', self.root):
+            for i in xrange(2):
+                f = github.open_file_at_ref(None, 'danvk', 'dygraphs',
+                                            'image.gif', 'abc')
+                # The bytes are stored as-is, not decoded as text.
+                self.assertEquals(_Handler.contents, f.read())
+                f.close()
+        self.assertEquals(1, len(_Handler.requests))
+        self.assertEquals('application/vnd.github.3.raw',
+                          _Handler.requests[0][1]['accept'])
+
+    def test_conditional_request(self):
+        url = self.root + '/repos/danvk/dygraphs/pulls'
+        self.assertEquals({'path': '/repos/danvk/dygraphs/pulls'},
+                          github._fetch_api(None, url, policy=github.MUTABLE))
+        self.assertEquals({'path': '/repos/danvk/dygraphs/pulls'},
+                          github._fetch_api(None, url, bust_cache=True,
+                                            policy=github.MUTABLE))
+
+        self.assertEquals(2, len(_Handler.requests))
+        self.assertNotIn('if-none-match', _Handler.requests[0][1])
+        self.assertEquals('"/repos/danvk/dygraphs/pulls"',
+                          _Handler.requests[1][1]['if-none-match'])
+
+    def test_expired_urls_are_revalidated(self):
+        with patch('github.GITHUB_API_ROOT', self.root):
+            github.get_pull_request(None, 'danvk', 'dygraphs', 1)
+            github.get_pull_request(None, 'danvk', 'dygraphs', 1)
+            self.assertEquals(1, len(_Handler.requests))
+
+            github.expire_cache_for_pull_request('danvk', 'dygraphs', 1)
+            self.assertEquals({'path': '/repos/danvk/dygraphs/pulls/1'},
+                              github.get_pull_request(None, 'danvk', 'dygraphs', 1))
+            self.assertEquals(2, len(_Handler.requests))
+            self.assertIn('if-none-match', _Handler.requests[1][1])
+
+            github.get_pull_request(None, 'danvk', 'dygraphs', 1)
+            self.assertEquals(2, len(_Handler.requests))
+
+    def test_cache_policies(self):
+        url = self.root + '/user'
+        with patch('github.GITHUB_API_ROOT', self.root):
+            github.get_current_user_info(None)
+            github.get_current_user_info(None)
+        self.assertEquals(2, len(_Handler.requests))
+
+        url = self.root + '/repos/danvk/dygraphs/pulls/1'
+        with patch.object(github.MUTABLE, 'ttl', 0):
+            github._fetch_api(None, url, policy=github.MUTABLE)
+            github._fetch_api(None, url, policy=github.MUTABLE)
+        self.assertEquals(4, len(_Handler.requests))
+        self.assertIn('if-none-match', _Handler.requests[3][1])
+
+    def test_concurrent_requests_are_collapsed(self):
+        url = self.root + '/repos/danvk/dygraphs/commits/abc'
+        results = []
+        def fetch():
+            results.append(github._fetch_api(None, url))
+        threads = [threading.Thread(target=fetch) for _ in xrange(5)]
+        with patch.object(_Handler, 'delay', 0.1), \
+             patch('github.inflight', caching.SingleFlight()):
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEquals(4, github.inflight.stats()['collapsed'])
+
+        self.assertEquals([{'path': '/repos/danvk/dygraphs/commits/abc'}] * 5,
+                          results)
+        self.assertEquals(1, len(_Handler.requests))
+
+        # Callers get their own copies.
+        results[0]['path'] = 'modified'
+        self.assertNotEqual(results[0], results[1])
+
+    def test_pagination(self):
+        url = self.root + '/repos/danvk/dygraphs/pulls/1/commits?per_page=100'
+        commits = github.fetch_paginated(None, url)
+        self.assertEquals([1, 1, 2, 2, 3, 3], [c['page'] for c in commits])
+        self.assertEquals(3, len(_Handler.requests))
+        self.assertEquals(['/repos/danvk/dygraphs/pulls/1/commits?per_page=100&page=2',
+                           '/repos/danvk/dygraphs/pulls/1/commits?per_page=100&page=3'],
+                          sorted(path for path, _ in _Handler.requests[1:]))
+
+        url = self.root + '/users/danvk/subscriptions?per_page=100'
+        self.assertEquals([1, 1, 2, 2, 3, 3],
+                          [r['page'] for r in github.iter_paginated(None, url)])
+
+    def test_recheck_sees_other_processes(self):
+        url = self.root + '/repos/danvk/dygraphs/pulls/1'
+        key = github._cache_key(url)
+        github.cache.set(key, u'{"old": true}', {'fetched_at': 0})
+        github.cache.get(key)  # now in this process's memory
+
+        # Another process fetches it while this one waits for the lock.
+        asked_at = time.time()
+        caching.TieredCache(self.cache_dir).set(
+                key, u'{"new": true}', {'fetched_at': time.time()})
+        response, _ = github._fetch_upstream(None, url, key, None,
+                                             github.MUTABLE, asked_at)
+        self.assertEquals(u'{"new": true}', response)
+        self.assertEquals([], _Handler.requests)
+
+    def test_pages_from_the_same_time(self):
+        url = self.root + '/repos/danvk/dygraphs/pulls/1/commits?per_page=100'
+        github.fetch_paginated(None, url)
+        # Page 3 alone has expired, but page 1 hasn't, so none is refetched.
+        key = github._cache_key(url + '&page=3')
+        github.cache.set_meta(key, dict(github.cache.get_meta(key),
+                                        fetched_at=0))
+        del _Handler.requests[:]
+        self.assertEquals(6, len(github.fetch_paginated(None, url)))
+        self.assertEquals([], _Handler.requests)
+
+        # Once page 1 is revalidated, so are the others.
+        github.fetch_paginated(None, url, bust_cache=True)
+        self.assertEquals(3, len(_Handler.requests))
+        self.assertTrue(all('if-none-match' in headers
+                            for _, headers in _Handler.requests))
+
+    def test_incomplete_lists(self):
+        url = self.root + '/repos/danvk/dygraphs/pulls/1/commits?per_page=100'
+        with patch.object(_Handler, 'fail_pattern', 'page=2'):
+            self.assertRaises(github.IncompleteList,
+                              github.fetch_paginated, None, url)
+        with patch('github.MAX_PAGES', 2):
+            self.assertRaises(github.IncompleteList,
+                              github.fetch_paginated, None, url, True)
+
+    def test_expire_all_pages(self):
+        with patch('github.GITHUB_API_ROOT', self.root):
+            github.get_pull_request_comments(None, 'danvk', 'dygraphs', 1)
+            self.assertEquals(6, len(_Handler.requests))
+            github.get_pull_request_comments(None, 'danvk', 'dygraphs', 1)
+            self.assertEquals(6, len(_Handler.requests))
+
+            github.expire_cache_for_pull_request_children('danvk', 'dygraphs', 1)
+            comments = github.get_pull_request_comments(None, 'danvk', 'dygraphs', 1)
+        self.assertEquals(6, len(comments['top_level']))
+        self.assertEquals(12, len(_Handler.requests))
+        for _, headers in _Handler.requests[6:]:
+            self.assertIn('if-none-match', headers)
+
+
+_COMPARE_DIFF = u'''diff --git a/README.md b/README.md
+index 1111111..2222222 100644
+--- a/README.md
++++ b/README.md
+@@ -1,1 +1,1 @@
+-caf\u00e9
++caf\u00e9 \u2603
+diff --git a/setup.py b/setup.py
+index 3333333..4444444 100644
+--- a/setup.py
++++ b/setup.py
+@@ -1,1 +1,1 @@
+-import os
++import sys
+'''
+
+
+class FileDiffTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.url = (github.GITHUB_API_ROOT +
+                    '/repos/danvk/dygraphs/compare/abc...def')
+        self.key = github._cache_key(self.url, github.DIFF_HEADERS)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_file_diff_index(self):
+        cache = caching.TieredCache(self.cache_dir)
+        cache.set(self.key, _COMPARE_DIFF, {'fetched_at': 0})
+        with patch('github.cache', cache):
+            readme = github.get_file_diff(None, 'danvk', 'dygraphs',
+                                          'README.md', 'abc', 'def')
+            self.assertTrue(readme.startswith('diff --git a/README.md'))
+            self.assertTrue(readme.endswith(u'\u2603\n'))
+            self.assertEquals(None, github.get_file_diff(
+                    None, 'danvk', 'dygraphs', 'nonexistent', 'abc', 'def'))
+
+        index = cache.get_meta(self.key)['file_index']
+        self.assertEquals(['README.md', 'setup.py'], sorted(index.keys()))
+
+        # A new process reads only the relevant bytes from disk.
+        cache = caching.TieredCache(self.cache_dir)
+        with patch('github.cache', cache), \
+             patch('github._fetch_url', side_effect=AssertionError):
+            setup_py = github.get_file_diff(None, 'danvk', 'dygraphs',
+                                            'setup.py', 'abc', 'def')
+            self.assertEquals(readme, github.get_file_diff(
+                    None, 'danvk', 'dygraphs', 'README.md', 'abc', 'def'))
+        self.assertTrue(setup_py.startswith('diff --git a/setup.py'))
+        self.assertTrue(setup_py.endswith('+import sys\n'))
+        self.assertEquals(0, cache.stats()['memory_hits'])
+
+
+if __name__ == '__main__':
+    unittest.main()
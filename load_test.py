@@ -0,0 +1,251 @@
+'''Replays browsing sessions against the app and reports latency per route.
+
+By default everything runs in this process: a fake github (see
+fake_github.py) with the given latency, error rate and rate limit, and the
+app on a threaded WSGI server which talks to it. Several simulated users then
+run sessions concurrently. Each session is what a reviewer does:
+
+    subscriptions -> open PR counts -> the repo's pulls -> a pull request
+    -> a few of its files (diff, then more context) -> save a draft comment
+    -> check for updates -> publish the draft
+
+To load test a deployed app instead (e.g. under gunicorn), pass --app-url.
+The app must have GITHUB_API_ROOT pointing at "python fake_github.py", run
+with the same --pull-requests, so that the sessions' paths and shas exist.
+
+Usage:
+    python load_test.py [--users=8] [--sessions=40] [--latency=0.05]
+'''
+
+import argparse
+import collections
+import itertools
+import logging
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import requests
+
+import fake_github
+
+# Diffs viewed in each session, and lines of context expanded in each.
+FILES_PER_SESSION = 3
+CONTEXT_LINES = 20
+
+
+def percentile(sorted_values, p):
+    '''The nearest-rank p-th percentile of a sorted list.'''
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[max(0, rank - 1)]
+
+
+class Stats(object):
+    '''Latencies and failures for each route.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = collections.defaultdict(list)
+        self._errors = collections.defaultdict(int)
+
+    def record(self, route, secs, ok):
+        with self._lock:
+            self._latencies[route].append(secs)
+            if not ok:
+                self._errors[route] += 1
+
+    def summary(self, elapsed_secs):
+        '''Returns [(route, requests, errors, req/s, p50, p95, p99)].'''
+        rows = []
+        with self._lock:
+            routes = sorted(self._latencies)
+            everything = sorted(itertools.chain(*self._latencies.values()))
+            for route, latencies in ([(r, sorted(self._latencies[r]))
+                                      for r in routes] +
+                                     [('(all)', everything)]):
+                errors = (sum(self._errors.values()) if route == '(all)'
+                          else self._errors[route])
+                rows.append((route, len(latencies), errors,
+                             len(latencies) / elapsed_secs,
+                             percentile(latencies, 50),
+                             percentile(latencies, 95),
+                             percentile(latencies, 99)))
+        return rows
+
+
+class Session(object):
+    '''One reviewer's visit to a pull request.'''
+    def __init__(self, app_url, pull_request, stats, rng):
+        self._app_url = app_url
+        self._pr = pull_request
+        self._stats = stats
+        self._rng = rng
+        self._http = requests.Session()
+
+    def _request(self, route, method, path, **kwargs):
+        start = time.time()
+        try:
+            r = self._http.request(method, self._app_url + path,
+                                   allow_redirects=False, timeout=120,
+                                   **kwargs)
+            ok = r.status_code < 400
+        except requests.exceptions.RequestException:
+            ok = False
+        self._stats.record(route, time.time() - start, ok)
+
+    def run(self):
+        pr = self._pr
+        repo_path = '/%s/%s' % (pr.owner, pr.repo)
+        pull_path = '%s/pull/%d' % (repo_path, pr.number)
+        base_sha = pr.base_sha
+        head_sha = pr.pull_request['head']['sha']
+
+        self._request('index', 'GET', '/')
+        self._request('open_pull_request_counts', 'POST',
+                      '/open_pull_request_counts',
+                      data={'repo': '%s/%s' % (pr.owner, pr.repo)})
+        self._request('repo', 'GET', repo_path + '/pulls')
+        self._request('pull', 'GET', pull_path)
+
+        paths = self._rng.sample(pr.filenames,
+                                 min(FILES_PER_SESSION, len(pr.filenames)))
+        for path in paths:
+            self._request('file_diff', 'GET', pull_path + '/diff', params={
+                'path': path, 'sha1': base_sha, 'sha2': head_sha})
+            self._request('diff_context', 'GET', repo_path + '/diff_context',
+                          params={'path': path, 'sha': head_sha,
+                                  'left_line': 1, 'right_line': 1,
+                                  'count': CONTEXT_LINES})
+
+        form = {'owner': pr.owner, 'repo': pr.repo,
+                'pull_number': str(pr.number)}
+        self._request('save_draft', 'POST', '/save_draft', data=dict(
+            form, path=paths[0], commit_id=head_sha, line_number='2',
+            body='Comment from the load test'))
+        self._request('check_for_updates', 'POST', '/check_for_updates',
+                      data=dict(form, updated_at=pr.pull_request['updated_at']))
+        self._request('publish_draft_comments', 'POST',
+                      '/publish_draft_comments',
+                      data=dict(form, top_level_comment=''),
+                      headers={'Accept': 'application/json'})
+        self._http.close()
+
+
+def run_sessions(app_url, pull_requests, num_users, num_sessions, seed=0):
+    '''Runs num_sessions sessions on num_users threads.
+
+    Returns (Stats, elapsed seconds).
+    '''
+    stats = Stats()
+    session_ids = itertools.count()
+    lock = threading.Lock()
+
+    def user(rng):
+        while True:
+            with lock:
+                i = next(session_ids)
+            if i >= num_sessions:
+                return
+            pr = pull_requests[i % len(pull_requests)]
+            Session(app_url, pr, stats, rng).run()
+
+    start = time.time()
+    threads = [threading.Thread(target=user, args=(random.Random(seed + i),))
+               for i in xrange(num_users)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return stats, time.time() - start
+
+
+def start_app(github_root, tmp_dir):
+    '''Serves the app on a local port, using the given github API.
+
+    Returns (server, URL).
+    '''
+    os.environ.setdefault('BETTER_PR_CONFIG', 'testing.config')
+    import app
+    import caching
+    import comment_db
+    import github
+    from werkzeug.serving import make_server
+
+    for name in ('', 'github', 'werkzeug'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    # testing.config's fake login has no token, but publishing needs one.
+    app.app.config['FAKE_AUTH'] = {'token': 'load-test', 'login': 'fakelogin'}
+    github.GITHUB_API_ROOT = github_root
+    github.cache = caching.TieredCache(os.path.join(tmp_dir, 'cache'))
+    app.db = comment_db.CommentDb(os.path.join(tmp_dir, 'drafts.sqlite'))
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=8,
+                        help='Number of concurrent simulated users.')
+    parser.add_argument('--sessions', type=int, default=40,
+                        help='Total number of sessions to run.')
+    parser.add_argument('--pull-requests', type=int, default=4,
+                        help='Number of pull requests to spread sessions over.')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds to delay each fake github response.')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of github requests which fail.')
+    parser.add_argument('--rate-limit', type=int, default=None,
+                        help='github requests allowed per token per hour.')
+    parser.add_argument('--app-url', default=None,
+                        help='Load test an app which is already running.')
+    args = parser.parse_args()
+
+    pull_requests = fake_github.synthetic_pull_requests(args.pull_requests)
+    fake = server = tmp_dir = None
+    app_url = args.app_url
+    if not app_url:
+        fake = fake_github.FakeGitHub(pull_requests[0], latency=args.latency,
+                                      error_rate=args.error_rate,
+                                      rate_limit=args.rate_limit)
+        for pr in pull_requests[1:]:
+            fake.add_pull_request(pr)
+        fake.start()
+        tmp_dir = tempfile.mkdtemp()
+        server, app_url = start_app(fake.root, tmp_dir)
+
+    try:
+        stats, elapsed = run_sessions(app_url, pull_requests, args.users,
+                                      args.sessions)
+    finally:
+        if server:
+            import github
+            server.shutdown()
+            github.client.close()
+            fake.stop()
+            shutil.rmtree(tmp_dir)
+
+    print '%d sessions by %d users in %.1fs' % (args.sessions, args.users,
+                                                elapsed)
+    print '%-26s %8s %7s %8s %8s %8s %8s' % (
+            'route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+    for route, n, errors, rate, p50, p95, p99 in stats.summary(elapsed):
+        print '%-26s %8d %7d %8.1f %8.0f %8.0f %8.0f' % (
+                route, n, errors, rate, 1000 * p50, 1000 * p95, 1000 * p99)
+    if fake:
+        num_published = sum(len(pr.review_comments) for pr in pull_requests)
+        print '%d requests to github, %d review comments after publishing' % (
+                len(fake.requests), num_published)
+
+
+if __name__ == '__main__':
+    main()
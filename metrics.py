@@ -0,0 +1,216 @@
+'''Per-request performance instrumentation.
+
+Each request gets a Trace, which counts the work done on its behalf (github
+calls, cache hits and misses, bytes fetched and parsed, ...) and the time
+spent in each stage (waiting on github, parsing, the drafts DB, rendering).
+app.py reports the trace to the browser in a Server-Timing header.
+
+Every count and timing is also added to process-wide counters and histograms,
+which /metrics serves in the Prometheus text format. Each WSGI worker process
+keeps its own totals.
+'''
+
+import bisect
+import functools
+import threading
+import time
+
+import parallel
+
+# Prefix for the names of exported metrics.
+NAMESPACE = 'better_pr'
+
+# Upper bounds (in seconds) of the histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_local = threading.local()
+
+
+class Histogram(object):
+    '''Counts observations falling into each of a fixed set of buckets.'''
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last is for +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        '''Returns [(upper bound, count of observations <= it)].'''
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+            '%s="%s"' % (k, unicode(v).replace('\\', r'\\').replace('"', r'\"'))
+            for k, v in labels)
+
+
+class Registry(object):
+    '''Process-wide counters and histograms.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+
+    def increment(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        '''Returns all metrics in the Prometheus text exposition format.'''
+        lines = []
+        with self._lock:
+            last_name = None
+            for (name, labels), value in sorted(self._counters.items()):
+                name = '%s_%s_total' % (NAMESPACE, name)
+                if name != last_name:
+                    lines.append('# TYPE %s counter' % name)
+                    last_name = name
+                lines.append('%s%s %s' % (name, _format_labels(labels), value))
+            for (name, labels), h in sorted(self._histograms.items()):
+                name = '%s_%s_seconds' % (NAMESPACE, name)
+                if name != last_name:
+                    lines.append('# TYPE %s histogram' % name)
+                    last_name = name
+                for bound, count in h.cumulative_counts():
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(labels + (('le', bound),)), count))
+                lines.append('%s_sum%s %f' % (name, _format_labels(labels), h.sum))
+                lines.append('%s_count%s %d' % (
+                    name, _format_labels(labels), sum(h.counts)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Trace(object):
+    '''The counts and stage timings for a single request.
+
+    Stage times are summed across threads, so stages run concurrently can
+    add up to more than the request's total time.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.counts = {}
+        self.stages = {}  # stage -> [seconds, calls]
+        self._order = []
+
+    def add_count(self, name, n):
+        with self._lock:
+            if name not in self.counts:
+                self._order.append(name)
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, stage, secs):
+        with self._lock:
+            if stage not in self.stages:
+                self._order.append(stage)
+                self.stages[stage] = [0.0, 0]
+            self.stages[stage][0] += secs
+            self.stages[stage][1] += 1
+
+    def server_timing(self, total_secs):
+        '''Formats the trace as a Server-Timing header value.'''
+        entries = []
+        with self._lock:
+            for name in self._order:
+                if name in self.stages:
+                    secs, calls = self.stages[name]
+                    entries.append('%s;dur=%.1f;desc="%d call%s"' % (
+                        name, 1000 * secs, calls, '' if calls == 1 else 's'))
+                else:
+                    entries.append('%s;desc="%d"' % (name, self.counts[name]))
+        entries.append('total;dur=%.1f' % (1000 * total_secs))
+        return ', '.join(entries)
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def _set_trace(trace):
+    _local.trace = trace
+
+
+# github calls made via the parallel module count towards the caller's trace.
+parallel.propagate_context(current_trace, _set_trace)
+
+
+def start_trace():
+    '''Begins collecting a trace for the request on this thread.'''
+    trace = Trace()
+    _set_trace(trace)
+    return trace
+
+
+def finish_trace(endpoint):
+    '''Ends this thread's trace and records the request's duration.
+
+    Returns (trace, total seconds), or (None, None) if there wasn't a trace.
+    '''
+    trace = current_trace()
+    if trace is None:
+        return None, None
+    _set_trace(None)
+    total_secs = time.time() - trace.started_at
+    registry.observe('request', total_secs, endpoint=endpoint or 'unknown')
+    return trace, total_secs
+
+
+def count(name, n=1):
+    '''Adds n to a counter, both for this request and process-wide.'''
+    registry.increment(name, n)
+    trace = current_trace()
+    if trace:
+        trace.add_count(name, n)
+
+
+class timed(object):
+    '''Times a block of code (or a function) as one call to a stage.
+
+        with metrics.timed('render'):
+            ...
+    '''
+    def __init__(self, stage):
+        self._stage = stage
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        secs = time.time() - self._start
+        registry.observe('stage', secs, stage=self._stage)
+        trace = current_trace()
+        if trace:
+            trace.add_time(self._stage, secs)
+
+    def __call__(self, fn):
+        stage = self._stage
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return fn(*args, **kwargs)
+        return wrapper
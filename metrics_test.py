@@ -0,0 +1,62 @@
+import metrics
+import parallel
+import unittest
+from mock import patch
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.patch = patch('metrics.registry', self.registry)
+        self.patch.start()
+
+    def tearDown(self):
+        metrics._set_trace(None)
+        self.patch.stop()
+
+    def test_trace(self):
+        trace = metrics.start_trace()
+        metrics.count('github_requests')
+        metrics.count('github_requests')
+        with metrics.timed('render'):
+            pass
+        self.assertEquals({'github_requests': 2}, trace.counts)
+        self.assertEquals(1, trace.stages['render'][1])
+
+        finished, total_secs = metrics.finish_trace('pull')
+        self.assertIs(trace, finished)
+        self.assertIsNone(metrics.current_trace())
+        header = trace.server_timing(total_secs)
+        self.assertTrue(header.startswith(
+                'github_requests;desc="2", render;dur='), header)
+        self.assertIn('desc="1 call"', header)
+        self.assertIn(', total;dur=', header)
+
+    def test_counts_without_a_trace(self):
+        metrics.count('github_cache_hits', 3)
+        self.assertIn('better_pr_github_cache_hits_total 3\n',
+                      self.registry.render())
+
+    def test_parallel_calls_share_the_trace(self):
+        trace = metrics.start_trace()
+        @metrics.timed('github')
+        def fetch():
+            metrics.count('github_requests')
+        parallel.run_concurrently([fetch] * 5)
+        self.assertEquals(5, trace.counts['github_requests'])
+        self.assertEquals(5, trace.stages['github'][1])
+
+    def test_histogram(self):
+        for secs in (0.001, 0.2, 0.2, 100):
+            self.registry.observe('request', secs, endpoint='pull')
+        lines = self.registry.render().split('\n')
+        self.assertIn('# TYPE better_pr_request_seconds histogram', lines)
+        self.assertIn('better_pr_request_seconds_bucket{endpoint="pull",le="0.005"} 1', lines)
+        self.assertIn('better_pr_request_seconds_bucket{endpoint="pull",le="0.25"} 3', lines)
+        self.assertIn('better_pr_request_seconds_bucket{endpoint="pull",le="+Inf"} 4', lines)
+        self.assertIn('better_pr_request_seconds_count{endpoint="pull"} 4', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
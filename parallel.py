@@ -0,0 +1,113 @@
+'''Helpers for issuing independent github API calls concurrently.
+
+Most of the time spent building a page goes to waiting on api.github.com.
+When several responses don't depend on one another (e.g. the commit list and
+the comments for a pull request), it's much faster to request them at once.
+'''
+
+import logging
+import Queue
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of simultaneous calls made by run_concurrently().
+# This can be set via GITHUB_MAX_CONCURRENCY in the app config.
+MAX_WORKERS = 8
+
+# Queue.get() without a timeout can't be interrupted by Ctrl-C.
+_FOREVER = 1e9
+
+# (capture, restore) function pairs which carry thread-local state from the
+# calling thread into the worker threads, see propagate_context().
+_context_hooks = []
+
+
+class DeadlineExceeded(Exception):
+    '''Raised when concurrent calls don't finish before their deadline.'''
+
+
+def propagate_context(capture, restore):
+    '''Carries some thread-local state into concurrently run calls.
+
+    capture() is called on the calling thread; its result is passed to
+    restore() on each worker thread before it runs any calls.
+    '''
+    _context_hooks.append((capture, restore))
+
+
+def iter_concurrently(thunks, max_workers=None, deadline=None):
+    '''Calls each zero-argument function in thunks, in parallel.
+
+    Yields (index, result) pairs in the order in which the calls finish. If a
+    call raises, its exception is re-raised here and no further calls are
+    started.
+
+    deadline is an absolute time.time() value. If the calls haven't all
+    finished by then, DeadlineExceeded is raised. Calls which are still
+    running are abandoned; calls which haven't started are skipped. The same
+    happens if the caller stops iterating early.
+    '''
+    thunks = list(thunks)
+    if not thunks:
+        return
+    max_workers = max_workers or MAX_WORKERS
+    num_workers = min(max_workers, len(thunks))
+
+    pending = Queue.Queue()
+    for idx in xrange(len(thunks)):
+        pending.put(idx)
+    finished = Queue.Queue()
+    cancelled = threading.Event()
+    context = [(restore, capture()) for capture, restore in _context_hooks]
+
+    def worker():
+        for restore, value in context:
+            restore(value)
+        while not cancelled.is_set():
+            try:
+                idx = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                finished.put((idx, thunks[idx](), None))
+            except Exception:
+                finished.put((idx, None, sys.exc_info()))
+
+    for _ in xrange(num_workers):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    try:
+        for num_done in xrange(len(thunks)):
+            timeout = _FOREVER
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            try:
+                idx, result, error = finished.get(timeout=timeout)
+            except Queue.Empty:
+                remaining = len(thunks) - num_done
+                logger.warn('%d of %d calls missed their deadline',
+                            remaining, len(thunks))
+                raise DeadlineExceeded('%d of %d calls did not finish in time' % (
+                    remaining, len(thunks)))
+            if error:
+                raise error[0], error[1], error[2]
+            yield idx, result
+    finally:
+        cancelled.set()
+
+
+def run_concurrently(thunks, max_workers=None, deadline=None):
+    '''Like iter_concurrently, but returns a list of results.
+
+    The results are in the same order as thunks.
+    '''
+    thunks = list(thunks)
+    results = [None] * len(thunks)
+    for idx, result in iter_concurrently(thunks, max_workers, deadline):
+        results[idx] = result
+    return results
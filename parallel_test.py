@@ -0,0 +1,51 @@
+import parallel
+import threading
+import time
+import unittest
+
+
+class ParallelTestCase(unittest.TestCase):
+
+    def test_results_in_order(self):
+        def slow(x, delay):
+            time.sleep(delay)
+            return x
+        thunks = [lambda: slow(1, 0.05), lambda: slow(2, 0.0), lambda: slow(3, 0.02)]
+        self.assertEquals([1, 2, 3], parallel.run_concurrently(thunks))
+
+    def test_empty(self):
+        self.assertEquals([], parallel.run_concurrently([]))
+
+    def test_runs_concurrently(self):
+        start = time.time()
+        parallel.run_concurrently([lambda: time.sleep(0.1)] * 5, max_workers=5)
+        self.assertLess(time.time() - start, 0.3)
+
+    def test_max_workers(self):
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+        def task():
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+        parallel.run_concurrently([task] * 10, max_workers=3)
+        self.assertEquals(3, peak[0])
+
+    def test_exception_propagates(self):
+        def boom():
+            raise KeyError('boom')
+        with self.assertRaises(KeyError):
+            parallel.run_concurrently([lambda: 1, boom])
+
+    def test_deadline(self):
+        with self.assertRaises(parallel.DeadlineExceeded):
+            parallel.run_concurrently([lambda: time.sleep(1)],
+                                      deadline=time.time() + 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+'''Warms the cache in the background for pages the user is likely to visit.
+
+After viewing a pull request, reviewers almost always click through its files
+in order. Each of those pages is rendered from the file's diff. The
+Prefetcher fetches these on a few background threads so that navigating from
+file to file is served from cache.
+
+Prefetching never competes with pages which a user is waiting on: workers
+pause whenever an interactive request is in progress.
+'''
+
+import Queue
+import itertools
+import logging
+import os
+import threading
+
+import caching
+import github_comments
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+# Number of recently-completed jobs to remember, so they aren't redone.
+_DONE_JOBS = 10000
+
+
+class Prefetcher(object):
+    '''A bounded, de-duplicating priority queue of background jobs.
+
+    Jobs with lower priority values run first. Jobs are identified by a
+    hashable key; a job whose key is already queued (or recently done) is
+    dropped, as are jobs which don't fit in the queue.
+    '''
+    def __init__(self, num_workers=2, max_queue=1000):
+        self._num_workers = num_workers
+        self._queue = Queue.PriorityQueue(max_queue)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._interactive = 0
+        self._pending = set()
+        self._done = caching.LruCache(_DONE_JOBS)
+        self._seq = itertools.count()  # FIFO order for equal priorities
+        self._pid = None
+        self._counts = {
+            'queued': 0,
+            'duplicates': 0,
+            'dropped': 0,
+            'completed': 0,
+            'shed': 0,  # skipped to save the rate limit
+            'errors': 0
+        }
+
+    def begin_interactive(self):
+        '''Pauses prefetching until the matching end_interactive().'''
+        with self._lock:
+            self._interactive += 1
+
+    def end_interactive(self):
+        with self._lock:
+            self._interactive -= 1
+            if self._interactive == 0:
+                self._idle.notify_all()
+
+    def enqueue(self, key, fn, priority=0):
+        '''Schedules fn() to be called in the background.
+
+        Returns True if it was queued, False if it was dropped.
+        '''
+        if not self._num_workers:
+            return False
+        self._ensure_workers()
+        with self._lock:
+            if key in self._pending or self._done.get(key):
+                self._counts['duplicates'] += 1
+                return False
+            try:
+                self._queue.put_nowait((priority, next(self._seq), key, fn))
+            except Queue.Full:
+                self._counts['dropped'] += 1
+                return False
+            self._pending.add(key)
+            self._counts['queued'] += 1
+            return True
+
+    def _ensure_workers(self):
+        # Threads don't survive a fork, so each WSGI worker starts its own.
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        for _ in xrange(self._num_workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def _work(self):
+        while True:
+            _, _, key, fn = self._queue.get()
+            with self._lock:
+                while self._interactive:
+                    self._idle.wait()
+            try:
+                with ratelimit.background():
+                    fn()
+                outcome = 'completed'
+            except ratelimit.RateLimited:
+                outcome = 'shed'
+            except Exception:
+                logger.warn('Prefetch of %s failed', key, exc_info=True)
+                outcome = 'errors'
+            with self._lock:
+                self._pending.discard(key)
+                if outcome != 'shed':  # it can be retried later
+                    self._done.set(key, True)
+                self._counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['pending'] = len(self._pending)
+        return stats
+
+
+# This is replaced using the PREFETCH_* settings in the app config.
+prefetcher = Prefetcher()
+
+
+def prefetch_pull_request_files(token, owner, repo, files, sha1, sha2):
+    '''Warms the cache for each file's diff page, in order.'''
+    for idx, f in enumerate(files):
+        path = f['filename']
+        prefetcher.enqueue(
+                ('diff', owner, repo, path, sha1, sha2),
+                lambda path=path: github_comments.get_parsed_diff(
+                    token, owner, repo, path, sha1, sha2),
+                priority=idx)
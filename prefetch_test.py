@@ -0,0 +1,75 @@
+import prefetch
+import time
+import unittest
+from mock import patch
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out')
+        time.sleep(0.01)
+
+
+class PrefetcherTestCase(unittest.TestCase):
+
+    def test_priority_order(self):
+        p = prefetch.Prefetcher(num_workers=1)
+        calls = []
+        p.begin_interactive()  # hold the worker until everything is queued
+        for key, priority in [('first', -1), ('c', 2), ('a', 0), ('b', 1),
+                              ('a2', 0)]:
+            p.enqueue(key, lambda key=key: calls.append(key), priority)
+        time.sleep(0.05)
+        self.assertEquals([], calls)
+        p.end_interactive()
+
+        _wait_for(lambda: len(calls) == 5)
+        self.assertEquals(['first', 'a', 'a2', 'b', 'c'], calls)
+
+    def test_dedup_and_bound(self):
+        p = prefetch.Prefetcher(num_workers=1, max_queue=2)
+        p.begin_interactive()
+        self.assertTrue(p.enqueue('a', lambda: None))
+        _wait_for(lambda: p._queue.empty())  # the worker is holding 'a'
+        self.assertTrue(p.enqueue('b', lambda: None))
+        self.assertTrue(p.enqueue('c', lambda: None))
+        self.assertFalse(p.enqueue('b', lambda: None))
+        self.assertFalse(p.enqueue('d', lambda: None))
+        p.end_interactive()
+
+        _wait_for(lambda: p.stats()['completed'] == 3)
+        self.assertFalse(p.enqueue('a', lambda: None))  # recently done
+        stats = p.stats()
+        self.assertEquals(3, stats['queued'])
+        self.assertEquals(2, stats['duplicates'])
+        self.assertEquals(1, stats['dropped'])
+        self.assertEquals(0, stats['pending'])
+
+    def test_errors(self):
+        p = prefetch.Prefetcher(num_workers=1)
+        p.enqueue('a', lambda: 1 / 0)
+        _wait_for(lambda: p.stats()['errors'] == 1)
+
+    def test_disabled(self):
+        p = prefetch.Prefetcher(num_workers=0)
+        self.assertFalse(p.enqueue('a', lambda: None))
+
+    def test_prefetch_pull_request_files(self):
+        p = prefetch.Prefetcher(num_workers=1)
+        p.begin_interactive()
+        files = [{'filename': 'new.py', 'status': 'added'},
+                 {'filename': 'old.py', 'status': 'modified'}]
+        with patch('prefetch.prefetcher', p):
+            prefetch.prefetch_pull_request_files(
+                    'token', 'owner', 'repo', files, 'sha1', 'sha2')
+        keys = sorted(p._pending)
+        self.assertEquals([
+            ('diff', 'owner', 'repo', 'new.py', 'sha1', 'sha2'),
+            ('diff', 'owner', 'repo', 'old.py', 'sha1', 'sha2')
+        ], keys)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+'''Tracks and enforces each user's github API budget.
+
+github allows each OAuth token a fixed number of requests per hour (5000 for
+REST). Every response says how many are left (X-RateLimit-Remaining) and when
+the budget resets (X-RateLimit-Reset). github also imposes "secondary" rate
+limits on bursts, which it signals with a 403 or 429 and a Retry-After.
+
+The RateLimiter records these per token and decides whether a request may go
+ahead. Requests are either interactive (someone is waiting on the page) or
+background (prefetching, watching for updates). Background requests are
+shed while the budget is low, so that what's left goes to pages people are
+actually looking at.
+'''
+
+import contextlib
+import hashlib
+import logging
+import threading
+import time
+
+import parallel
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# Background requests are shed once a token has fewer than this many
+# requests left. This can be set via RATE_LIMIT_RESERVE in the app config.
+RESERVE = 500
+
+# Interactive requests wait out a backoff this short, rather than failing.
+# This can be set via RATE_LIMIT_MAX_WAIT_SECS in the app config.
+MAX_WAIT_SECS = 10
+
+# Backoff for secondary rate limits which don't say how long to wait.
+DEFAULT_RETRY_AFTER_SECS = 60
+
+_local = threading.local()
+
+
+class RateLimited(Exception):
+    '''Raised when a request can't be made without exceeding a rate limit.'''
+    def __init__(self, message, retry_at):
+        Exception.__init__(self, message)
+        self.retry_at = retry_at
+
+
+def current_priority():
+    return getattr(_local, 'priority', INTERACTIVE)
+
+
+def _set_priority(priority):
+    _local.priority = priority
+
+
+@contextlib.contextmanager
+def background():
+    '''Marks github requests made in this block as background work.'''
+    old = current_priority()
+    _set_priority(BACKGROUND)
+    try:
+        yield
+    finally:
+        _set_priority(old)
+
+
+# Calls run via the parallel module inherit the caller's priority.
+parallel.propagate_context(current_priority, _set_priority)
+
+
+def fingerprint(token):
+    '''Identifies a token in logs and status pages without revealing it.'''
+    if not token:
+        return 'anonymous'
+    return hashlib.sha1(token).hexdigest()[:8]
+
+
+class _Budget(object):
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = None  # epoch seconds
+        self.blocked_until = 0
+
+    def to_dict(self):
+        return {
+            'limit': self.limit,
+            'remaining': self.remaining,
+            'reset': self.reset,
+            'blocked_until': self.blocked_until or None
+        }
+
+
+class RateLimiter(object):
+    '''Per-token budget accounting and admission control.
+
+    Budgets are kept separately for each of github's rate limit resources
+    ('core' for REST, 'graphql', ...).
+    '''
+    def __init__(self, reserve=None, max_wait_secs=None):
+        self._reserve = RESERVE if reserve is None else reserve
+        self._max_wait_secs = (MAX_WAIT_SECS if max_wait_secs is None
+                               else max_wait_secs)
+        self._lock = threading.Lock()
+        self._budgets = {}
+        self._counts = {'waited': 0, 'shed': 0, 'rate_limited': 0}
+
+    def _budget(self, token, resource):
+        key = (fingerprint(token), resource)
+        if key not in self._budgets:
+            self._budgets[key] = _Budget()
+        return self._budgets[key]
+
+    def acquire(self, token, resource='core'):
+        '''Blocks until a request may be made, or raises RateLimited.'''
+        priority = current_priority()
+        now = time.time()
+        with self._lock:
+            budget = self._budget(token, resource)
+            retry_at = budget.blocked_until
+            if (budget.remaining is not None and budget.reset > now and
+                    budget.remaining <= 0):
+                retry_at = max(retry_at, budget.reset)
+            low = (budget.remaining is not None and budget.reset > now and
+                   budget.remaining < self._reserve)
+            if retry_at > now and (priority == BACKGROUND or
+                                   retry_at - now > self._max_wait_secs):
+                self._counts['shed'] += 1
+                raise RateLimited('github rate limit exceeded', retry_at)
+            if low and priority == BACKGROUND:
+                self._counts['shed'] += 1
+                raise RateLimited('Saving the rest of the github rate limit '
+                                  'for interactive use', budget.reset)
+            if retry_at > now:
+                self._counts['waited'] += 1
+        if retry_at > now:
+            logger.info('Waiting %.1fs for the github rate limit',
+                        retry_at - now)
+            time.sleep(retry_at - now)
+
+    def record(self, token, response):
+        '''Updates a budget from a response's headers.
+
+        Returns False if the response says the request was rate limited.
+        '''
+        headers = response.headers
+        resource = headers.get('X-RateLimit-Resource', 'core')
+        now = time.time()
+        with self._lock:
+            budget = self._budget(token, resource)
+            try:
+                if headers.get('X-RateLimit-Remaining') is not None:
+                    budget.remaining = int(headers['X-RateLimit-Remaining'])
+                    budget.limit = int(headers['X-RateLimit-Limit'])
+                    budget.reset = int(headers['X-RateLimit-Reset'])
+            except (KeyError, ValueError):
+                logger.warn('Malformed rate limit headers: %s', headers)
+
+            if response.status_code not in (403, 429):
+                budget.blocked_until = 0
+                return True
+            retry_after = headers.get('Retry-After')
+            if retry_after is not None:
+                try:
+                    budget.blocked_until = now + int(retry_after)
+                except ValueError:
+                    budget.blocked_until = now + DEFAULT_RETRY_AFTER_SECS
+            elif budget.remaining == 0:
+                budget.blocked_until = budget.reset
+            elif response.status_code == 429:
+                budget.blocked_until = now + DEFAULT_RETRY_AFTER_SECS
+            else:
+                return True  # an ordinary 403, e.g. no access to the repo
+            self._counts['rate_limited'] += 1
+        logger.warn('Rate limited by github until %s',
+                    time.ctime(budget.blocked_until))
+        return False
+
+    def budget(self, token):
+        '''Returns {resource: budget dict} for a token.'''
+        fp = fingerprint(token)
+        with self._lock:
+            return dict((resource, b.to_dict())
+                        for (f, resource), b in self._budgets.iteritems()
+                        if f == fp)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['tokens'] = len(set(f for f, _ in self._budgets))
+        return stats
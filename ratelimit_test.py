@@ -0,0 +1,88 @@
+import parallel
+import ratelimit
+import time
+import unittest
+from mock import patch, MagicMock
+
+
+def _response(status_code=200, remaining=4000, reset=None, **headers):
+    r = MagicMock()
+    r.status_code = status_code
+    r.headers = {
+        'X-RateLimit-Limit': '5000',
+        'X-RateLimit-Remaining': str(remaining),
+        'X-RateLimit-Reset': str(int(reset or time.time() + 3600))
+    }
+    r.headers.update(headers)
+    return r
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = ratelimit.RateLimiter(reserve=100, max_wait_secs=1)
+
+    def test_budget(self):
+        self.assertTrue(self.limiter.record('token', _response(remaining=4000)))
+        budget = self.limiter.budget('token')['core']
+        self.assertEquals(4000, budget['remaining'])
+        self.assertEquals(5000, budget['limit'])
+        self.assertEquals({}, self.limiter.budget('other'))
+
+    def test_reserve_is_kept_for_interactive_use(self):
+        self.limiter.record('token', _response(remaining=50))
+        self.limiter.acquire('token')
+        with ratelimit.background():
+            self.assertRaises(ratelimit.RateLimited,
+                              self.limiter.acquire, 'token')
+            self.limiter.acquire('other')  # a separate budget
+        self.assertEquals(1, self.limiter.stats()['shed'])
+
+    def test_exhausted(self):
+        self.assertFalse(self.limiter.record(
+                'token', _response(status_code=403, remaining=0)))
+        self.assertRaises(ratelimit.RateLimited, self.limiter.acquire, 'token')
+
+        # Once the budget resets, requests can go ahead again.
+        self.limiter.record('token', _response(remaining=0, reset=time.time() - 1))
+        self.limiter.acquire('token')
+
+    def test_secondary_rate_limit(self):
+        self.assertFalse(self.limiter.record(
+                'token', _response(status_code=403, **{'Retry-After': '0'})))
+        with patch('time.sleep'):
+            self.limiter.acquire('token')  # a short wait is waited out
+        self.assertEquals(1, self.limiter.stats()['rate_limited'])
+
+        self.limiter.record('token', _response(status_code=429,
+                                               **{'Retry-After': '60'}))
+        self.assertRaises(ratelimit.RateLimited, self.limiter.acquire, 'token')
+
+    def test_plain_forbidden(self):
+        self.assertTrue(self.limiter.record('token', _response(status_code=403)))
+        self.limiter.acquire('token')
+
+    def test_resources(self):
+        self.limiter.record('token', _response(
+                remaining=0, status_code=403,
+                **{'X-RateLimit-Resource': 'graphql'}))
+        self.limiter.acquire('token')
+        self.assertRaises(ratelimit.RateLimited,
+                          self.limiter.acquire, 'token', 'graphql')
+
+    def test_priority_propagates(self):
+        self.assertEquals(ratelimit.INTERACTIVE, ratelimit.current_priority())
+        with ratelimit.background():
+            priorities = parallel.run_concurrently(
+                    [ratelimit.current_priority] * 3)
+        self.assertEquals([ratelimit.BACKGROUND] * 3, priorities)
+        self.assertEquals(ratelimit.INTERACTIVE, ratelimit.current_priority())
+
+    def test_fingerprint(self):
+        self.assertEquals('anonymous', ratelimit.fingerprint(None))
+        self.assertEquals(8, len(ratelimit.fingerprint('secret-token')))
+        self.assertNotIn('secret', ratelimit.fingerprint('secret-token'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+'''Renders a file's diff as side-by-side rows, from github's unified diff.
+
+Only the lines in the diff's hunks are shown. The unchanged lines between
+hunks are collapsed into "skip" rows, which the page can expand by asking for
+those lines (see context_rows) rather than downloading both whole files.
+
+Each row is a dict with a 'type' of 'equal', 'replace', 'delete', 'insert'
+or 'skip'. Other rows have a 'left' and 'right' side, each of which is None
+or {'line': line number, 'segments': [(text, css class or None)]}. Skip rows
+instead have the first hidden 'left_line' and 'right_line', and a 'count'
+of hidden lines (None if they run to the end of the file).
+'''
+
+import difflib
+import itertools
+
+import github_comments
+
+# Lines shown each time a collapsed region is expanded.
+EXPAND_LINES = 100
+
+# Changed lines are diffed character by character if they're at most this
+# long and at least this similar (see difflib.SequenceMatcher.ratio).
+CHAR_DIFF_MAX_LENGTH = 1000
+CHAR_DIFF_MIN_RATIO = 0.5
+
+_CHAR_CLASSES = {
+    'delete': ('char-delete', None),
+    'insert': (None, 'char-insert'),
+    'replace': ('char-replace', 'char-replace')
+}
+
+
+def _side(line_number, segments):
+    return {'line': line_number, 'segments': segments}
+
+
+def _char_diff(left, right):
+    '''Returns segments for each side of a changed line, or None.'''
+    if max(len(left), len(right)) > CHAR_DIFF_MAX_LENGTH:
+        return None
+    sm = difflib.SequenceMatcher(None, left, right, autojunk=False)
+    if sm.ratio() < CHAR_DIFF_MIN_RATIO:
+        return None
+    left_segments, right_segments = [], []
+    for op, i1, i2, j1, j2 in sm.get_opcodes():
+        left_class, right_class = _CHAR_CLASSES.get(op, (None, None))
+        if i2 > i1:
+            left_segments.append((left[i1:i2], left_class))
+        if j2 > j1:
+            right_segments.append((right[j1:j2], right_class))
+    return left_segments, right_segments
+
+
+def _change_rows(deleted, inserted):
+    '''Pairs up a run of deleted lines with the inserted lines after it.
+
+    Each of deleted and inserted is a list of (line number, text).
+    '''
+    rows = []
+    for i in xrange(max(len(deleted), len(inserted))):
+        left = deleted[i] if i < len(deleted) else None
+        right = inserted[i] if i < len(inserted) else None
+        if left and right:
+            segments = _char_diff(left[1], right[1]) or (
+                    [(left[1], None)], [(right[1], None)])
+            rows.append({'type': 'replace',
+                         'left': _side(left[0], segments[0]),
+                         'right': _side(right[0], segments[1])})
+        elif left:
+            rows.append({'type': 'delete',
+                         'left': _side(left[0], [(left[1], None)]),
+                         'right': None})
+        else:
+            rows.append({'type': 'insert',
+                         'left': None,
+                         'right': _side(right[0], [(right[1], None)])})
+    return rows
+
+
+def _skip_row(left_line, right_line, count):
+    return {'type': 'skip', 'left_line': left_line, 'right_line': right_line,
+            'count': count}
+
+
+def rows_for_diff(parsed_diff):
+    '''Returns the rows for a github_comments.ParsedDiff.'''
+    rows = []
+    # The last line number shown on each side.
+    left_line = right_line = 0
+    for first, last in parsed_diff.hunks:
+        m = github_comments.DIFF_HUNK_HEADER_RE.match(parsed_diff.lines[first])
+        hunk_left, hunk_right = int(m.group(1)), int(m.group(2))
+        hidden = min(hunk_left - 1 - left_line, hunk_right - 1 - right_line)
+        if hidden > 0:
+            rows.append(_skip_row(left_line + 1, right_line + 1, hidden))
+
+        deleted, inserted = [], []
+        for position in xrange(first + 1, last + 1):
+            diff_line = parsed_diff.lines[position]
+            left = parsed_diff.left_line_numbers[position]
+            right = parsed_diff.right_line_numbers[position]
+            if left is not None and right is not None:
+                rows.extend(_change_rows(deleted, inserted))
+                deleted, inserted = [], []
+                rows.append({'type': 'equal',
+                             'left': _side(left, [(diff_line[1:], None)]),
+                             'right': _side(right, [(diff_line[1:], None)])})
+            elif left is not None:
+                if inserted:  # a new run of changes
+                    rows.extend(_change_rows(deleted, inserted))
+                    deleted, inserted = [], []
+                deleted.append((left, diff_line[1:]))
+            elif right is not None:
+                inserted.append((right, diff_line[1:]))
+            left_line = left or left_line
+            right_line = right or right_line
+        rows.extend(_change_rows(deleted, inserted))
+
+    # We don't know how long the file is, so there may be nothing more to
+    # show. There's certainly nothing if the file was added or deleted (its
+    # hunk starts at line 0 on the empty side) or its end is in the diff.
+    lines = parsed_diff.lines
+    if (rows and left_line and right_line and
+            not (lines and lines[-1].startswith('\\'))):
+        rows.append(_skip_row(left_line + 1, right_line + 1, None))
+    return rows
+
+
+def context_rows(lines, left_line, right_line, count=None,
+                 max_lines=EXPAND_LINES):
+    '''Returns rows for some of the unchanged lines hidden by a skip row.
+
+    lines iterates over the lines of the file on the right side of the diff,
+    without their newlines; only as much of it as is needed is read. If more
+    than max_lines lines are hidden, the rest stay behind a new skip row.
+    '''
+    wanted = max_lines if count is None else min(count, max_lines)
+    # Read one line more than we show, to see whether there's more to come.
+    window = list(itertools.islice(lines, right_line - 1,
+                                   right_line + wanted))
+    rows = []
+    for i, line in enumerate(window[:wanted]):
+        text = [(line, None)]
+        rows.append({'type': 'equal',
+                     'left': _side(left_line + i, text),
+                     'right': _side(right_line + i, text)})
+    shown = len(rows)
+    if len(window) > wanted and (count is None or count > shown):
+        rows.append(_skip_row(left_line + shown, right_line + shown,
+                              None if count is None else count - shown))
+    return rows
@@ -0,0 +1,94 @@
+import github_comments
+import side_by_side
+import unittest
+
+
+def _parse(diff):
+    return github_comments.ParsedDiff.from_diff(diff)
+
+
+def _summary(rows):
+    '''Each row as (type, left line, right line), or (skip, left, right, n).'''
+    result = []
+    for row in rows:
+        if row['type'] == 'skip':
+            result.append(('skip', row['left_line'], row['right_line'],
+                           row['count']))
+        else:
+            result.append((row['type'],
+                           row['left'] and row['left']['line'],
+                           row['right'] and row['right']['line']))
+    return result
+
+
+class SideBySideTestCase(unittest.TestCase):
+
+    def test_small_diff(self):
+        rows = side_by_side.rows_for_diff(
+                _parse(open('testdata/small-inline.diff.txt').read()))
+        self.assertEquals([
+            ('skip', 1, 1, 29),
+            ('equal', 30, 30), ('equal', 31, 31), ('equal', 32, 32),
+            ('insert', None, 33),
+            ('equal', 33, 34), ('equal', 34, 35), ('equal', 35, 36),
+            ('skip', 36, 37, None)
+        ], _summary(rows))
+        self.assertEquals(
+                [('  <script type="text/javascript" src="../tests/fill_step_plot.js"></script>', None)],
+                rows[4]['right']['segments'])
+
+    def test_file_creation(self):
+        rows = side_by_side.rows_for_diff(
+                _parse(open('testdata/file-creation.diff.txt').read()))
+        self.assertEquals(59, len(rows))
+        self.assertEquals([('insert', None, 1), ('insert', None, 59)],
+                          _summary([rows[0], rows[-1]]))
+
+    def test_changes_and_gaps(self):
+        rows = side_by_side.rows_for_diff(_parse('\n'.join([
+            '@@ -1,3 +1,3 @@',
+            ' a',
+            '-def f(x):',
+            '+def f(x, y):',
+            ' b',
+            '@@ -20,4 +20,3 @@',
+            '-c',
+            '-d',
+            '+e',
+            ' f',
+            ' g',
+            '\\ No newline at end of file'
+        ])))
+        self.assertEquals([
+            ('equal', 1, 1), ('replace', 2, 2), ('equal', 3, 3),
+            ('skip', 4, 4, 16),
+            ('replace', 20, 20), ('delete', 21, None),
+            ('equal', 22, 21), ('equal', 23, 22)
+        ], _summary(rows))
+        # Similar lines are diffed character by character.
+        self.assertEquals([('def f(x', None), ('):', None)],
+                          rows[1]['left']['segments'])
+        self.assertEquals([('def f(x', None), (', y', 'char-insert'),
+                           ('):', None)],
+                          rows[1]['right']['segments'])
+        # ... but dissimilar ones aren't.
+        self.assertEquals([('e', None)], rows[4]['right']['segments'])
+
+    def test_context_rows(self):
+        contents = ['line %d' % i for i in xrange(1, 11)]
+        rows = side_by_side.context_rows(iter(contents), 2, 3, 4)
+        self.assertEquals([('equal', 2, 3), ('equal', 3, 4), ('equal', 4, 5),
+                           ('equal', 5, 6)], _summary(rows))
+        self.assertEquals([('line 3', None)], rows[0]['right']['segments'])
+
+        # Runs to the end of the file, a few lines at a time.
+        rows = side_by_side.context_rows(iter(contents), 6, 7, max_lines=3)
+        self.assertEquals([('equal', 6, 7), ('equal', 7, 8), ('equal', 8, 9),
+                           ('skip', 9, 10, None)], _summary(rows))
+        rows = side_by_side.context_rows(iter(contents), 9, 10, max_lines=3)
+        self.assertEquals([('equal', 9, 10)], _summary(rows))
+        self.assertEquals([], side_by_side.context_rows(iter(contents), 10, 11))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,10 @@
-// Render the diff using jsdifflib. Also attaches comments.
-function displayDiffs(before_ref, after_ref, baseTxt, afterTxt) {
-  var diffDiv = renderDiff(baseTxt, afterTxt);
+// Comments on lines which are collapsed, and so can't be shown yet.
+var hiddenComments = [];
 
-  $('#thediff').append(diffDiv);
+// Attaches comments to the diff, which the server rendered.
+function displayDiffs(before_ref, after_ref) {
+  var diffDiv = $('#thediff .diff').get(0);
+  if (!diffDiv) return;
 
   var comments = _.filter(diff_comments, function(comment) {
       return (comment.original_commit_id == after_ref ||
@@ -11,11 +13,14 @@ function displayDiffs(before_ref, after_ref, baseTxt, afterTxt) {
   });
 
   comments.forEach(function(x) {
-    return attachComment(before_ref, after_ref, diffDiv, x);
+    if (!attachComment(before_ref, after_ref, diffDiv, x)) {
+      hiddenComments.push(x);
+    }
   });
 }
 
 // Creates a DOM element for the comment and attaches it appropriately.
+// Returns false if its line isn't on the page.
 function attachComment(before_ref, after_ref, diffDiv, comment) {
   var pos = parseDiffPosition(comment.diff_hunk, comment.position_in_diff_hunk);
   if (comment.original_commit_id == before_ref) {
@@ -25,7 +30,36 @@ function attachComment(before_ref, after_ref, diffDiv, comment) {
   comment.line_number = pos.lineNumber;
 
   var lineEl = findDomElementForPosition(diffDiv, pos);
+  if (!lineEl) return false;
   $(lineEl).append(renderComment(comment));
+  return true;
+}
+
+// User clicked "Show N lines" on a collapsed part of the diff. Fetch just
+// those lines from the server, and show any comments on them.
+function handleExpandContext(e) {
+  e.preventDefault();
+  var $skip = $(this).closest('td.skip');
+  var $row = $skip.closest('tr');
+  $.get(context_url, {
+    path: path,
+    sha: sha2,
+    left_line: $skip.data('left-line'),
+    right_line: $skip.data('right-line'),
+    count: $skip.data('count')
+  }).done(function(html) {
+    $row.replaceWith(html);
+    var diffDiv = $('#thediff .diff').get(0);
+    var comments = hiddenComments;
+    hiddenComments = [];
+    comments.forEach(function(x) {
+      if (!attachComment(sha1, sha2, diffDiv, x)) {
+        hiddenComments.push(x);
+      }
+    });
+  }).fail(function() {
+    alert("Unable to show more of the file!");
+  });
 }
 
 // Adds a new, editable comment box to the given position.
@@ -110,7 +144,10 @@ function handleDblClick(e) {
 function handleSaveComment(e) {
   var $comment = $(this).parent('.inline-editable-comment');
   var lineNumber = $comment.data('lineNumber');
-  var commitId = $comment.data('onLeft') ? sha1 : sha2;
+  // github places comments on the diff from the base to their commit. So a
+  // comment on the base itself goes on the left side of the diff to sha2.
+  var onLeft = $comment.data('onLeft') && sha1 == base_sha;
+  var commitId = ($comment.data('onLeft') && !onLeft) ? sha1 : sha2;
   var inReplyTo = $comment.data('inReplyTo');
   var body = $comment.find('textarea').val();
 
@@ -125,6 +162,7 @@ function handleSaveComment(e) {
       path: path,
       commit_id: commitId,
       line_number: lineNumber,
+      on_left: onLeft,
       in_reply_to: inReplyTo,
       body: body,
     }
@@ -154,6 +192,7 @@ function attachHandlers() {
     .on('keydown', handleKeyPress)
     .on('dblclick', '.diff td, .diff th', handleDblClick)
     .on('click', '.save-comment', handleSaveComment)
+    .on('click', '.diff td.skip a', handleExpandContext)
     .on('click', '.discard-comment', function(e) {
       // TODO(danvk): save draft comment at this location in case the
       // "discard" was an accident.
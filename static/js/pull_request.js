@@ -107,45 +107,6 @@ function collapseQuotes(el) {
 }
 
 
-/**
- * Display the diff for a single file.
- * @param {string} contentsBefore
- * @param {string} contentsAfter
- * @param {!HTMLDivElement} An unattached div containing the rendered diff.
- */
-function renderDiff(contentsBefore, contentsAfter) {
-  var diffDiv = $('<div class="diff"></div>').get(0);
-
-  // From https://github.com/cemerick/jsdifflib
-  var baseLines = difflib.stringAsLines(contentsBefore);
-  var afterLines = difflib.stringAsLines(contentsAfter);
-
-  // create a SequenceMatcher instance that diffs the two sets of lines
-  var sm = new difflib.SequenceMatcher(baseLines, afterLines);
-
-  // get the opcodes from the SequenceMatcher instance
-  // opcodes is a list of 3-tuples describing what changes should be made to the base text
-  // in order to yield the new text
-  var opcodes = sm.get_opcodes();
-  var contextSize = 10;
-
-  // build the diff view and add it to the current DOM
-  diffDiv.appendChild(diffview.buildView({
-      baseTextLines: baseLines,
-      newTextLines: afterLines,
-      opcodes: opcodes,
-      // set the display titles for each resource
-      baseTextName: "Before",
-      newTextName: "After",
-      contextSize: contextSize,
-      viewType: 0,  // i.e. two column rather than inline.
-      characterDiffs: true
-  }));
-
-  return diffDiv;
-}
-
-
 /**
  * Find the diff DOM element corresponding to a comment.
  * @param {!Element} diffEl Element containing the rendered two-column diff.
@@ -218,10 +179,25 @@ function renderComment(comment) {
 
 
 /**
- * Check for updates to the current pull request.
+ * Listen for updates to the current pull request.
  * Displays a "please reload" message if any is found.
  */
 function checkForUpdates(owner, repo, pull_number, updated_at) {
+  if (!window.EventSource) {
+    pollForUpdates(owner, repo, pull_number, updated_at);
+    return;
+  }
+  var url = '/' + owner + '/' + repo + '/pull/' + pull_number + '/events?' +
+      $.param({updated_at: updated_at});
+  var source = new EventSource(url);
+  source.addEventListener('updated', function() {
+    $('#refresh-update-available').show();
+    source.close();
+  });
+}
+
+// Fallback for browsers without EventSource: asks once.
+function pollForUpdates(owner, repo, pull_number, updated_at) {
   $.post('/check_for_updates', {
     'owner': owner,
     'repo': repo,
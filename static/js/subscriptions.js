@@ -8,24 +8,53 @@ function renderPullRequest(pr) {
   return $prEl.get(0);
 }
 
+function renderPullRequestCount(el, response, ownPullRequestsEl) {
+  var count = response.count;
+  if (count) {
+    $(el).find('.pr-count').text(count + ' open pull request' + (count == 1 ? '' : 's'));
+  } else {
+    $(el).find('.repo-data').empty();
+  }
+
+  if (response.own) {
+    $.each(response.own, function(_, pr) {
+      $(ownPullRequestsEl).append(renderPullRequest(pr));
+    });
+  }
+}
+
+// Fetches the counts for all repos in one request. The server streams back
+// one JSON object per line, so each repo is filled in as soon as it's ready.
 function addPullRequestCounts(followedReposEl, ownPullRequestsEl) {
+  var repoEls = {};
+  var params = [];
   $(followedReposEl).find('li').each(function(_, el) {
-    var owner = $(el).attr('owner');
-    var repo = $(el).attr('repo');
-    $.post('/count_open_pull_requests', { owner: owner, repo: repo })
-      .success(function(response) {
-        var count = response.count;
-        if (count) {
-          $(el).find('.pr-count').text(count + ' open pull request' + (count == 1 ? '' : 's'));
-        } else {
-          $(el).find('.repo-data').empty();
-        }
-
-        if (response.own) {
-          $.each(response.own, function(_, pr) {
-            $(ownPullRequestsEl).append(renderPullRequest(pr));
-          });
-        }
-      });
+    var fullName = $(el).attr('owner') + '/' + $(el).attr('repo');
+    repoEls[fullName] = el;
+    params.push({name: 'repo', value: fullName});
   });
+  if (!params.length) return;
+
+  var xhr = new XMLHttpRequest();
+  var consumed = 0;
+  var processLines = function() {
+    var text = xhr.responseText;
+    var end = text.lastIndexOf('\n') + 1;
+    if (end <= consumed) return;
+    var lines = text.substring(consumed, end).split('\n');
+    consumed = end;
+    $.each(lines, function(_, line) {
+      if (!line) return;
+      var response = JSON.parse(line);
+      var el = repoEls[response.owner + '/' + response.repo];
+      if (el && !response.error) {
+        renderPullRequestCount(el, response, ownPullRequestsEl);
+      }
+    });
+  };
+  xhr.onprogress = processLines;
+  xhr.onload = processLines;
+  xhr.open('POST', '/open_pull_request_counts');
+  xhr.setRequestHeader('Content-Type', 'application/x-www-form-urlencoded');
+  xhr.send($.param(params));
 }
@@ -0,0 +1,172 @@
+'''Tells open pull request pages when the pull request changes.
+
+Every page showing a pull request used to ask github whether it had changed.
+Instead, pages subscribe to a server-sent event stream (see app.py). All the
+subscribers for one pull request share a single PullRequestWatcher, which
+polls github once per interval and broadcasts to each of them. The watcher
+stops once nobody is listening.
+
+With webhooks set up, github reports each change (see webhooks.py), so the
+watchers don't poll at all.
+'''
+
+import Queue
+import logging
+import threading
+
+import github
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+# How often each watcher asks github about its pull request.
+# This can be set via WATCH_INTERVAL_SECS in the app config.
+POLL_INTERVAL_SECS = 30
+
+
+class Subscription(object):
+    '''One listener's view of a PullRequestWatcher.'''
+    def __init__(self, key, token, updated_at):
+        self.key = key
+        self.token = token
+        self.updated_at = updated_at
+        self._events = Queue.Queue()
+
+    def put(self, event):
+        self._events.put(event)
+
+    def get(self, timeout):
+        '''Returns the next event, or None if there isn't one in time.'''
+        try:
+            return self._events.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+
+class PullRequestWatcher(object):
+    '''Polls github for changes to one pull request.'''
+    def __init__(self, owner, repo, number, interval, webhooks_enabled=False):
+        self.owner = owner
+        self.repo = repo
+        self.number = number
+        self._interval = interval
+        self._webhooks_enabled = webhooks_enabled
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._updated_at = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._webhooks_enabled:
+            return  # changes are reported via updated()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def add(self, subscription):
+        with self._lock:
+            self._subscribers.append(subscription)
+            updated_at = self._updated_at
+        # The page may have been rendered from an older copy.
+        if updated_at and updated_at > subscription.updated_at:
+            subscription.put({'updated_at': updated_at})
+
+    def remove(self, subscription):
+        '''Returns the number of remaining subscribers.'''
+        with self._lock:
+            self._subscribers.remove(subscription)
+            return len(self._subscribers)
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                with ratelimit.background():
+                    self.poll()
+            except ratelimit.RateLimited:
+                logger.info('Skipping update check for %s/%s#%s to save the '
+                            'rate limit', self.owner, self.repo, self.number)
+            except Exception:
+                logger.warn('Unable to check %s/%s#%s for updates', self.owner,
+                            self.repo, self.number, exc_info=True)
+
+    def poll(self):
+        with self._lock:
+            if not self._subscribers:
+                return
+            # Any subscriber's token will do; use the newest.
+            token = self._subscribers[-1].token
+        # Webhooks invalidate the cache whenever the PR changes, so there's
+        # no need to ask github.
+        pr = github.get_pull_request(token, self.owner, self.repo, self.number,
+                                     bust_cache=not self._webhooks_enabled)
+        if pr:
+            self.updated(pr['updated_at'])
+
+    def updated(self, updated_at):
+        '''Tells subscribers about a change, if it's news to them.'''
+        with self._lock:
+            if self._updated_at and updated_at <= self._updated_at:
+                return
+            self._updated_at = updated_at
+            news = [s for s in self._subscribers if updated_at > s.updated_at]
+        if news:
+            # Invalidate associated RPCs: commit list, comments
+            github.expire_cache_for_pull_request_children(
+                    self.owner, self.repo, self.number)
+        for subscription in news:
+            subscription.put({'updated_at': updated_at})
+
+
+class WatcherRegistry(object):
+    '''Shares one PullRequestWatcher between everyone watching a PR.'''
+    def __init__(self, interval=None, webhooks_enabled=False):
+        self._interval = interval or POLL_INTERVAL_SECS
+        self._webhooks_enabled = webhooks_enabled
+        self._lock = threading.Lock()
+        self._watchers = {}
+
+    def subscribe(self, token, owner, repo, number, updated_at):
+        '''Starts listening for changes made after updated_at.'''
+        key = (owner, repo, unicode(number))
+        subscription = Subscription(key, token, updated_at)
+        with self._lock:
+            watcher = self._watchers.get(key)
+            if watcher is None:
+                watcher = PullRequestWatcher(owner, repo, number,
+                                             self._interval,
+                                             self._webhooks_enabled)
+                self._watchers[key] = watcher
+                watcher.start()
+            watcher.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            watcher = self._watchers.get(subscription.key)
+            if watcher and not watcher.remove(subscription):
+                watcher.stop()
+                del self._watchers[subscription.key]
+
+    def notify(self, owner, repo, number, updated_at):
+        '''Reports a change learned some other way, e.g. via a webhook.'''
+        with self._lock:
+            watcher = self._watchers.get((owner, repo, unicode(number)))
+        if watcher:
+            watcher.updated(updated_at)
+
+    def stats(self):
+        with self._lock:
+            watchers = self._watchers.values()
+        return {
+            'watchers': len(watchers),
+            'subscribers': sum(len(w._subscribers) for w in watchers)
+        }
+
+
+# This is replaced using WATCH_INTERVAL_SECS and GITHUB_WEBHOOK_SECRET in the
+# app config.
+registry = WatcherRegistry()
@@ -0,0 +1,115 @@
+import unittest
+import watchers
+import webhooks
+from mock import patch, MagicMock
+
+
+class WatcherRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.get_pull_request = MagicMock(
+                return_value={'updated_at': '2014-07-01T12:00:00Z'})
+        self.patches = [
+            patch('github.get_pull_request', self.get_pull_request),
+            patch('github.expire_cache_for_pull_request_children', MagicMock())
+        ]
+        for p in self.patches:
+            p.start()
+        # A long interval, so that the tests drive polling themselves.
+        self.registry = watchers.WatcherRegistry(interval=3600)
+
+    def tearDown(self):
+        for watcher in self.registry._watchers.values():
+            watcher.stop()
+            if watcher._thread:
+                watcher._thread.join()
+        for p in reversed(self.patches):
+            p.stop()
+
+    def _watcher(self):
+        return self.registry._watchers[('danvk', 'dygraphs', u'1')]
+
+    def test_one_poll_for_all_subscribers(self):
+        subs = [self.registry.subscribe('token%d' % i, 'danvk', 'dygraphs', 1,
+                                        '2014-07-01T12:00:00Z')
+                for i in xrange(10)]
+        self.assertEquals({'watchers': 1, 'subscribers': 10},
+                          self.registry.stats())
+
+        watcher = self._watcher()
+        watcher.poll()
+        self.assertEquals(1, self.get_pull_request.call_count)
+        self.assertEquals(None, subs[0].get(timeout=0))  # no change yet
+
+        self.get_pull_request.return_value = {'updated_at': '2014-07-02T12:00:00Z'}
+        watcher.poll()
+        self.assertEquals(2, self.get_pull_request.call_count)
+        for sub in subs:
+            self.assertEquals({'updated_at': '2014-07-02T12:00:00Z'},
+                              sub.get(timeout=0))
+
+        # Newcomers with an out-of-date page hear about it right away.
+        late = self.registry.subscribe('token', 'danvk', 'dygraphs', 1,
+                                       '2014-07-01T12:00:00Z')
+        self.assertEquals({'updated_at': '2014-07-02T12:00:00Z'},
+                          late.get(timeout=0))
+
+    def test_stops_when_nobody_is_listening(self):
+        a = self.registry.subscribe('a', 'danvk', 'dygraphs', 1, '')
+        b = self.registry.subscribe('b', 'danvk', 'dygraphs', 1, '')
+        watcher = self._watcher()
+        self.registry.unsubscribe(a)
+        self.assertFalse(watcher._stopped.is_set())
+        self.registry.unsubscribe(b)
+        self.assertTrue(watcher._stopped.is_set())
+        self.assertEquals({'watchers': 0, 'subscribers': 0},
+                          self.registry.stats())
+
+    def test_notify(self):
+        sub = self.registry.subscribe('token', 'danvk', 'dygraphs', 1,
+                                      '2014-07-01T12:00:00Z')
+        self.registry.notify('danvk', 'dygraphs', 1, '2014-07-03T12:00:00Z')
+        self.assertEquals({'updated_at': '2014-07-03T12:00:00Z'},
+                          sub.get(timeout=0))
+        self.registry.notify('danvk', 'other', 1, '2014-07-04T12:00:00Z')
+        self.assertEquals(None, sub.get(timeout=0))
+
+    def test_webhooks_enabled(self):
+        self.registry = watchers.WatcherRegistry(interval=0.01,
+                                                 webhooks_enabled=True)
+        sub = self.registry.subscribe('token', 'danvk', 'dygraphs', 1,
+                                      '2014-07-01T12:00:00Z')
+        watcher = self._watcher()
+        self.assertEquals(None, watcher._thread)  # nothing polls github
+
+        # Changes come from webhook deliveries instead.
+        payload = {
+            'action': 'edited',
+            'repository': {'full_name': 'danvk/dygraphs'},
+            'pull_request': {'number': 1, 'updated_at': '2014-07-03T12:00:00Z'}
+        }
+        with patch('watchers.registry', self.registry), \
+                patch('github.update_cached_pull_request', MagicMock()), \
+                patch('github.expire_cache_for_pull_requests', MagicMock()), \
+                patch('github.expire_cache_for_snapshot', MagicMock()):
+            webhooks.handle_event('pull_request', payload)
+        self.assertEquals({'updated_at': '2014-07-03T12:00:00Z'},
+                          sub.get(timeout=0))
+
+        # If asked, it checks the cache, which the webhooks keep current.
+        watcher.poll()
+        self.assertFalse(self.get_pull_request.call_args[1]['bust_cache'])
+
+    def test_background_polling(self):
+        registry = watchers.WatcherRegistry(interval=0.01)
+        sub = registry.subscribe('token', 'danvk', 'dygraphs', 1,
+                                 '2014-06-01T12:00:00Z')
+        watcher = registry._watchers[('danvk', 'dygraphs', u'1')]
+        self.assertEquals({'updated_at': '2014-07-01T12:00:00Z'},
+                          sub.get(timeout=5))
+        registry.unsubscribe(sub)
+        watcher._thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+'''Keeps the github cache fresh using webhook deliveries.
+
+Without webhooks, the only way to notice that a pull request has changed is
+to ask github (see check_for_updates in app.py). If github is set up to send
+events to /webhook, each delivery invalidates (or replaces) exactly the cache
+entries it affects, so mutable data can be cached for much longer.
+
+See https://developer.github.com/webhooks/ for the payload formats.
+'''
+
+import hashlib
+import hmac
+import logging
+
+import github
+import watchers
+
+logger = logging.getLogger(__name__)
+
+# pull_request actions which change the commits in a pull request.
+_COMMIT_ACTIONS = ('opened', 'reopened', 'synchronize')
+
+
+def _signature(secret, body, digestmod):
+    return hmac.new(secret, body, digestmod).hexdigest()
+
+
+def verify_signature(secret, body, signature_256=None, signature_1=None):
+    '''Checks the X-Hub-Signature-256 (or older X-Hub-Signature) header.'''
+    if isinstance(secret, unicode):
+        secret = secret.encode('utf-8')
+    if signature_256:
+        expected = 'sha256=' + _signature(secret, body, hashlib.sha256)
+        return hmac.compare_digest(expected, str(signature_256))
+    if signature_1:
+        expected = 'sha1=' + _signature(secret, body, hashlib.sha1)
+        return hmac.compare_digest(expected, str(signature_1))
+    return False
+
+
+def _owner_and_repo(payload):
+    return payload['repository']['full_name'].split('/', 1)
+
+
+def handle_pull_request(payload):
+    owner, repo = _owner_and_repo(payload)
+    pr = payload['pull_request']
+    number = pr['number']
+    # An older event mustn't replace a newer copy of the pull request, but
+    # what it says changed (e.g. the commits) is still out of date.
+    if not github.update_cached_pull_request(owner, repo, pr):
+        logger.info('Keeping the newer cached copy of %s/%s#%s',
+                    owner, repo, number)
+    github.expire_cache_for_pull_requests(owner, repo)
+    if payload['action'] in _COMMIT_ACTIONS:
+        github.expire_cache_for_pull_request_children(owner, repo, number)
+    else:
+        github.expire_cache_for_snapshot(owner, repo, number)
+    watchers.registry.notify(owner, repo, number, pr['updated_at'])
+
+
+def handle_push(payload):
+    '''Expires any cached pull requests whose branch was pushed to.'''
+    ref = payload.get('ref', '')
+    if not ref.startswith('refs/heads/'):
+        return  # e.g. a tag
+    branch = ref[len('refs/heads/'):]
+    full_name = payload['repository']['full_name']
+    owner, repo = _owner_and_repo(payload)
+
+    numbers = [pr['number'] for pr in github.get_cached_pull_requests(owner, repo)
+               if pr['head']['ref'] == branch and
+                  (pr['head']['repo'] or {}).get('full_name') == full_name]
+    for number in numbers:
+        github.expire_cache_for_pull_request(owner, repo, number)
+        github.expire_cache_for_pull_request_children(owner, repo, number)
+    if numbers:
+        github.expire_cache_for_pull_requests(owner, repo)
+
+
+def handle_pull_request_review_comment(payload):
+    owner, repo = _owner_and_repo(payload)
+    pr = payload['pull_request']
+    github.expire_cache_for_comments(owner, repo, pr['number'],
+                                     top_level=False)
+    watchers.registry.notify(owner, repo, pr['number'], pr['updated_at'])
+
+
+def handle_issue_comment(payload):
+    if 'pull_request' not in payload['issue']:
+        return  # a comment on a plain issue
+    owner, repo = _owner_and_repo(payload)
+    issue = payload['issue']
+    github.expire_cache_for_comments(owner, repo, issue['number'],
+                                     diff_level=False)
+    if issue.get('updated_at'):
+        watchers.registry.notify(owner, repo, issue['number'],
+                                 issue['updated_at'])
+
+
+_HANDLERS = {
+    'pull_request': handle_pull_request,
+    'push': handle_push,
+    'pull_request_review_comment': handle_pull_request_review_comment,
+    'issue_comment': handle_issue_comment
+}
+
+
+def handle_event(event, payload):
+    '''Dispatches a webhook delivery. Returns False for unhandled events.'''
+    handler = _HANDLERS.get(event)
+    if not handler:
+        logger.info('Ignoring %s event', event)
+        return False
+    handler(payload)
+    return True
@@ -0,0 +1,121 @@
+import caching
+import github
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import webhooks
+from mock import patch
+
+PAYLOAD_DIR = os.path.join(os.path.dirname(__file__), 'testdata', 'webhooks')
+API = github.GITHUB_API_ROOT + '/repos/danvk/dygraphs'
+
+
+def _payload(name):
+    with open(os.path.join(PAYLOAD_DIR, name + '.json')) as f:
+        return json.load(f)
+
+
+class VerifySignatureTestCase(unittest.TestCase):
+
+    def test_signatures(self):
+        body = open(os.path.join(PAYLOAD_DIR, 'ping.json')).read()
+        sha256 = 'sha256=' + hmac.new('secret', body, hashlib.sha256).hexdigest()
+        sha1 = 'sha1=' + hmac.new('secret', body, hashlib.sha1).hexdigest()
+
+        self.assertTrue(webhooks.verify_signature('secret', body, signature_256=sha256))
+        self.assertTrue(webhooks.verify_signature(u'secret', body, signature_1=sha1))
+        self.assertFalse(webhooks.verify_signature('wrong', body, signature_256=sha256))
+        self.assertFalse(webhooks.verify_signature('secret', body + ' ', signature_1=sha1))
+        self.assertFalse(webhooks.verify_signature('secret', body))
+
+
+class HandleEventTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_patch = patch('github.cache',
+                                 caching.TieredCache(self.cache_dir))
+        self.cache_patch.start()
+
+        self.pr = _payload('pull_request.synchronize')['pull_request']
+        self.pr['updated_at'] = '2014-07-01T12:00:00Z'
+        self.pr['head']['sha'] = 'a' * 40
+        self.urls = {
+            'pr': API + '/pulls/1',
+            'pulls': API + '/pulls?per_page=100',
+            'commits': API + '/pulls/1/commits?per_page=100',
+            'issue_comments': API + '/issues/1/comments?per_page=100',
+            'diff_comments': API + '/pulls/1/comments?per_page=100',
+            'snapshot': github._snapshot_url('danvk', 'dygraphs', 1)
+        }
+        for name, url in self.urls.iteritems():
+            body = [self.pr] if name == 'pulls' else self.pr if name == 'pr' else []
+            github.cache.set(github._cache_key(url), json.dumps(body),
+                             meta={'etag': '"%s"' % name, 'fetched_at': 0})
+
+    def tearDown(self):
+        self.cache_patch.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def _stale(self):
+        return sorted(name for name, url in self.urls.iteritems()
+                      if github.cache.get_meta(github._cache_key(url)).get('stale'))
+
+    def _cached_pr(self):
+        return json.loads(github.cache.get(github._cache_key(self.urls['pr'])))
+
+    def test_synchronize(self):
+        self.assertTrue(webhooks.handle_event(
+                'pull_request', _payload('pull_request.synchronize')))
+        self.assertEquals(['commits', 'diff_comments', 'issue_comments',
+                           'pulls', 'snapshot'], self._stale())
+        self.assertEquals('c' * 40, self._cached_pr()['head']['sha'])
+
+    def test_edited(self):
+        webhooks.handle_event('pull_request', _payload('pull_request.edited'))
+        self.assertEquals(['pulls', 'snapshot'], self._stale())
+        self.assertEquals('2014-07-02T13:00:00Z', self._cached_pr()['updated_at'])
+
+    def test_out_of_order_delivery(self):
+        webhooks.handle_event('pull_request', _payload('pull_request.edited'))
+        webhooks.handle_event('pull_request', _payload('pull_request.synchronize'))
+        # The older synchronize event doesn't clobber the edit...
+        self.assertEquals('2014-07-02T13:00:00Z', self._cached_pr()['updated_at'])
+        # ... but the commits it announced are still stale.
+        self.assertIn('commits', self._stale())
+
+    def test_push(self):
+        webhooks.handle_event('push', _payload('push'))
+        self.assertEquals(['commits', 'diff_comments', 'issue_comments', 'pr',
+                           'pulls', 'snapshot'], self._stale())
+
+    def test_push_to_other_branch(self):
+        payload = _payload('push')
+        payload['ref'] = 'refs/heads/master'
+        webhooks.handle_event('push', payload)
+        self.assertEquals([], self._stale())
+
+    def test_review_comment(self):
+        webhooks.handle_event('pull_request_review_comment',
+                              _payload('pull_request_review_comment.created'))
+        self.assertEquals(['diff_comments', 'pr', 'snapshot'], self._stale())
+
+    def test_issue_comment(self):
+        webhooks.handle_event('issue_comment', _payload('issue_comment.created'))
+        self.assertEquals(['issue_comments', 'pr', 'snapshot'], self._stale())
+
+    def test_comment_on_plain_issue(self):
+        webhooks.handle_event('issue_comment', _payload('issue_comment.issue'))
+        self.assertEquals([], self._stale())
+
+    def test_unhandled_event(self):
+        self.assertFalse(webhooks.handle_event('ping', _payload('ping')))
+        self.assertEquals([], self._stale())
+
+
+if __name__ == '__main__':
+    unittest.main()